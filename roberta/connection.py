@@ -0,0 +1,165 @@
+import http.client
+from io import BytesIO
+import logging
+import socket
+import ssl
+import urllib.error
+import urllib.parse
+
+logger = logging.getLogger('roberta.connection')
+
+
+class PooledHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, pool, key, *args, **kwargs):
+        http.client.HTTPConnection.__init__(self, *args, **kwargs)
+        self.pool = pool
+        self.key = key
+
+    def connect(self):
+        self.sock = self.pool._create_connection(self.host, self.port, self.timeout)
+
+
+class PooledHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, pool, key, *args, **kwargs):
+        http.client.HTTPSConnection.__init__(self, *args, **kwargs)
+        self.pool = pool
+        self.key = key
+
+    def connect(self):
+        sock = self.pool._create_connection(self.host, self.port, self.timeout)
+        self.sock = self.pool._wrap_socket(sock, self.host, self.key)
+
+
+class HttpConnectionPool(object):
+    """Keep-alive http(s) connections to the server
+
+    Keeps one connection per (scheme, host:port) open across requests, reuses a
+    single ssl context (with session resumption where supported) and caches the
+    resolved address. Errors are mapped to the urllib.error exceptions, so that
+    callers can handle them the same way as for urllib.request.urlopen().
+    """
+
+    REDIRECTS = (301, 302, 303, 307, 308)
+    # same as urllib.request.HTTPRedirectHandler
+    MAX_REDIRECTS = 10
+
+    def __init__(self):
+        self.ssl_context = ssl.create_default_context()
+        self.connections = {}
+        self.addresses = {}
+        self.ssl_sessions = {}
+        self.stats = {
+            'requests': 0,
+            'connects': 0,
+            'reconnects': 0,
+        }
+
+    def _resolve(self, host, port):
+        key = (host, port)
+        addr = self.addresses.get(key)
+        if not addr:
+            info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            addr = info[0][4][:2]
+            self.addresses[key] = addr
+        return addr
+
+    def _create_connection(self, host, port, timeout):
+        self.stats['connects'] += 1
+        try:
+            return socket.create_connection(self._resolve(host, port), timeout)
+        except OSError:
+            # the server might have moved, resolve again next time
+            self.addresses.pop((host, port), None)
+            raise
+
+    def _wrap_socket(self, sock, host, key):
+        kwargs = {}
+        session = self.ssl_sessions.get(key)
+        if session:
+            kwargs['session'] = session
+        return self.ssl_context.wrap_socket(sock, server_hostname=host, **kwargs)
+
+    def _get(self, scheme, netloc, timeout):
+        key = (scheme, netloc)
+        conn = self.connections.get(key)
+        if conn:
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return conn, False
+        if scheme == 'https':
+            conn = PooledHTTPSConnection(self, key, netloc, timeout=timeout, context=self.ssl_context)
+        else:
+            conn = PooledHTTPConnection(self, key, netloc, timeout=timeout)
+        self.connections[key] = conn
+        return conn, True
+
+    def _drop(self, scheme, netloc):
+        conn = self.connections.pop((scheme, netloc), None)
+        if conn:
+            conn.close()
+
+    def request(self, url, data=None, headers=None, timeout=None):
+        """Send a GET (or POST if data is given) request and return the
+        response.
+
+        Redirects are followed like urllib.request does: 307 and 308 repeat the
+        request, 301, 302 and 303 turn it into a GET. Other responses outside
+        of 2xx (except 304) raise urllib.error.HTTPError. The response has to
+        be read completely before the next request is made.
+        """
+        headers = headers or {}
+        for i in range(HttpConnectionPool.MAX_REDIRECTS + 1):
+            response = self._send(url, data, headers, timeout)
+            if response.status not in HttpConnectionPool.REDIRECTS:
+                break
+            location = response.getheader('Location')
+            # consume the body to keep the connection usable
+            body = response.read()
+            if not location:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.msg, BytesIO(body))
+            logger.debug('redirected (%d) to %s', response.status, location)
+            url = urllib.parse.urljoin(url, location)
+            if response.status not in (307, 308):
+                data = None
+                headers = {k: v for (k, v) in headers.items() if k.lower() not in ('content-type', 'content-length')}
+        else:
+            raise urllib.error.HTTPError(url, response.status, 'too many redirects', response.msg, BytesIO(b''))
+        if not (200 <= response.status < 300 or response.status == 304):
+            # consume the body to keep the connection usable
+            body = response.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.msg, BytesIO(body))
+        return response
+
+    def _send(self, url, data, headers, timeout):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        method = 'POST' if data is not None else 'GET'
+        self.stats['requests'] += 1
+        while True:
+            conn, fresh = self._get(parts.scheme, parts.netloc, timeout)
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+                break
+            except (http.client.HTTPException, ConnectionError) as e:
+                self._drop(parts.scheme, parts.netloc)
+                if fresh:
+                    raise urllib.error.URLError(e)
+                # the server closed the kept-alive connection, reconnect
+                logger.debug('connection dropped (%s), reconnecting', repr(e))
+                self.stats['reconnects'] += 1
+            except OSError as e:
+                self._drop(parts.scheme, parts.netloc)
+                raise urllib.error.URLError(e)
+        if parts.scheme == 'https':
+            session = getattr(conn.sock, 'session', None)
+            if session:
+                self.ssl_sessions[(parts.scheme, parts.netloc)] = session
+        return response
+
+    def close(self):
+        for key in list(self.connections):
+            self._drop(*key)
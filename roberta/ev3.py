@@ -1,11 +1,16 @@
 
-from PIL import Image, ImageFont
+from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ThreadPoolExecutor
 import dbus    # only for waitForConnection() bluetooth
+from fcntl import ioctl
 import glob    # only for stopAllMotors()
 import logging
 import math
+import mmap
 import os
-import threading  # only for ledOn() animations
+import select
+import struct
+import threading
 import time
 
 # ignore failure to make this testable outside of the target platform
@@ -22,6 +27,10 @@ try:
 except ImportError:
     from .test import Ev3dev as ev3dev
 
+from .glyphs import GlyphAtlas, maskToRows
+from .keys import KeyState
+from .recorder import Recorder, runPeriodically
+
 logger = logging.getLogger('roberta.ev3')
 
 
@@ -29,10 +38,967 @@ def clamp(v, mi, ma):
     return mi if v < mi else ma if v > ma else v
 
 
+def isIdleOrStalled(state):
+    return not state or 'stalled' in state
+
+
+def pollUntil(func, timeout, interval=0.01):
+    """Call func until it returns something that is true or timeout seconds
+    have passed, returns the last result."""
+    deadline = time.monotonic() + timeout
+    while True:
+        result = func()
+        if result or time.monotonic() >= deadline:
+            return result
+        time.sleep(interval)
+
+
+class Waiter(object):
+    """Base for blocking waits that can be cancelled from another thread"""
+
+    # poll() is restarted after this many seconds, so that exceptions raised
+    # asynchronously into this thread (soft abort) get delivered
+    POLL_SLICE = 0.05
+
+    def __init__(self):
+        # self-pipe to cancel a wait from another thread
+        (self.wake_r, self.wake_w) = os.pipe2(os.O_NONBLOCK)
+
+    def close(self):
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def cancel(self):
+        """Make the current wait() return False."""
+        try:
+            os.write(self.wake_w, b'x')
+        except BlockingIOError:
+            pass  # already pending
+
+    def _drain(self):
+        try:
+            while os.read(self.wake_r, 64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _getRemaining(self, deadline):
+        if deadline is None:
+            return Waiter.POLL_SLICE
+        return deadline - time.monotonic()
+
+    def _poll(self, fds, mask, timeout):
+        """Poll fds for the events in mask, returns False if cancelled."""
+        poller = select.poll()
+        poller.register(self.wake_r, select.POLLIN)
+        for fd in fds:
+            poller.register(fd, mask)
+        events = poller.poll(1000 * min(Waiter.POLL_SLICE, timeout))
+        if any(fd == self.wake_r for (fd, _) in events):
+            self._drain()
+            return False
+        return True
+
+
+class MotorWaiter(Waiter):
+    """Waits for tacho motors to finish their commands
+
+    The driver notifies changes of the 'state' attribute, hence we block in
+    poll() on the attribute files instead of re-reading them in a loop. Motors
+    without an attribute file (e.g. in tests) are checked periodically.
+    """
+
+    # check interval for motors that can't be polled
+    CHECK_INTERVAL = 0.005
+
+    def __init__(self):
+        super(MotorWaiter, self).__init__()
+        # path -> fd of the 'state' attribute
+        self.state_fds = {}
+
+    def close(self):
+        for fd in self.state_fds.values():
+            os.close(fd)
+        self.state_fds = {}
+        super(MotorWaiter, self).close()
+
+    def _getStateFd(self, m):
+        path = getattr(m, '_path', None)
+        if not path:
+            return None
+        fd = self.state_fds.get(path)
+        if fd is None:
+            try:
+                fd = os.open(os.path.join(path, 'state'), os.O_RDONLY)
+            except OSError:
+                return None
+            self.state_fds[path] = fd
+        return fd
+
+    def _getState(self, m):
+        fd = self._getStateFd(m)
+        if fd is not None:
+            try:
+                # reading the attribute also re-arms poll()
+                return os.pread(fd, 256, 0).decode().split()
+            except OSError:
+                # motor got unplugged
+                del self.state_fds[m._path]
+                os.close(fd)
+        return m.state
+
+    def wait(self, motors, done=None, timeout=None):
+        """Wait until done(state) is true for all motors.
+
+        By default this waits for the motors to become idle. Returns False on
+        timeout or if the wait got cancelled.
+        """
+        done = done or (lambda state: not state)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self._drain()
+        pending = list(motors)
+        while True:
+            pending = [m for m in pending if not done(self._getState(m))]
+            if not pending:
+                return True
+            remaining = self._getRemaining(deadline)
+            if remaining <= 0:
+                return False
+            fds = [self._getStateFd(m) for m in pending]
+            if None in fds:
+                if not self._poll([], 0, min(MotorWaiter.CHECK_INTERVAL, remaining)):
+                    return False
+            elif not self._poll(fds, select.POLLPRI | select.POLLERR, remaining):
+                return False
+
+
+class ProcessWaiter(Waiter):
+    """Waits for child processes (sound and speech commands)
+
+    Uses a pidfd where the kernel supports it. Otherwise the process is checked
+    with increasing intervals.
+    """
+
+    MIN_INTERVAL = 0.001
+    MAX_INTERVAL = 0.02
+
+    def _openPidfd(self, pid):
+        if not hasattr(os, 'pidfd_open'):
+            return None
+        try:
+            return os.pidfd_open(pid)
+        except OSError:
+            return None
+
+    def wait(self, cmd, timeout=None):
+        """Wait for the subprocess.Popen cmd to exit.
+
+        Returns False on timeout or if the wait got cancelled.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self._drain()
+        pidfd = self._openPidfd(cmd.pid)
+        interval = ProcessWaiter.MIN_INTERVAL
+        try:
+            while cmd.poll() is None:
+                remaining = self._getRemaining(deadline)
+                if remaining <= 0:
+                    return False
+                if pidfd is not None:
+                    if not self._poll([pidfd], select.POLLIN, remaining):
+                        return False
+                else:
+                    if not self._poll([], 0, min(interval, remaining)):
+                        return False
+                    interval = min(interval * 2, ProcessWaiter.MAX_INTERVAL)
+            return True
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+
+
+class SensorReader(object):
+    """Reads the values of a sensor from its sysfs attributes
+
+    The attribute files are kept open and read with os.pread(), 'decimals' and
+    'num_values' are cached per mode. If 'bin_data' decodes to the same values
+    as the 'value<N>' attributes, all values are read from it in one go.
+    """
+
+    BIN_DATA_FORMATS = {
+        'u8': '<B',
+        's8': '<b',
+        'u16': '<H',
+        's16': '<h',
+        's16_be': '>h',
+        's32': '<i',
+        'float': '<f',
+    }
+
+    class Mode(object):
+        def __init__(self, scale, num_values, bin_data=None):
+            self.scale = scale
+            self.num_values = num_values
+            # struct.Struct for all values, None if 'bin_data' is not usable
+            self.bin_data = bin_data
+
+    def __init__(self, path):
+        self.path = path
+        # attribute name -> fd
+        self.fds = {}
+        self.modes = {}
+        # number of reads
+        self.reads = 0
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+    def _read(self, name, size=64):
+        fd = self.fds.get(name)
+        if fd is None:
+            fd = os.open(os.path.join(self.path, name), os.O_RDONLY)
+            self.fds[name] = fd
+        self.reads += 1
+        return os.pread(fd, size, 0)
+
+    def _readValue(self, n):
+        return float(self._read('value%d' % n))
+
+    def _getMode(self, mode):
+        info = self.modes.get(mode)
+        if info is None:
+            scale = 10.0 ** int(self._read('decimals'))
+            num_values = int(self._read('num_values'))
+            info = SensorReader.Mode(scale, num_values)
+            fmt = SensorReader.BIN_DATA_FORMATS.get(self._read('bin_data_format').decode().strip())
+            if fmt:
+                bin_data = struct.Struct(fmt[0] + fmt[1] * num_values)
+                try:
+                    values = bin_data.unpack(self._read('bin_data', bin_data.size))
+                    if list(values) == [self._readValue(i) for i in range(num_values)]:
+                        info.bin_data = bin_data
+                except (OSError, struct.error):
+                    pass
+            self.modes[mode] = info
+        return info
+
+    def read(self, mode=None):
+        """Read the scaled values of the sensor in the mode (that the sensor
+        is already in). None stands for the mode the sensor was found in, it
+        is cached like the others (see Hal.invalidateSensorModes())."""
+        info = self._getMode(mode)
+        if info.bin_data:
+            values = info.bin_data.unpack(self._read('bin_data', info.bin_data.size))
+        else:
+            values = [self._readValue(i) for i in range(info.num_values)]
+        return tuple([v / info.scale for v in values])
+
+
+class SensorSampler(object):
+    """Reads the sensors from a background thread
+
+    Publishes the latest values of each sensor together with the mode and the
+    time they were read, so that the getters can return them without doing
+    any I/O. Only sensors that are in a known mode (see Hal.getSensor()) are
+    sampled.
+    """
+
+    def __init__(self, hal, rates, max_staleness=None, clock=time.monotonic):
+        """rates maps the ports to the sample rate in Hz, values older than
+        max_staleness seconds (default: two sample periods) are not used."""
+        self.hal = hal
+        self.periods = {port: 1.0 / rate for (port, rate) in rates.items()}
+        self.max_staleness = max_staleness
+        self.clock = clock
+        # sensor -> (mode, values, timestamp, port), the tuples get replaced, never
+        # modified, hence readers need no lock
+        self.snapshots = {}
+        # port -> [samples, errors, first, last, sum of intervals, sum of squared intervals]
+        self.stats = {port: [0, 0, None, None, 0.0, 0.0] for port in rates}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.snapshots = {}
+
+    def discard(self, sensor):
+        """Drop the values of the sensor, e.g. after resetting it."""
+        self.snapshots.pop(sensor, None)
+
+    def getValues(self, sensor, mode):
+        """Get the latest values of the sensor in mode, None if there are none
+        or they are too old."""
+        snapshot = self.snapshots.get(sensor)
+        if snapshot is None or snapshot[0] != mode:
+            return None
+        port = snapshot[3]
+        max_staleness = self.max_staleness
+        if max_staleness is None:
+            max_staleness = 2.0 * self.periods[port]
+        if self.clock() - snapshot[2] > max_staleness:
+            return None
+        return snapshot[1]
+
+    def getStats(self):
+        """Get the achieved sample rate (Hz) and jitter (standard deviation of
+        the sample intervals in seconds) per port."""
+        stats = {}
+        for (port, (samples, errors, first, last, sum_dt, sum_dt2)) in self.stats.items():
+            rate = jitter = 0.0
+            if samples > 1:
+                n = samples - 1
+                rate = n / (last - first) if last > first else 0.0
+                jitter = math.sqrt(max(0.0, sum_dt2 / n - (sum_dt / n) ** 2))
+            stats[port] = {
+                'samples': samples,
+                'errors': errors,
+                'rate': rate,
+                'jitter': jitter,
+            }
+        return stats
+
+    def _sample(self, port):
+        sensor = self.hal.cfg['sensors'].get(port)
+        if not sensor:
+            return
+        stats = self.stats[port]
+        with self.hal.sensor_lock:
+            mode = self.hal.sensor_modes.get(sensor)
+            if mode is None:
+                return
+            try:
+                values = self.hal.readSensor(sensor)
+            except (IOError, OSError, ValueError, struct.error):
+                stats[1] += 1
+                self.discard(sensor)
+                return
+        now = self.clock()
+        self.snapshots[sensor] = (mode, values, now, port)
+        if stats[3] is not None:
+            dt = now - stats[3]
+            stats[4] += dt
+            stats[5] += dt * dt
+        else:
+            stats[2] = now
+        stats[0] += 1
+        stats[3] = now
+
+    def _run(self):
+        runPeriodically(self.periods, self._sample, self.stop_event, self.clock)
+
+
+class WriteCache(object):
+    """Skips writes of device attributes that already have the value
+
+    Only use this for attributes that nobody but us changes (setpoints, led
+    brightness). The cache is dropped if a write fails.
+    """
+
+    def __init__(self):
+        # (device, attribute name) -> value
+        self.values = {}
+        # number of writes that were skipped
+        self.saved = 0
+
+    def write(self, device, name, value):
+        key = (device, name)
+        if key in self.values and self.values[key] == value:
+            self.saved += 1
+            return
+        try:
+            setattr(device, name, value)
+        except Exception:
+            self.invalidate()
+            raise
+        self.values[key] = value
+
+    def invalidate(self):
+        self.values = {}
+
+
+class MotorHandle(object):
+    """Thin wrapper around an ev3dev motor
+
+    Captures the attributes that never change for a motor ('max_speed',
+    'count_per_rot') once, everything else is passed through to the motor.
+    Writes of the setpoints go through a WriteCache.
+    """
+
+    CACHED_ATTRIBUTES = frozenset([
+        'duty_cycle_sp',
+        'polarity',
+        'position_sp',
+        'ramp_down_sp',
+        'ramp_up_sp',
+        'speed_sp',
+        'stop_action',
+        'time_sp',
+    ])
+
+    # handles with an open command fd, of all Hal instances in this process
+    open_handles = set()
+
+    def __init__(self, motor):
+        self.__dict__['motor'] = motor
+        self.__dict__['cache'] = WriteCache()
+        # dc-motors have neither
+        self.__dict__['max_speed'] = getattr(motor, 'max_speed', None)
+        count_per_rot = getattr(motor, 'count_per_rot', None)
+        self.__dict__['count_per_rot'] = count_per_rot
+        self.__dict__['degrees_per_count'] = 360.0 / count_per_rot if count_per_rot else None
+
+    def __getattr__(self, name):
+        return getattr(self.motor, name)
+
+    def __setattr__(self, name, value):
+        if name in MotorHandle.CACHED_ATTRIBUTES:
+            self.cache.write(self.motor, name, value)
+        else:
+            setattr(self.motor, name, value)
+
+    # the ev3dev commands set their kwargs as attributes on the motor, we do
+    # that ourselves so that the cache sees them
+    def _command(self, command, kwargs):
+        for (name, value) in kwargs.items():
+            setattr(self, name, value)
+        getattr(self.motor, command)()
+
+    def run_forever(self, **kwargs):
+        self._command('run_forever', kwargs)
+
+    def run_to_abs_pos(self, **kwargs):
+        self._command('run_to_abs_pos', kwargs)
+
+    def run_to_rel_pos(self, **kwargs):
+        self._command('run_to_rel_pos', kwargs)
+
+    def run_timed(self, **kwargs):
+        self._command('run_timed', kwargs)
+
+    def run_direct(self, **kwargs):
+        self._command('run_direct', kwargs)
+
+    def stop(self, **kwargs):
+        self._command('stop', kwargs)
+
+    def reset(self, **kwargs):
+        # resets all setpoints
+        self.cache.invalidate()
+        self._command('reset', kwargs)
+
+    def getCommandFd(self):
+        """Get the (cached) fd of the 'command' attribute, None if the motor is
+        not in sysfs."""
+        if 'command_fd' not in self.__dict__:
+            path = getattr(self.motor, '_path', None)
+            fd = None
+            if path:
+                try:
+                    fd = os.open(os.path.join(path, 'command'), os.O_WRONLY)
+                except OSError:
+                    pass
+            self.__dict__['command_fd'] = fd
+            if fd is not None:
+                MotorHandle.open_handles.add(self)
+        return self.__dict__['command_fd']
+
+    def closeCommandFd(self):
+        fd = self.__dict__.pop('command_fd', None)
+        if fd is not None:
+            os.close(fd)
+        MotorHandle.open_handles.discard(self)
+
+    @staticmethod
+    def closeAllCommandFds():
+        for handle in list(MotorHandle.open_handles):
+            handle.closeCommandFd()
+
+
+class ConfigurationBuilder(object):
+    """Builds a brickConfiguration, probing all ports in parallel
+
+        builder = ConfigurationBuilder({'wheel-diameter': 5.6, 'track-width': 18.0})
+        builder.addActor('B', Hal.makeLargeMotor, ev3dev.OUTPUT_B, 'on', 'forward')
+        builder.addSensor('1', Hal.makeTouchSensor, ev3dev.INPUT_1)
+        hal = Hal(builder.build())
+
+    After build(), timings has the seconds spent per port (and 'total').
+    """
+
+    def __init__(self, cfg=None, max_workers=4):
+        self.cfg = dict(cfg or {})
+        self.max_workers = max_workers
+        # (section, port, factory, args)
+        self.probes = []
+        self.timings = {}
+
+    def addActor(self, port, factory, *args):
+        self.probes.append(('actors', port, factory, args))
+
+    def addSensor(self, port, factory, *args):
+        self.probes.append(('sensors', port, factory, args))
+
+    def _probe(self, factory, args):
+        start = time.monotonic()
+        device = factory(*args)
+        return (device, time.monotonic() - start)
+
+    def build(self):
+        start = time.monotonic()
+        cfg = dict(self.cfg)
+        cfg['actors'] = {}
+        cfg['sensors'] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [(section, port, executor.submit(self._probe, factory, args))
+                       for (section, port, factory, args) in self.probes]
+            for (section, port, future) in futures:
+                (cfg[section][port], self.timings[port]) = future.result()
+        self.timings['total'] = time.monotonic() - start
+        logger.debug('hardware probing took %s', ', '.join(
+            ['%s: %.3f s' % (port, t) for (port, t) in sorted(self.timings.items())]))
+        return cfg
+
+
+def textSize(msg, font, spacing=4):
+    """Get the size of msg as drawn by ImageDraw.text() (what the deprecated
+    ImageDraw.textsize() returned)."""
+    sizes = [font.getmask(line).size for line in msg.split('\n')]
+    line_h = font.getmask('A').size[1] + spacing
+    return (max(w for (w, h) in sizes), line_h * (len(sizes) - 1) + sizes[-1][1])
+
+
+class DisplayStats(object):
+    """Counts the frames and bytes written by Display and FramebufferDisplay"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.resetStats()
+
+    def resetStats(self):
+        self.frames = 0
+        self.bytes = 0
+        self.stats_start = self.clock()
+
+    def getStats(self):
+        """Get the flushed frames and written bytes, in total and per second."""
+        elapsed = self.clock() - self.stats_start
+        return {
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'fps': self.frames / elapsed if elapsed > 0 else 0.0,
+            'bytes_per_s': self.bytes / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class Display(DisplayStats):
+    """Coalesces the updates of the screen
+
+    Drawing marks a dirty rectangle, flushing copies it to the framebuffer. For
+    1 bit framebuffers only the rows that differ from what we've written last
+    are copied, otherwise this falls back to Screen.update(). By default every
+    draw is flushed right away, with max_fps set draws within 1 / max_fps of
+    the last flush are left to a timer (or an explicit flush()).
+    """
+
+    PICTURE_SIZE = (178, 128)
+
+    def __init__(self, screen, max_fps=None, clock=time.monotonic):
+        DisplayStats.__init__(self, clock)
+        self.screen = screen
+        self.max_fps = max_fps
+        # guards the image against the flush timer
+        self.lock = threading.RLock()
+        self.fb = getattr(screen, 'mmap', None)
+        var_info = getattr(screen, 'var_info', None)
+        if var_info is not None and var_info.bits_per_pixel == 1:
+            # bytes per row, the image is as wide as the stride
+            self.stride = screen.fix_info.line_length
+        else:
+            self.stride = None
+        self.size = screen.image.size
+        # (x0, y0, x1, y1), None if nothing is pending
+        self.dirty = None
+        # the rows as we've written them, None if unknown
+        self.invalidateRows()
+        self.last_flush = None
+        self.timer = None
+
+    def text(self, xy, msg, font):
+        with self.lock:
+            self.screen.draw.text(xy, msg, font=font)
+            (w, h) = textSize(msg, font)
+            self.invalidate((xy[0], xy[1], xy[0] + w, xy[1] + h))
+        self.update()
+
+    def glyphs(self, xy, msg, atlas):
+        self.blit(xy, atlas.render(msg))
+
+    def picture(self, data, xy):
+        """Paste a screen sized picture (inverted 1 bit rows, lsb first)."""
+        pixels = Image.frombytes('1', Display.PICTURE_SIZE, data, 'raw', '1;IR', 0, 1)
+        self.paste(pixels, xy)
+
+    def blit(self, xy, mask, ink=0):
+        """Fill the pixels set in mask with ink."""
+        (w, h) = mask.size
+        box = (xy[0], xy[1], xy[0] + w, xy[1] + h)
+        with self.lock:
+            self.screen.image.paste(ink, box, mask)
+            self.invalidate(box)
+        self.update()
+
+    def paste(self, image, xy):
+        with self.lock:
+            self.screen.image.paste(image, xy)
+            self.invalidate((xy[0], xy[1], xy[0] + image.size[0], xy[1] + image.size[1]))
+        self.update()
+
+    def clear(self):
+        with self.lock:
+            self.screen.clear()
+            # others write the framebuffer as well (e.g. the Hal of the program
+            # vs. the one of the daemon), make sure the screen really is blank
+            self.invalidateRows()
+            self.invalidate()
+        self.update()
+
+    def invalidateRows(self):
+        """Forget what we've written, the next flush writes all dirty rows."""
+        with self.lock:
+            self.rows = [None] * self.size[1]
+
+    def invalidate(self, rect=None):
+        """Mark rect (x0, y0, x1, y1) as changed, the whole screen if None."""
+        (w, h) = self.size
+        if rect is None:
+            rect = (0, 0, w, h)
+        (x0, y0, x1, y1) = rect
+        rect = (max(0, x0), max(0, y0), min(w, x1), min(h, y1))
+        if rect[0] >= rect[2] or rect[1] >= rect[3]:
+            return
+        with self.lock:
+            if self.dirty:
+                rect = (min(rect[0], self.dirty[0]), min(rect[1], self.dirty[1]),
+                        max(rect[2], self.dirty[2]), max(rect[3], self.dirty[3]))
+            self.dirty = rect
+
+    def update(self):
+        """Flush the dirty rectangle, unless that would exceed max_fps."""
+        with self.lock:
+            if self.dirty is None:
+                return
+            if self.max_fps and self.last_flush is not None:
+                delay = self.last_flush + 1.0 / self.max_fps - self.clock()
+                if delay > 0:
+                    if self.timer is None:
+                        self.timer = threading.Timer(delay, self.flush)
+                        self.timer.daemon = True
+                        self.timer.start()
+                    return
+            self._write()
+
+    def flush(self):
+        """Write pending changes now."""
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            if self.dirty is not None:
+                self._write()
+
+    def _write(self):
+        (x0, y0, x1, y1) = self.dirty
+        self.dirty = None
+        if self.fb is None or self.stride is None:
+            self.screen.update()
+            written = len(self.fb) if self.fb is not None else 0
+        else:
+            written = 0
+            stride = self.stride
+            band = self.screen.image.crop((0, y0, self.size[0], y1)).tobytes('raw', '1;R')
+            for y in range(y0, y1):
+                row = band[(y - y0) * stride:(y - y0 + 1) * stride]
+                if self.rows[y] != row:
+                    self.rows[y] = row
+                    self.fb[y * stride:(y + 1) * stride] = row
+                    written += stride
+        self.frames += 1
+        self.bytes += written
+        self.last_flush = self.clock()
+
+
+class Framebuffer(object):
+    """A mapped 1 bit framebuffer, e.g. /dev/fb0
+
+    Rows are stride bytes long and set bits are white pixels, the same as
+    ev3dev.Screen.update() writes. With lsb_first (the EV3 LCD) pixel x is bit
+    x % 8 of byte x // 8, otherwise bit 7 - x % 8. Rows are passed in as ints
+    with bit x for pixel x, see maskToRows().
+    """
+
+    FBIOGET_VSCREENINFO = 0x4600
+    FBIOGET_FSCREENINFO = 0x4602
+    # the fields we need from struct fb_var_screeninfo: xres, yres, xres_virtual,
+    # yres_virtual, xoffset, yoffset, bits_per_pixel
+    VAR_SCREENINFO = struct.Struct('7I')
+    # and from struct fb_fix_screeninfo, up to line_length
+    FIX_SCREENINFO = struct.Struct('16sLIIIIHHHI')
+    REVERSED_BITS = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+    def __init__(self, fd, xres, yres, stride, lsb_first=True):
+        self.xres = xres
+        self.yres = yres
+        self.stride = stride
+        self.lsb_first = lsb_first
+        self.mmap = mmap.mmap(fd, stride * yres)
+        # like ev3dev.Screen we draw into the padding of the rows as well
+        self.width = stride * 8
+        self.pixels = (1 << self.width) - 1
+
+    @staticmethod
+    def open(path=None, geometry=None, lsb_first=True):
+        """Map the framebuffer device path (default: $FRAMEBUFFER or /dev/fb0).
+
+        geometry is (xres, yres, stride), it is queried from the device if
+        None. Raises ValueError if this is not a 1 bit framebuffer.
+        """
+        path = path or os.getenv('FRAMEBUFFER', '/dev/fb0')
+        fd = os.open(path, os.O_RDWR)
+        try:
+            if geometry is None:
+                var_info = bytearray(Framebuffer.VAR_SCREENINFO.size)
+                ioctl(fd, Framebuffer.FBIOGET_VSCREENINFO, var_info)
+                (xres, yres, _, _, _, _, bpp) = Framebuffer.VAR_SCREENINFO.unpack(var_info)
+                if bpp != 1:
+                    raise ValueError('%s has %d bits per pixel' % (path, bpp))
+                fix_info = bytearray(Framebuffer.FIX_SCREENINFO.size)
+                ioctl(fd, Framebuffer.FBIOGET_FSCREENINFO, fix_info)
+                geometry = (xres, yres, Framebuffer.FIX_SCREENINFO.unpack(fix_info)[-1])
+            return Framebuffer(fd, *geometry, lsb_first=lsb_first)
+        finally:
+            # the mapping keeps the device open
+            os.close(fd)
+
+    def close(self):
+        self.mmap.close()
+
+    def readRow(self, y):
+        data = self.mmap[y * self.stride:(y + 1) * self.stride]
+        if not self.lsb_first:
+            data = data.translate(Framebuffer.REVERSED_BITS)
+        return int.from_bytes(data, 'little')
+
+    def writeRow(self, y, bits):
+        data = bits.to_bytes(self.stride, 'little')
+        if not self.lsb_first:
+            data = data.translate(Framebuffer.REVERSED_BITS)
+        self.mmap[y * self.stride:(y + 1) * self.stride] = data
+
+    def _shift(self, bits, x):
+        return (bits << x if x >= 0 else bits >> -x) & self.pixels
+
+    def blit(self, x, y, rows, white=False):
+        """Set the pixels of rows at (x, y) to black (or white), returns the
+        number of bytes written."""
+        written = 0
+        for (i, bits) in enumerate(rows, y):
+            if 0 <= i < self.yres:
+                old = self.readRow(i)
+                bits = self._shift(bits, x)
+                new = old | bits if white else old & ~bits
+                if new != old:
+                    self.writeRow(i, new)
+                    written += self.stride
+        return written
+
+    def paste(self, x, y, rows, width):
+        """Replace width pixels at (x, y) by rows (set bits are white), returns
+        the number of bytes written."""
+        region = self._shift((1 << width) - 1, x)
+        written = 0
+        for (i, bits) in enumerate(rows, y):
+            if 0 <= i < self.yres:
+                old = self.readRow(i)
+                new = (old & ~region) | (self._shift(bits, x) & region)
+                if new != old:
+                    self.writeRow(i, new)
+                    written += self.stride
+        return written
+
+    def clear(self):
+        self.mmap[:] = b'\xff' * len(self.mmap)
+        return len(self.mmap)
+
+
+class FramebufferDisplay(DisplayStats):
+    """Draws straight into a Framebuffer instead of a PIL image
+
+    Has the same interface as Display, but every draw writes the rows it
+    changes right away. Hence there is no conversion of the whole screen and
+    nothing to coalesce (max_fps and flush() have no effect).
+    """
+
+    def __init__(self, framebuffer, clock=time.monotonic):
+        DisplayStats.__init__(self, clock)
+        self.framebuffer = framebuffer
+        self.max_fps = None
+        self.lock = threading.RLock()
+        self.last_flush = None
+
+    def invalidate(self, rect=None):
+        pass
+
+    def invalidateRows(self):
+        pass
+
+    def update(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def text(self, xy, msg, font):
+        # fonts we have no atlas for and multi-line text
+        fb = self.framebuffer
+        mask = Image.new('1', (max(0, fb.width - xy[0]), max(0, fb.yres - xy[1])), 0)
+        ImageDraw.Draw(mask).text((0, 0), msg, font=font, fill=1)
+        self.blit(xy, mask)
+
+    def glyphs(self, xy, msg, atlas):
+        self._draw(self.framebuffer.blit, xy[0], xy[1], atlas.renderRows(msg))
+
+    def picture(self, data, xy):
+        (w, h) = Display.PICTURE_SIZE
+        stride = (w + 7) // 8
+        if len(data) < stride * h:
+            raise ValueError('not enough image data')
+        # set bits are black in the picture
+        pixels = (1 << w) - 1
+        rows = [~int.from_bytes(data[y * stride:(y + 1) * stride], 'little') & pixels for y in range(h)]
+        self._draw(self.framebuffer.paste, xy[0], xy[1], rows, w)
+
+    def blit(self, xy, mask, ink=0):
+        self._draw(self.framebuffer.blit, xy[0], xy[1], maskToRows(mask), ink != 0)
+
+    def paste(self, image, xy):
+        if image.mode != '1':
+            image = image.convert('1')
+        self._draw(self.framebuffer.paste, xy[0], xy[1], maskToRows(image), image.size[0])
+
+    def clear(self):
+        self._draw(self.framebuffer.clear)
+
+    def _draw(self, func, *args):
+        with self.lock:
+            self.bytes += func(*args)
+            self.frames += 1
+            self.last_flush = self.clock()
+
+
+def loadFont(name, pool=None):
+    filename = os.path.join(os.path.dirname(__file__), name)
+    if pool:
+        return pool.getFont(filename)
+    return ImageFont.load(filename)
+
+
+def loadAtlas(name, pool=None):
+    if pool:
+        return pool.getAtlas(name)
+    return GlyphAtlas(loadFont(name))
+
+
+class HalPool(object):
+    """Warm resources, shared by the Hal instances of consecutive programs
+
+    Keeps the fonts, the screen, the buttons and the ev3dev devices (by class,
+    port and kwargs). Devices are only reused while their sysfs directory
+    exists, Hal.resetState() on the daemon side is what sanitizes them between
+    runs.
+    """
+
+    def __init__(self):
+        self.fonts = {}
+        self.atlases = {}
+        self.screen = None
+        self.keys = None
+        self.key_state = None
+        self.devices = {}
+        self.hits = 0
+        self.misses = 0
+
+    def warm(self):
+        """Load what every program needs (e.g. before forking)."""
+        loadAtlas('ter-u12n_unicode.pil', self)
+        self.getScreen()
+        self.getButton()
+
+    def getFont(self, filename):
+        font = self.fonts.get(filename)
+        if font is None:
+            font = self.fonts[filename] = ImageFont.load(filename)
+        return font
+
+    def getAtlas(self, name):
+        atlas = self.atlases.get(name)
+        if atlas is None:
+            atlas = self.atlases[name] = GlyphAtlas(loadFont(name, self))
+        return atlas
+
+    def getScreen(self):
+        if self.screen is None:
+            self.screen = ev3dev.Screen()
+        return self.screen
+
+    def getButton(self):
+        if self.keys is None:
+            self.keys = ev3dev.Button()
+        return self.keys
+
+    def getKeyState(self):
+        if self.key_state is None:
+            key_state = KeyState()
+            self.key_state = key_state.start() and key_state
+        elif self.key_state:
+            # don't report presses from the previous program
+            with self.key_state.cond:
+                self.key_state.events.clear()
+        return self.key_state
+
+    def getDevice(self, cls, port, **kwargs):
+        key = (cls, port, tuple(sorted(kwargs.items())))
+        device = self.devices.get(key)
+        if device is not None:
+            path = getattr(device, '_path', None)
+            if path is None or os.path.isdir(path):
+                self.hits += 1
+                return device
+            del self.devices[key]
+        self.misses += 1
+        device = cls(port, **kwargs)
+        if getattr(device, 'connected', True):
+            self.devices[key] = device
+        return device
+
+
 class Hal(object):
     # class global, so that the front-end can cleanup on forced termination
     # popen objects
     cmds = []
+    # key states started without a pool
+    key_states = set()
     # led blinker
     led_blink_thread = None
     led_blink_running = False
@@ -51,18 +1017,59 @@ class Hal(object):
 
     LED_ALL = ev3dev.Leds.LEFT + ev3dev.Leds.RIGHT
 
+    KEY_ALIASES = {
+        'escape': 'backspace',
+        'back': 'backspace',
+    }
+
+    # max seconds to wait for devices to show up after changing a port mode
+    PROBE_TIMEOUT = 1.0
+
+    # HalPool, shared by consecutive programs
+    pool = None
+    # Framebuffer, if we draw into it directly
+    framebuffer = None
+
     def __init__(self, brickConfiguration):
         self.cfg = brickConfiguration
-        dir = os.path.dirname(__file__)
+        cfg = brickConfiguration or {}
+        # geometry of the robot in cm
+        self.wheel_circumference = math.pi * cfg['wheel-diameter'] if 'wheel-diameter' in cfg else None
+        self.track_circumference = math.pi * cfg['track-width'] if 'track-width' in cfg else None
+        pool = Hal.pool
         # char size: 6 x 12 -> num-chars: 29.666667 x 10.666667
-        self.font_s = ImageFont.load(os.path.join(dir, 'ter-u12n_unicode.pil'))
+        self.font_name = 'ter-u12n_unicode.pil'
         # char size: 10 x 18 -> num-chars: 17.800000 x 7.111111
-        # self.font_s = ImageFont.load(os.path.join(dir, 'ter-u18n_unicode.pil'))
-        self.lcd = ev3dev.Screen()
+        # self.font_name = 'ter-u18n_unicode.pil'
+        self.font_s = loadFont(self.font_name, pool)
+        # built on the first drawText(), see getAtlas()
+        self.atlas = None
+        self.lcd = pool.getScreen() if pool else ev3dev.Screen()
+        if Hal.framebuffer:
+            self.display = FramebufferDisplay(Hal.framebuffer)
+        else:
+            # flushed immediately, see setDisplayMaxFps()
+            self.display = Display(self.lcd)
         self.led = ev3dev.Leds
-        self.keys = ev3dev.Button()
+        self.led_cache = WriteCache()
+        # motor starts: [count, sum of the start skews, max start skew, last start skew]
+        self.motor_start_stats = [0, 0.0, 0.0, 0.0]
+        self.keys = pool.getButton() if pool else ev3dev.Button()
+        # started on first use, False if there is no input device
+        self.key_state = None
+        # created on first use
+        self.motor_waiter = None
+        self.process_waiter = None
+        # sensor -> the mode we've set, saves reading the mode from sysfs
+        self.sensor_modes = {}
+        # sensor -> SensorReader, None if the sensor is not in sysfs
+        self.sensor_readers = {}
+        # guards mode changes and reads, if the sensor sampler runs
+        self.sensor_lock = threading.RLock()
+        self.sensor_sampler = None
+        self.recorder = None
         self.sound = ev3dev.Sound
-        (self.font_w, self.font_h) = self.lcd.draw.textsize('X', font=self.font_s)
+        (self.font_w, self.font_h) = self.font_s.getmask('X').size
         # logger.info('char size: %d x %d -> num-chars: %f x %f',
         #     self.font_w, self.font_h, 178 / self.font_w, 128 / self.font_h)
         self.timers = {}
@@ -72,16 +1079,48 @@ class Hal(object):
         self.lang = 'de'
 
     # factory methods
+    @staticmethod
+    def _findSensor(cls, port):
+        s = Hal.openDevice(cls, port)
+        return s if s.connected else None
+
+    @staticmethod
+    def openDevice(cls, port, **kwargs):
+        """Create the ev3dev device for the port, reuses it from the pool if
+        there is one."""
+        if Hal.pool:
+            return Hal.pool.getDevice(cls, port, **kwargs)
+        return cls(port, **kwargs)
+
+    @staticmethod
+    def enablePool():
+        """Let the following Hal instances share warm resources, see HalPool."""
+        if Hal.pool is None:
+            Hal.pool = HalPool()
+        return Hal.pool
+
+    @staticmethod
+    def enableFramebuffer(path=None, geometry=None):
+        """Let the following Hal instances draw straight into the framebuffer,
+        see FramebufferDisplay. Returns None if it is not a 1 bit framebuffer."""
+        if Hal.framebuffer is None:
+            try:
+                Hal.framebuffer = Framebuffer.open(path, geometry)
+            except (OSError, ValueError) as e:
+                logger.info('not drawing into the framebuffer directly: %s', e)
+        return Hal.framebuffer
+
     @staticmethod
     # TODO(ensonic): 'regulated' is unused, it is passed to the motor-functions
     # directly, consider making all params after port 'kwargs'
     def makeLargeMotor(port, regulated, direction):
         try:
-            m = ev3dev.LargeMotor(port)
+            m = Hal.openDevice(ev3dev.LargeMotor, port)
             if direction == 'backward':
                 m.polarity = 'inversed'
             else:
                 m.polarity = 'normal'
+            m = MotorHandle(m)
         except (AttributeError, OSError):
             logger.info('no large motor connected to port [%s]', port)
             logger.exception("HW Config error")
@@ -91,11 +1130,12 @@ class Hal(object):
     @staticmethod
     def makeMediumMotor(port, regulated, direction):
         try:
-            m = ev3dev.MediumMotor(port)
+            m = Hal.openDevice(ev3dev.MediumMotor, port)
             if direction == 'backward':
                 m.polarity = 'inversed'
             else:
                 m.polarity = 'normal'
+            m = MotorHandle(m)
         except (AttributeError, OSError):
             logger.info('no medium motor connected to port [%s]', port)
             logger.exception("HW Config error")
@@ -104,13 +1144,19 @@ class Hal(object):
 
     @staticmethod
     def makeOtherConsumer(port, regulated, direction):
+        def openDcMotor():
+            m = Hal.openDevice(ev3dev.DcMotor, port)
+            # https://github.com/ev3dev/ev3dev-lang-python/issues/234
+            # some time is needed to set the permissions for the new attributes
+            if m.connected and os.access(os.path.join(m._path, 'command'), os.W_OK):
+                return m
+            return None
+
         try:
             lp = ev3dev.LegoPort(port)
             lp.mode = 'dc-motor'
-            # https://github.com/ev3dev/ev3dev-lang-python/issues/234
-            # some time is needed to set the permissions for the new attributes
-            time.sleep(0.5)
-            m = ev3dev.DcMotor(address=port)
+            m = pollUntil(openDcMotor, Hal.PROBE_TIMEOUT) or Hal.openDevice(ev3dev.DcMotor, port)
+            m = MotorHandle(m)
         except (AttributeError, OSError):
             logger.info('no other consumer connected to port [%s]', port)
             logger.exception("HW Config error")
@@ -120,7 +1166,7 @@ class Hal(object):
     @staticmethod
     def makeColorSensor(port):
         try:
-            s = ev3dev.ColorSensor(port)
+            s = Hal.openDevice(ev3dev.ColorSensor, port)
         except (AttributeError, OSError):
             logger.info('no color sensor connected to port [%s]', port)
             s = None
@@ -129,7 +1175,7 @@ class Hal(object):
     @staticmethod
     def makeGyroSensor(port):
         try:
-            s = ev3dev.GyroSensor(port)
+            s = Hal.openDevice(ev3dev.GyroSensor, port)
         except (AttributeError, OSError):
             logger.info('no gyro sensor connected to port [%s]', port)
             s = None
@@ -138,7 +1184,7 @@ class Hal(object):
     @staticmethod
     def makeI2cSensor(port):
         try:
-            s = ev3dev.I2cSensor(port)
+            s = Hal.openDevice(ev3dev.I2cSensor, port)
         except (AttributeError, OSError):
             logger.info('no i2c sensor connected to port [%s]', port)
             s = None
@@ -147,7 +1193,7 @@ class Hal(object):
     @staticmethod
     def makeInfraredSensor(port):
         try:
-            s = ev3dev.InfraredSensor(port)
+            s = Hal.openDevice(ev3dev.InfraredSensor, port)
         except (AttributeError, OSError):
             logger.info('no infrared sensor connected to port [%s]', port)
             s = None
@@ -158,7 +1204,9 @@ class Hal(object):
         try:
             p = ev3dev.LegoPort(port)
             p.set_device = 'lego-nxt-light'
-            s = ev3dev.LightSensor(port)
+            # the sensor device shows up asynchronously
+            s = pollUntil(lambda: Hal._findSensor(ev3dev.LightSensor, port), Hal.PROBE_TIMEOUT)
+            s = s or Hal.openDevice(ev3dev.LightSensor, port)
         except (AttributeError, OSError):
             logger.info('no light sensor connected to port [%s]', port)
             s = None
@@ -169,7 +1217,9 @@ class Hal(object):
         try:
             p = ev3dev.LegoPort(port)
             p.set_device = 'lego-nxt-sound'
-            s = ev3dev.SoundSensor(port)
+            # the sensor device shows up asynchronously
+            s = pollUntil(lambda: Hal._findSensor(ev3dev.SoundSensor, port), Hal.PROBE_TIMEOUT)
+            s = s or Hal.openDevice(ev3dev.SoundSensor, port)
         except (AttributeError, OSError):
             logger.info('no sound sensor connected to port [%s]', port)
             s = None
@@ -178,7 +1228,7 @@ class Hal(object):
     @staticmethod
     def makeTouchSensor(port):
         try:
-            s = ev3dev.TouchSensor(port)
+            s = Hal.openDevice(ev3dev.TouchSensor, port)
         except (AttributeError, OSError):
             logger.info('no touch sensor connected to port [%s]', port)
             s = None
@@ -187,7 +1237,7 @@ class Hal(object):
     @staticmethod
     def makeUltrasonicSensor(port):
         try:
-            s = ev3dev.UltrasonicSensor(port)
+            s = Hal.openDevice(ev3dev.UltrasonicSensor, port)
         except (AttributeError, OSError):
             logger.info('no ultrasonic sensor connected to port [%s]', port)
             s = None
@@ -196,7 +1246,7 @@ class Hal(object):
     @staticmethod
     def makeCompassSensor(port):
         try:
-            s = ev3dev.Sensor(address=port, driver_name='ht-nxt-compass')
+            s = Hal.openDevice(ev3dev.Sensor, port, driver_name='ht-nxt-compass')
         except (AttributeError, OSError):
             logger.info('no compass sensor connected to port [%s]', port)
             s = None
@@ -205,7 +1255,7 @@ class Hal(object):
     @staticmethod
     def makeIRSeekerSensor(port):
         try:
-            s = ev3dev.Sensor(address=port, driver_name='ht-nxt-ir-seek-v2')
+            s = Hal.openDevice(ev3dev.Sensor, port, driver_name='ht-nxt-ir-seek-v2')
         except (AttributeError, OSError):
             logger.info('no ir seeker v2 sensor connected to port [%s]', port)
             s = None
@@ -214,7 +1264,7 @@ class Hal(object):
     @staticmethod
     def makeHTColorSensorV2(port):
         try:
-            s = ev3dev.Sensor(address=port, driver_name='ht-nxt-color-v2')
+            s = Hal.openDevice(ev3dev.Sensor, port, driver_name='ht-nxt-color-v2')
         except (AttributeError, OSError):
             logger.info('no hitechnic color sensor v2 connected to port [%s]', port)
             s = None
@@ -222,10 +1272,31 @@ class Hal(object):
 
     # state
     def resetState(self):
+        # the program might have used another Hal instance
+        self.invalidateWriteCaches()
         self.clearDisplay()
+        self.display.flush()
         self.stopAllMotors()
         self.resetAllOutputs()
         self.resetLED()
+        self.stopSensorSampler()
+        self.stopRecording()
+        self.invalidateSensorModes()
+        # including the ones of the program's Hal, if it ran in this process
+        MotorHandle.closeAllCommandFds()
+        Hal.stopKeyStates()
+        self.key_state = None
+        if self.motor_waiter:
+            self.motor_waiter.close()
+            self.motor_waiter = None
+        if self.process_waiter:
+            self.process_waiter.close()
+            self.process_waiter = None
+        Hal.terminateCommands()
+
+    @staticmethod
+    def terminateCommands():
+        """Stop the commands (sounds, speech) that are still running."""
         logger.debug("terminate %d commands", len(Hal.cmds))
         for cmd in Hal.cmds:
             if cmd:
@@ -242,36 +1313,62 @@ class Hal(object):
         """Used as interruptable busy wait."""
         time.sleep(0.0)
 
+    def waitForMotors(self, motors, done=None, timeout=None):
+        """Wait for the motors to finish (see MotorWaiter.wait())."""
+        if self.motor_waiter is None:
+            self.motor_waiter = MotorWaiter()
+        return self.motor_waiter.wait(motors, done, timeout)
+
     def waitCmd(self, cmd):
         """Wait for a command to finish."""
         Hal.cmds.append(cmd)
         # we're not using cmd.wait() since that is not interruptable
-        while cmd.poll() is None:
-            self.busyWait()
+        if self.process_waiter is None:
+            self.process_waiter = ProcessWaiter()
+        self.process_waiter.wait(cmd)
         Hal.cmds.remove(cmd)
 
     # lcd
+    def getAtlas(self):
+        if self.atlas is None:
+            self.atlas = loadAtlas(self.font_name, Hal.pool)
+        return self.atlas
+
     def drawText(self, msg, x, y, font=None):
-        font = font or self.font_s
-        self.lcd.draw.text((x * self.font_w, y * self.font_h), msg, font=font)
-        self.lcd.update()
+        xy = (x * self.font_w, y * self.font_h)
+        if font in (None, self.font_s) and self.getAtlas().canRender(msg):
+            self.display.glyphs(xy, msg, self.atlas)
+        else:
+            self.display.text(xy, msg, font or self.font_s)
 
     def drawPicture(self, picture, x, y):
         # logger.info('len(picture) = %d', len(picture))
-        size = (178, 128)
         # One image is supposed to be 178*128/8 = 2848 bytes
         # string data is in utf-16 format and padding with extra 0 bytes
         data = bytes(picture, 'utf-16')[::2]
-        pixels = Image.frombytes('1', size, data, 'raw', '1;IR', 0, 1)
-        self.lcd.image.paste(pixels, (x, y))
-        self.lcd.update()
+        self.display.picture(data, (x, y))
 
     def clearDisplay(self):
-        self.lcd.clear()
-        self.lcd.update()
+        self.display.clear()
+
+    def setDisplayMaxFps(self, fps):
+        """Coalesce display updates to at most fps frames per second, None
+        makes every draw visible right away."""
+        self.display.flush()
+        self.display.max_fps = fps
+
+    def flushDisplay(self):
+        self.display.flush()
+
+    def getDisplayStats(self):
+        return self.display.getStats()
 
     # led
 
+    def setLEDs(self, color):
+        for (led, value) in zip(Hal.LED_ALL, color):
+            self.led_cache.write(led, 'brightness_pct', value)
+
     def ledStopAnim(self):
         if Hal.led_blink_running:
             Hal.led_blink_running = False
@@ -282,7 +1379,7 @@ class Hal(object):
         def ledAnim(anim):
             while Hal.led_blink_running:
                 for step in anim:
-                    self.led.set_color(Hal.LED_ALL, step[1])
+                    self.setLEDs(step[1])
                     time.sleep(step[0])
                     if not Hal.led_blink_running:
                         break
@@ -293,7 +1390,7 @@ class Hal(object):
         on = Hal.LED_COLORS[color]
         off = Hal.LED_COLORS['black']
         if mode == 'on':
-            self.led.set_color(Hal.LED_ALL, on)
+            self.setLEDs(on)
         elif mode == 'flash':
             Hal.led_blink_thread = threading.Thread(
                 target=ledAnim, args=([(0.5, on), (0.5, off)],))
@@ -306,29 +1403,61 @@ class Hal(object):
             Hal.led_blink_thread.start()
 
     def ledOff(self):
-        self.led.all_off()
         self.ledStopAnim()
+        self.setLEDs(Hal.LED_COLORS['black'])
 
     def resetLED(self):
         self.ledOff()
 
     # key
+    def getKeyState(self):
+        if self.key_state is None:
+            if Hal.pool:
+                self.key_state = Hal.pool.getKeyState()
+            else:
+                key_state = KeyState()
+                self.key_state = key_state.start() and key_state
+                if self.key_state:
+                    Hal.key_states.add(key_state)
+        return self.key_state
+
+    @staticmethod
+    def stopKeyStates():
+        """Stop the key states that are not shared through the pool."""
+        for key_state in list(Hal.key_states):
+            key_state.stop()
+        Hal.key_states = set()
+
     def isKeyPressed(self, key):
+        # remap some keys
+        key = Hal.KEY_ALIASES.get(key, key)
+        key_state = self.getKeyState()
+        if key_state:
+            return key_state.isPressed(key)
         if key in ['any', '*']:
             return self.keys.any()
         else:
-            # remap some keys
-            key_aliases = {
-                'escape':  'backspace',
-                'back': 'backspace',
-            }
-            if key in key_aliases:
-                key = key_aliases[key]
             return key in self.keys.buttons_pressed
 
     def isKeyPressedAndReleased(self, key):
+        key_state = self.getKeyState()
+        if key_state:
+            return key_state.wasPressedAndReleased(Hal.KEY_ALIASES.get(key, key))
         return False
 
+    def waitForKeyPress(self, key='any', timeout=None):
+        """Sleep until the key is pressed, returns False on timeout."""
+        key = Hal.KEY_ALIASES.get(key, key)
+        key_state = self.getKeyState()
+        if key_state:
+            return key_state.waitForKeyPress(key, timeout)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while not self.isKeyPressed(key):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
     # tones
     def playTone(self, frequency, duration):
         # this is already handled by the sound api (via beep cmd)
@@ -343,11 +1472,11 @@ class Hal(object):
         if systemSound == 0:
             self.playTone(600, 200)
         elif systemSound == 1:
-            self.sound.tone([(600, 150, 50), (600, 150, 50)]).wait()
+            self.waitCmd(self.sound.tone([(600, 150, 50), (600, 150, 50)]))
         elif systemSound == 2:  # C major arpeggio
-            self.sound.tone([(C2 * i / 4, 50, 50) for i in range(4, 7)]).wait()
+            self.waitCmd(self.sound.tone([(C2 * i / 4, 50, 50) for i in range(4, 7)]))
         elif systemSound == 3:
-            self.sound.tone([(C2 * i / 4, 50, 50) for i in range(7, 4, -1)]).wait()
+            self.waitCmd(self.sound.tone([(C2 * i / 4, 50, 50) for i in range(7, 4, -1)]))
         elif systemSound == 4:
             self.playTone(100, 500)
 
@@ -382,13 +1511,11 @@ class Hal(object):
         speed = self.scaleSpeed(m, clamp(speed_pct, -100, 100))
         if mode == 'degree':
             m.run_to_rel_pos(position_sp=value, speed_sp=speed)
-            while m.state and 'stalled' not in m.state:
-                self.busyWait()
+            self.waitForMotors([m], isIdleOrStalled)
         elif mode == 'rotations':
             value *= m.count_per_rot
             m.run_to_rel_pos(position_sp=int(value), speed_sp=speed)
-            while m.state and 'stalled' not in m.state:
-                self.busyWait()
+            self.waitForMotors([m], isIdleOrStalled)
 
     def rotateUnregulatedMotor(self, port, speed_pct, mode, value):
         speed_pct = clamp(speed_pct, -100, 100)
@@ -459,6 +1586,67 @@ class Hal(object):
         for port in (ev3dev.OUTPUT_A, ev3dev.OUTPUT_B, ev3dev.OUTPUT_C, ev3dev.OUTPUT_D):
             lp = ev3dev.LegoPort(port)
             lp.mode = 'auto'
+        # this resets the motors
+        self.invalidateWriteCaches()
+
+    def getWriteCaches(self):
+        caches = [self.led_cache]
+        if self.cfg:
+            caches += [m.cache for m in self.cfg['actors'].values() if isinstance(m, MotorHandle)]
+        return caches
+
+    def invalidateWriteCaches(self):
+        for cache in self.getWriteCaches():
+            cache.invalidate()
+
+    def getSavedWrites(self):
+        """Get the number of attribute writes that were skipped."""
+        return sum([cache.saved for cache in self.getWriteCaches()])
+
+    def startMotors(self, motors, command):
+        """Start the motors together with an ev3dev motor command.
+
+        The setpoints have to be set before. The commands are written back to
+        back to the pre-opened 'command' attributes, motors that are not in
+        sysfs are started through ev3dev. Returns the start skew in seconds.
+        """
+        fds = [m.getCommandFd() if isinstance(m, MotorHandle) else None for m in motors]
+        if None in fds:
+            method = command.replace('-', '_')
+            start = time.perf_counter()
+            for m in motors:
+                getattr(m, method)()
+            end = time.perf_counter()
+        else:
+            data = command.encode()
+            start = time.perf_counter()
+            try:
+                for fd in fds:
+                    os.pwrite(fd, data, 0)
+                end = time.perf_counter()
+            except OSError:
+                for m in motors:
+                    m.closeCommandFd()
+                    m.cache.invalidate()
+                raise
+        # time from the start of the first to the end of the last command
+        skew = end - start
+        stats = self.motor_start_stats
+        stats[0] += 1
+        stats[1] += skew
+        stats[2] = max(stats[2], skew)
+        stats[3] = skew
+        return skew
+
+    def getMotorStartSkew(self):
+        """Get the start skew statistics of startMotors() in seconds."""
+        (count, total, maximum, last) = self.motor_start_stats
+        return {
+            'starts': count,
+            'mean': total / count if count else 0.0,
+            'max': maximum,
+            'last': last,
+        }
 
     def regulatedDrive(self, left_port, right_port, reverse, direction, speed_pct):
         # direction: forward, backward
@@ -468,8 +1656,9 @@ class Hal(object):
         mr = self.cfg['actors'][right_port]
         if direction == 'backward':
             speed_pct = -speed_pct
-        ml.run_forever(speed_sp=self.scaleSpeed(ml, speed_pct))
-        mr.run_forever(speed_sp=self.scaleSpeed(mr, speed_pct))
+        ml.speed_sp = self.scaleSpeed(ml, speed_pct)
+        mr.speed_sp = self.scaleSpeed(mr, speed_pct)
+        self.startMotors([ml, mr], 'run-forever')
 
     def driveDistance(self, left_port, right_port, reverse, direction, speed_pct, distance):
         # direction: forward, backward
@@ -477,8 +1666,7 @@ class Hal(object):
         speed_pct = clamp(speed_pct, -100, 100)
         ml = self.cfg['actors'][left_port]
         mr = self.cfg['actors'][right_port]
-        circ = math.pi * self.cfg['wheel-diameter']
-        dc = distance / circ
+        dc = distance / self.wheel_circumference
         if direction == 'backward':
             dc = -dc
         # set all attributes
@@ -488,12 +1676,9 @@ class Hal(object):
         mr.stop_action = 'brake'
         mr.position_sp = int(dc * mr.count_per_rot)
         mr.speed_sp = self.scaleSpeed(mr, speed_pct)
-        # start motors
-        ml.run_to_rel_pos()
-        mr.run_to_rel_pos()
+        self.startMotors([ml, mr], 'run-to-rel-pos')
         # logger.debug("driving: %s, %s" % (ml.state, mr.state))
-        while ml.state or mr.state:
-            self.busyWait()
+        self.waitForMotors([ml, mr])
 
     def rotateDirectionRegulated(self, left_port, right_port, reverse, direction, speed_pct):
         # direction: left, right
@@ -502,11 +1687,12 @@ class Hal(object):
         ml = self.cfg['actors'][left_port]
         mr = self.cfg['actors'][right_port]
         if direction == 'left':
-            mr.run_forever(speed_sp=self.scaleSpeed(mr, speed_pct))
-            ml.run_forever(speed_sp=self.scaleSpeed(ml, -speed_pct))
+            mr.speed_sp = self.scaleSpeed(mr, speed_pct)
+            ml.speed_sp = self.scaleSpeed(ml, -speed_pct)
         else:
-            ml.run_forever(speed_sp=self.scaleSpeed(ml, speed_pct))
-            mr.run_forever(speed_sp=self.scaleSpeed(mr, -speed_pct))
+            ml.speed_sp = self.scaleSpeed(ml, speed_pct)
+            mr.speed_sp = self.scaleSpeed(mr, -speed_pct)
+        self.startMotors([ml, mr], 'run-forever')
 
     def rotateDirectionAngle(self, left_port, right_port, reverse, direction, speed_pct, angle):
         # direction: left, right
@@ -514,10 +1700,8 @@ class Hal(object):
         speed_pct = clamp(speed_pct, -100, 100)
         ml = self.cfg['actors'][left_port]
         mr = self.cfg['actors'][right_port]
-        circ = math.pi * self.cfg['track-width']
-        distance = angle * circ / 360.0
-        circ = math.pi * self.cfg['wheel-diameter']
-        dc = distance / circ
+        distance = angle * self.track_circumference / 360.0
+        dc = distance / self.wheel_circumference
         logger.debug("doing %lf rotations" % dc)
         # set all attributes
         ml.stop_action = 'brake'
@@ -530,12 +1714,9 @@ class Hal(object):
         else:
             ml.position_sp = int(dc * ml.count_per_rot)
             mr.position_sp = int(-dc * mr.count_per_rot)
-        # start motors
-        ml.run_to_rel_pos()
-        mr.run_to_rel_pos()
+        self.startMotors([ml, mr], 'run-to-rel-pos')
         logger.debug("turning: %s, %s" % (ml.state, mr.state))
-        while ml.state or mr.state:
-            self.busyWait()
+        self.waitForMotors([ml, mr])
 
     def driveInCurve(self, direction, left_port, left_speed_pct, right_port, right_speed_pct, distance=None):
         # direction: foreward, backward
@@ -547,8 +1728,7 @@ class Hal(object):
             left_dc = right_dc = 0.0
             speed_pct = (left_speed_pct + right_speed_pct) / 2.0
             if speed_pct:
-                circ = math.pi * self.cfg['wheel-diameter']
-                dc = distance / circ
+                dc = distance / self.wheel_circumference
                 left_dc = dc * left_speed_pct / speed_pct
                 right_dc = dc * right_speed_pct / speed_pct
             # set all attributes
@@ -562,42 +1742,142 @@ class Hal(object):
             else:
                 ml.position_sp = int(left_dc * ml.count_per_rot)
                 mr.position_sp = int(right_dc * mr.count_per_rot)
-            # start motors
-            ml.run_to_rel_pos()
-            mr.run_to_rel_pos()
-            while (ml.state and left_speed_pct) or (mr.state and right_speed_pct):
-                self.busyWait()
+            self.startMotors([ml, mr], 'run-to-rel-pos')
+            self.waitForMotors([m for (m, speed) in [(ml, left_speed_pct), (mr, right_speed_pct)] if speed])
         else:
             if direction == 'backward':
-                ml.run_forever(speed_sp=int(-left_speed_pct))
-                mr.run_forever(speed_sp=int(-right_speed_pct))
+                ml.speed_sp = int(-left_speed_pct)
+                mr.speed_sp = int(-right_speed_pct)
             else:
-                ml.run_forever(speed_sp=int(left_speed_pct))
-                mr.run_forever(speed_sp=int(right_speed_pct))
+                ml.speed_sp = int(left_speed_pct)
+                mr.speed_sp = int(right_speed_pct)
+            self.startMotors([ml, mr], 'run-forever')
 
     # sensors
+    def getSensor(self, port, mode):
+        """Get the sensor on the port and switch it to the mode.
+
+        The mode is only read from the sensor the first time. Afterwards we
+        trust the mode we've set, until reading a value fails.
+        """
+        s = self.cfg['sensors'][port]
+        current = self.sensor_modes.get(s)
+        if current != mode:
+            with self.sensor_lock:
+                if current is not None or s.mode != mode:
+                    s.mode = mode
+                self.sensor_modes[s] = mode
+        return s
+
+    def invalidateSensorModes(self, sensor=None):
+        """Forget the cached mode(s), e.g. after a sensor got replugged."""
+        with self.sensor_lock:
+            if sensor is None:
+                sensors = list(self.sensor_readers)
+                self.sensor_modes = {}
+            else:
+                sensors = [sensor]
+                self.sensor_modes.pop(sensor, None)
+            for s in sensors:
+                reader = self.sensor_readers.pop(s, None)
+                if reader:
+                    reader.close()
+
+    def readSensor(self, sensor):
+        """Read all scaled values of the sensor."""
+        with self.sensor_lock:
+            if sensor not in self.sensor_readers:
+                path = getattr(sensor, '_path', None)
+                self.sensor_readers[sensor] = SensorReader(path) if path else None
+            reader = self.sensor_readers[sensor]
+            try:
+                if reader:
+                    return reader.read(self.sensor_modes.get(sensor))
+                scale = float(10.0 ** sensor.decimals)
+                return tuple([sensor.value(i) / scale for i in range(sensor.num_values)])
+            except (IOError, OSError, ValueError, struct.error):
+                self.invalidateSensorModes(sensor)
+                raise
+
+    def getSensorValues(self, sensor):
+        """Get all scaled values of the sensor, from the sensor sampler if it
+        has recent values."""
+        sampler = self.sensor_sampler
+        if sampler:
+            values = sampler.getValues(sensor, self.sensor_modes.get(sensor))
+            if values is not None:
+                return values
+        return self.readSensor(sensor)
+
     def scaledValue(self, sensor):
-        return sensor.value() / float(10.0 ** sensor.decimals)
+        return self.getSensorValues(sensor)[0]
 
     def scaledValues(self, sensor):
-        scale = float(10.0 ** sensor.decimals)
-        return tuple([sensor.value(i) / scale for i in range(sensor.num_values)])
+        return self.getSensorValues(sensor)
+
+    def startSensorSampler(self, rate=100, rates=None, max_staleness=None):
+        """Sample the configured sensors in the background.
+
+        All sensors are sampled with rate Hz, rates can override this per port.
+        See SensorSampler.
+        """
+        self.stopSensorSampler()
+        port_rates = {port: rate for (port, s) in self.cfg['sensors'].items() if s}
+        port_rates.update(rates or {})
+        self.sensor_sampler = SensorSampler(self, port_rates, max_staleness)
+        self.sensor_sampler.start()
+        return self.sensor_sampler
+
+    def stopSensorSampler(self):
+        if self.sensor_sampler:
+            self.sensor_sampler.stop()
+            self.sensor_sampler = None
+
+    # recording
+    def startRecording(self, ports, rate=100, size=4096):
+        """Record the first value of sensors and the tacho count of motors.
+
+        rate is the sample rate in Hz, either for all ports or a dict per port.
+        Only the last size samples per port are kept.
+        """
+        self.stopRecording()
+        self.recorder = Recorder()
+        for port in ports:
+            port_rate = rate[port] if isinstance(rate, dict) else rate
+            if port in self.cfg['sensors']:
+                s = self.cfg['sensors'][port]
+                self.recorder.addChannel(port, lambda s=s: self.getSensorValues(s)[0], port_rate, size)
+            elif port in self.cfg['actors']:
+                m = self.cfg['actors'][port]
+                self.recorder.addChannel(port, lambda m=m: m.position, port_rate, size, 'i')
+            else:
+                self.recorder = None
+                raise ValueError('no sensor or motor on port %s' % port)
+        self.recorder.start()
+        return self.recorder
+
+    def stopRecording(self):
+        if self.recorder:
+            self.recorder.stop()
+
+    def saveRecording(self, filename):
+        """Write the recording to filename, see recorder.readLog()."""
+        if not self.recorder:
+            raise ValueError('nothing has been recorded, see startRecording()')
+        self.stopRecording()
+        self.recorder.save(filename)
 
     # touch sensor
     def isPressed(self, port):
-        return self.scaledValue(self.cfg['sensors'][port])
+        return self.scaledValue(self.getSensor(port, 'TOUCH'))
 
     # ultrasonic sensor
     def getUltraSonicSensorDistance(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'US-DIST-CM':
-            s.mode = 'US-DIST-CM'
+        s = self.getSensor(port, 'US-DIST-CM')
         return self.scaledValue(s)
 
     def getUltraSonicSensorPresence(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'US-LISTEN':
-            s.mode = 'US-LISTEN'
+        s = self.getSensor(port, 'US-LISTEN')
         return self.scaledValue(s) != 0.0
 
     # gyro
@@ -605,54 +1885,44 @@ class Hal(object):
     def resetGyroSensor(self, port):
         # change mode to reset for GYRO-ANG and GYRO-G&A
         s = self.cfg['sensors'][port]
-        s.mode = 'GYRO-RATE'
-        s.mode = 'GYRO-ANG'
+        with self.sensor_lock:
+            s.mode = 'GYRO-RATE'
+            s.mode = 'GYRO-ANG'
+            self.sensor_modes[s] = 'GYRO-ANG'
+            if self.sensor_sampler:
+                self.sensor_sampler.discard(s)
 
     def getGyroSensorValue(self, port, mode):
-        s = self.cfg['sensors'][port]
-        if s.mode != Hal.GYRO_MODES[mode]:
-            s.mode = Hal.GYRO_MODES[mode]
+        s = self.getSensor(port, Hal.GYRO_MODES[mode])
         return self.scaledValue(s)
 
     # color
     # http://www.ev3dev.org/docs/sensors/lego-ev3-color-sensor/
     def getColorSensorAmbient(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'COL-AMBIENT':
-            s.mode = 'COL-AMBIENT'
+        s = self.getSensor(port, 'COL-AMBIENT')
         return self.scaledValue(s)
 
     def getColorSensorColour(self, port):
         colors = ['none', 'black', 'blue', 'green', 'yellow', 'red', 'white', 'brown']
-        s = self.cfg['sensors'][port]
-        if s.mode != 'COL-COLOR':
-            s.mode = 'COL-COLOR'
+        s = self.getSensor(port, 'COL-COLOR')
         return colors[int(self.scaledValue(s))]
 
     def getColorSensorRed(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'COL-REFLECT':
-            s.mode = 'COL-REFLECT'
+        s = self.getSensor(port, 'COL-REFLECT')
         return self.scaledValue(s)
 
     def getColorSensorRgb(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'RGB-RAW':
-            s.mode = 'RGB-RAW'
+        s = self.getSensor(port, 'RGB-RAW')
         return self.scaledValues(s)
 
     # infrared
     # http://www.ev3dev.org/docs/sensors/lego-ev3-infrared-sensor/
     def getInfraredSensorSeek(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'IR-SEEK':
-            s.mode = 'IR-SEEK'
+        s = self.getSensor(port, 'IR-SEEK')
         return self.scaledValues(s)
 
     def getInfraredSensorDistance(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'IR-PROX':
-            s.mode = 'IR-PROX'
+        s = self.getSensor(port, 'IR-PROX')
         return self.scaledValue(s)
 
     # timer
@@ -676,13 +1946,13 @@ class Hal(object):
         tacho_count = m.position
 
         if mode == 'degree':
-            return tacho_count * 360.0 / float(m.count_per_rot)
+            return tacho_count * m.degrees_per_count
         elif mode in ['rotation', 'distance']:
             rotations = float(tacho_count) / float(m.count_per_rot)
             if mode == 'rotation':
                 return rotations
             else:
-                distance = round(math.pi * self.cfg['wheel-diameter'] * rotations)
+                distance = round(self.wheel_circumference * rotations)
                 return distance
         else:
             raise ValueError('incorrect MotorTachoMode: %s' % mode)
@@ -690,15 +1960,11 @@ class Hal(object):
     def getSoundLevel(self, port):
         # 100 for silent,
         # 0 for loud
-        s = self.cfg['sensors'][port]
-        if s.mode != 'DB':
-            s.mode = 'DB'
+        s = self.getSensor(port, 'DB')
         return round(-self.scaledValue(s) + 100, 2)  # map to 0 silent 100 loud
 
     def getHiTecCompassSensorValue(self, port, mode):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'COMPASS':
-            s.mode = 'COMPASS'  # ev3dev currently only supports the compass mode
+        s = self.getSensor(port, 'COMPASS')  # ev3dev currently only supports the compass mode
         value = self.scaledValue(s)
         if mode == 'angle':
             return -(((value + 180) % 360) - 180)  # simulate the angle [-180, 180] mode from ev3lejos
@@ -706,18 +1972,14 @@ class Hal(object):
             return value
 
     def getHiTecIRSeekerSensorValue(self, port, mode):
-        s = self.cfg['sensors'][port]
-        if s.mode != mode:
-            s.mode = mode
+        s = self.getSensor(port, mode)
         value = self.scaledValue(s)
         # remap from [1 - 9] default 0 to [120, -120] default NaN like ev3lejos
         return float('nan') if value == 0 else (value - 5) * -30
 
     def getHiTecColorSensorV2Colour(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'COLOR':
-            s.mode = 'COLOR'
-        value = s.value()
+        s = self.getSensor(port, 'COLOR')
+        value = self.scaledValue(s)
         return self.mapHiTecColorIdToColor(int(value))
 
     def mapHiTecColorIdToColor(self, id):
@@ -746,23 +2008,17 @@ class Hal(object):
         return colors[id]
 
     def getHiTecColorSensorV2Ambient(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'PASSIVE':
-            s.mode = 'PASSIVE'
-        value = abs(s.value(0)) / 380
+        s = self.getSensor(port, 'PASSIVE')
+        value = abs(self.scaledValue(s)) / 380
         return min(value, 100)
 
     def getHiTecColorSensorV2Light(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'NORM':
-            s.mode = 'NORM'
+        s = self.getSensor(port, 'NORM')
         value = self.scaledValues(s)[3] / 2.55
         return value
 
     def getHiTecColorSensorV2Rgb(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'NORM':
-            s.mode = 'NORM'
+        s = self.getSensor(port, 'NORM')
         value = self.scaledValues(s)
         value = list(value)
         del value[0]
@@ -0,0 +1,78 @@
+import collections
+
+from PIL import Image, ImageDraw
+
+
+def maskToRows(mask):
+    """Get the rows of a 1 bit image as ints, bit x is set for pixel x."""
+    (w, h) = mask.size
+    stride = (w + 7) // 8
+    data = mask.tobytes('raw', '1;R')
+    return tuple(int.from_bytes(data[y * stride:(y + 1) * stride], 'little') for y in range(h))
+
+
+class GlyphAtlas(object):
+    """Pre-rendered 1 bit glyphs of a fixed width PIL font
+
+    All glyphs of the font (latin-1) are rendered once into cells of the same
+    size. Strings are composed from the cells, either into a mask or into
+    packed rows (see maskToRows()). The last cache_size strings are kept, so
+    that redrawing the same text is a single paste into the screen.
+    """
+
+    def __init__(self, font, cache_size=64):
+        self.font = font
+        masks = [font.getmask(chr(c)) for c in range(256)]
+        self.cell = (max(m.size[0] for m in masks), max(m.size[1] for m in masks))
+        self.glyphs = []
+        for c in range(256):
+            glyph = Image.new('1', self.cell, 0)
+            ImageDraw.Draw(glyph).text((0, 0), chr(c), font=font, fill=1)
+            self.glyphs.append(glyph)
+        self.glyph_rows = [maskToRows(glyph) for glyph in self.glyphs]
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.row_cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def canRender(self, msg):
+        return '\n' not in msg and all(ord(c) < 256 for c in msg)
+
+    def getSize(self, msg):
+        return (self.cell[0] * len(msg), self.cell[1])
+
+    def render(self, msg):
+        """Get the mask for msg (one line of latin-1 text)."""
+        return self._getCached(self.cache, msg, self._renderMask)
+
+    def renderRows(self, msg):
+        """Get the packed rows for msg (one line of latin-1 text)."""
+        return self._getCached(self.row_cache, msg, self._renderRows)
+
+    def _getCached(self, cache, msg, render):
+        value = cache.get(msg)
+        if value is not None:
+            self.hits += 1
+            cache.move_to_end(msg)
+            return value
+        self.misses += 1
+        value = cache[msg] = render(msg)
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return value
+
+    def _renderMask(self, msg):
+        w = self.cell[0]
+        mask = Image.new('1', self.getSize(msg), 0)
+        for (i, c) in enumerate(msg):
+            mask.paste(self.glyphs[ord(c)], (i * w, 0))
+        return mask
+
+    def _renderRows(self, msg):
+        w = self.cell[0]
+        rows = [0] * self.cell[1]
+        for (i, c) in enumerate(msg):
+            for (y, bits) in enumerate(self.glyph_rows[ord(c)]):
+                rows[y] |= bits << (i * w)
+        return tuple(rows)
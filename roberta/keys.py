@@ -0,0 +1,145 @@
+import array
+import collections
+from fcntl import ioctl
+import logging
+import os
+import select
+import struct
+import threading
+
+logger = logging.getLogger('roberta.keys')
+
+
+class KeyState(object):
+    """Button state, tracked from the events of the button input device
+
+    Keeps a snapshot of the pressed buttons and a bounded queue of the press
+    and release edges. Both are updated from a background thread, so that
+    checking a button does not read the device and short presses don't get
+    lost.
+    """
+
+    # from linux/input.h and linux/input-event-codes.h
+    EV_KEY = 1
+    KEYS = {
+        103: 'up',
+        108: 'down',
+        105: 'left',
+        106: 'right',
+        28: 'enter',
+        14: 'backspace',
+    }
+    # struct input_event: struct timeval time, __u16 type, __u16 code, __s32 value
+    INPUT_EVENT = struct.Struct('llHHi')
+    # EVIOCGKEY(len), len = (KEY_MAX + 7) / 8
+    KEY_BUF_LEN = 96
+    EVIOCGKEY = (2 << (14 + 8 + 8) | KEY_BUF_LEN << (8 + 8) | ord('E') << 8 | 0x18)
+
+    BUTTONS_DEVICE = '/dev/input/by-path/platform-gpio_keys-event'
+
+    def __init__(self, device=BUTTONS_DEVICE, max_events=64):
+        # path or file descriptor of the input device
+        self.device = device
+        self.fd = None
+        self.pressed = frozenset()
+        # (name, pressed) tuples
+        self.events = collections.deque(maxlen=max_events)
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Open the device and start tracking, returns False if the device is
+        not available."""
+        if isinstance(self.device, int):
+            self.fd = self.device
+        else:
+            try:
+                self.fd = os.open(self.device, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                logger.debug('no input device %s', self.device)
+                return False
+        buf = array.array('B', [0] * KeyState.KEY_BUF_LEN)
+        try:
+            ioctl(self.fd, KeyState.EVIOCGKEY, buf)
+            self.pressed = frozenset(name for (code, name) in KeyState.KEYS.items()
+                                     if buf[code >> 3] & (1 << (code & 7)))
+        except OSError:
+            pass
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.fd is not None and not isinstance(self.device, int):
+            os.close(self.fd)
+        self.fd = None
+
+    def _run(self):
+        data = b''
+        while self.running:
+            # wake up once in a while to check if we're still running
+            (readable, _, _) = select.select([self.fd], [], [], 0.5)
+            if not readable:
+                continue
+            try:
+                chunk = os.read(self.fd, KeyState.INPUT_EVENT.size * 16)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                logger.warning('input device closed')
+                with self.cond:
+                    self.running = False
+                    self.cond.notify_all()
+                break
+            data += chunk
+            end = len(data) - len(data) % KeyState.INPUT_EVENT.size
+            with self.cond:
+                pressed = set(self.pressed)
+                for (sec, usec, ev_type, code, value) in KeyState.INPUT_EVENT.iter_unpack(data[:end]):
+                    name = KeyState.KEYS.get(code)
+                    if ev_type != KeyState.EV_KEY or not name or value == 2:  # 2 = autorepeat
+                        continue
+                    if value:
+                        pressed.add(name)
+                    else:
+                        pressed.discard(name)
+                    self.events.append((name, bool(value)))
+                self.pressed = frozenset(pressed)
+                self.cond.notify_all()
+            data = data[end:]
+
+    def isPressed(self, key):
+        if key in ['any', '*']:
+            return bool(self.pressed)
+        return key in self.pressed
+
+    def wasPressedAndReleased(self, key):
+        """Check if the key has been pressed and released since the last
+        check, this consumes the events."""
+        any_key = key in ['any', '*']
+        with self.cond:
+            # name -> index of the press
+            presses = {}
+            for (ix, (name, pressed)) in enumerate(self.events):
+                if not any_key and name != key:
+                    continue
+                if pressed:
+                    presses[name] = ix
+                elif name in presses:
+                    # only drop this press and release, keep the other keys' edges
+                    del self.events[ix]
+                    del self.events[presses[name]]
+                    return True
+        return False
+
+    def waitForKeyPress(self, key, timeout=None):
+        """Sleep until the key is pressed, returns False on timeout."""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.isPressed(key), timeout)
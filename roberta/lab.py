@@ -1,31 +1,33 @@
 from .__version__ import version
+from .keys import KeyState
+from .timeline import timeline
 import ctypes
 import dbus
 import dbus.service
 from fcntl import ioctl
+import filecmp
+import hashlib
+import importlib.util
 import json
 import logging
+import marshal
 import os
+import resource
+import signal
+import shutil
 import socket
 import stat
 import struct
 import time
 import _thread
 import threading
-import urllib.request
 import urllib.error
 import urllib.parse
 import sys
 
 local_pkg_path = os.path.expanduser('~/.local/lib/python')
-# ignore failure to make this testable outside of the target platform
-try:
-    from ev3dev import auto as ev3dev
-    from .ev3 import Hal
-except ImportError:
-    from .test import Ev3dev as ev3dev
-    from .test import Hal
-
+local_state_path = os.path.expanduser('~/.local/share/openrobertalab')
+local_cache_path = os.path.expanduser('~/.cache/openrobertalab')
 logger = logging.getLogger('roberta.lab')
 
 # configuration
@@ -36,6 +38,15 @@ logger = logging.getLogger('roberta.lab')
 TOKEN_PER_SESSION = True
 
 
+# hotfixes for the downloaded programs, needed until server update
+HOTFIXES = [
+    # the server generated code is python2 still
+    (b'from __future__ import absolute_import\n', b''),
+    (b'in xrange(', b'in range('),
+    (b'#!/usr/bin/python\n', b'#!/usr/bin/python3\n'),
+]
+
+
 # helpers
 def getHwAddr(ifname):
     # SIOCGIFHWADDR = 0x8927
@@ -44,6 +55,24 @@ def getHwAddr(ifname):
     return ':'.join(['%02x' % char for char in info[18:24]])
 
 
+def findHwAddr(sys_class_net='/sys/class/net'):
+    """Get the mac address of the first wlan, usb or eth interface."""
+    try:
+        ifnames = os.listdir(sys_class_net)
+    except OSError:
+        return None
+    for iface in ['wlan', 'usb', 'eth']:
+        for ifname in sorted(i for i in ifnames if i.startswith(iface)):
+            try:
+                with open(os.path.join(sys_class_net, ifname, 'address'), 'r') as f:
+                    addr = f.read().strip()
+            except IOError:
+                continue
+            if addr and addr != '00:00:00:00:00:00':
+                return addr
+    return None
+
+
 def generateToken():
     # note: we intentionally leave '01' and 'IO' out since they can be confused
     # when entering the code
@@ -53,10 +82,395 @@ def generateToken():
     return ''.join(chars[b[i] % len(chars)] for i in range(8))
 
 
+hardware_modules = None
+
+
+def getHardwareModules():
+    """Get the ev3dev module and the Hal class.
+
+    They are slow to import, hence we do this on first use.
+    """
+    global hardware_modules
+    if not hardware_modules:
+        with timeline.phase('import roberta.ev3'):
+            # ignore failure to make this testable outside of the target platform
+            try:
+                from ev3dev import auto as ev3dev
+                from .ev3 import Hal
+            except ImportError:
+                from .test import Ev3dev as ev3dev
+                from .test import Hal
+        hardware_modules = (ev3dev, Hal)
+    return hardware_modules
+
+
 def getBatteryVoltage():
+    (ev3dev, Hal) = getHardwareModules()
     return "{0:.3f}".format(ev3dev.PowerSupply().measured_volts)
 
 
+class CachedValue(object):
+    """Calls func() at most once per ttl seconds and caches the result."""
+
+    def __init__(self, func, ttl, clock=time.monotonic):
+        self.func = func
+        self.ttl = ttl
+        self.clock = clock
+        self.value = None
+        self.expires = None
+
+    def get(self):
+        now = self.clock()
+        if self.expires is None or now >= self.expires:
+            self.value = self.func()
+            self.expires = now + self.ttl
+        return self.value
+
+
+class Payload(object):
+    """Json body for the requests to the server
+
+    The static fields (firmware version, mac address, ...) are encoded once,
+    for each request only the few volatile fields are encoded and spliced in.
+    """
+
+    VOLATILE = ('cmd', 'token', 'nepoexitvalue', 'brickname', 'battery')
+
+    def __init__(self, params):
+        self.params = params
+        self.static = None
+        self.static_params = None
+
+    def encode(self):
+        static = dict((k, v) for (k, v) in self.params.items() if k not in Payload.VOLATILE)
+        if static != self.static_params:
+            self.static = json.dumps(static)[1:-1].encode('utf8')
+            self.static_params = static
+        volatile = dict((k, self.params[k]) for k in Payload.VOLATILE if k in self.params)
+        volatile = json.dumps(volatile)[1:-1].encode('utf8')
+        if volatile and self.static:
+            return b'{' + volatile + b', ' + self.static + b'}'
+        return b'{' + volatile + self.static + b'}'
+
+
+def randomFraction():
+    # note: we don't use the random module since it is large
+    return int.from_bytes(os.urandom(2), 'big') / 65535.0
+
+
+class Backoff(object):
+    """Capped exponential backoff with jitter for the connection retries
+
+    Each error class has its own initial and maximum delay and attempt counter.
+    The delay for the n-th failure is a random value between half and the full
+    value of min(max, initial * 2^n).
+    """
+
+    DELAYS = {
+        # error class: (initial delay, max delay) in seconds
+        'dns': (2.0, 60.0),
+        'refused': (1.0, 30.0),
+        'server': (1.0, 60.0),
+        'timeout': (0.5, 15.0),
+        'network': (1.0, 30.0),
+    }
+
+    def __init__(self, clock=time.monotonic, sleep=time.sleep, random=randomFraction):
+        self.clock = clock
+        self.sleep = sleep
+        self.random = random
+        self.attempts = {}
+        self.delay = 0.0
+        self.deadline = 0.0
+
+    @staticmethod
+    def classify(e):
+        """Map an exception to an error class."""
+        if isinstance(e, urllib.error.HTTPError):
+            return 'server'
+        if isinstance(e, urllib.error.URLError) and isinstance(e.reason, Exception):
+            e = e.reason
+        if isinstance(e, socket.timeout):
+            return 'timeout'
+        if isinstance(e, (socket.gaierror, socket.herror)):
+            return 'dns'
+        if isinstance(e, ConnectionRefusedError):
+            return 'refused'
+        return 'network'
+
+    def failure(self, error_class):
+        """Register a failure and return the delay until the next attempt."""
+        (initial, maximum) = Backoff.DELAYS[error_class]
+        attempt = self.attempts.get(error_class, 0)
+        self.attempts[error_class] = attempt + 1
+        delay = min(maximum, initial * (2 ** attempt))
+        self.delay = delay * (0.5 + 0.5 * self.random())
+        self.deadline = self.clock() + self.delay
+        return self.delay
+
+    def reset(self):
+        self.attempts = {}
+        self.delay = 0.0
+        self.deadline = 0.0
+
+    def wait(self, is_running=lambda: True):
+        """Sleep until the next attempt is due or is_running() returns False."""
+        while is_running():
+            remaining = self.deadline - self.clock()
+            if remaining <= 0:
+                break
+            self.sleep(min(remaining, 0.5))
+
+
+class NegotiationCache(object):
+    """Remembers the protocol and path prefix that worked for a server
+
+    The entries are persisted, so that we don't need to probe the server again
+    after a restart.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = None
+
+    def _load(self):
+        self.entries = {}
+        try:
+            with open(self.filename, 'r') as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_filename, self.filename)
+        except IOError:
+            logger.warning('failed to store %s', self.filename)
+
+    def get(self, address):
+        if self.entries is None:
+            self._load()
+        entry = self.entries.get(address)
+        if entry:
+            return (entry['protocol'], entry['prefix'])
+        return None
+
+    def set(self, address, protocol, prefix):
+        if self.get(address) != (protocol, prefix):
+            logger.info('using %s://%s/%s', protocol, address, prefix)
+            self.entries[address] = {'protocol': protocol, 'prefix': prefix}
+            self._save()
+
+    def invalidate(self, address):
+        if self.get(address):
+            del self.entries[address]
+            self._save()
+
+
+negotiation_cache = NegotiationCache(os.path.join(local_state_path, 'servers.json'))
+
+
+class CodeCache(object):
+    """Content addressed cache of compiled programs
+
+    The code objects are stored with marshal, keyed by a hash of the source,
+    the filename and the python bytecode version. When there are more than
+    max_entries files, the least recently used ones are removed.
+    """
+
+    def __init__(self, dirname, max_entries=32):
+        self.dirname = dirname
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.0
+
+    def _path(self, code, filename):
+        if isinstance(code, str):
+            code = code.encode('utf-8')
+        key = hashlib.sha256(importlib.util.MAGIC_NUMBER)
+        key.update(filename.encode('utf-8') + b'\0')
+        key.update(code)
+        return os.path.join(self.dirname, key.hexdigest())
+
+    def _load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                (compile_time,) = struct.unpack('<d', f.read(8))
+                compiled_code = marshal.load(f)
+            # mark as recently used
+            os.utime(path)
+            return (compiled_code, compile_time)
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, ValueError, TypeError, struct.error):
+            logger.warning('dropping broken cache entry: %s', path)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        return (None, 0.0)
+
+    def _store(self, path, compiled_code, compile_time):
+        try:
+            os.makedirs(self.dirname, exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(struct.pack('<d', compile_time))
+                marshal.dump(compiled_code, f)
+            os.replace(path + '.tmp', path)
+            entries = [os.path.join(self.dirname, e) for e in os.listdir(self.dirname)]
+            if len(entries) > self.max_entries:
+                entries.sort(key=os.path.getmtime)
+                for entry in entries[:-self.max_entries]:
+                    os.unlink(entry)
+        except OSError:
+            logger.warning('failed to store cache entry: %s', path)
+
+    def compile(self, code, filename):
+        """Like compile(code, filename, 'exec'), but returns a cached code
+        object if we compiled the same code before."""
+        path = self._path(code, filename)
+        (compiled_code, compile_time) = self._load(path)
+        if compiled_code:
+            self.hits += 1
+            self.time_saved += compile_time
+            logger.info('code cache hit (hits: %d, misses: %d, saved: %.3f s)',
+                        self.hits, self.misses, self.time_saved)
+            return compiled_code
+        started = time.monotonic()
+        compiled_code = compile(code, filename, 'exec')
+        compile_time = time.monotonic() - started
+        self.misses += 1
+        logger.info('code cache miss (hits: %d, misses: %d, compiled in %.3f s)',
+                    self.hits, self.misses, compile_time)
+        self._store(path, compiled_code, compile_time)
+        return compiled_code
+
+
+code_cache = CodeCache(os.path.join(local_cache_path, 'code'))
+
+
+class ProgramCache(object):
+    """Recently run programs, indexed by digest and filename
+
+    The entries are copies of the stored programs, so that we can restore a
+    program without downloading it again (and without writing it, if it is
+    unchanged). They are not hardlinks, since editing the program in place
+    would change the cached copy as well. The digest of the downloaded content
+    is used as the etag.
+    """
+
+    def __init__(self, dirname, max_entries=8):
+        self.dirname = dirname
+        self.max_entries = max_entries
+        self.index_filename = os.path.join(dirname, 'index.json')
+        # list of [digest, filename], most recently used first
+        self.entries = None
+
+    def _load(self):
+        self.entries = []
+        try:
+            with open(self.index_filename, 'r') as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def _save(self):
+        try:
+            os.makedirs(self.dirname, exist_ok=True)
+            with open(self.index_filename + '.tmp', 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(self.index_filename + '.tmp', self.index_filename)
+        except IOError:
+            logger.warning('failed to store %s', self.index_filename)
+
+    def _copy(self, src, dst):
+        tmp = dst + '.tmp'
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+
+    def _touch(self, digest, filename):
+        self.entries = [e for e in self.entries if e[0] != digest]
+        self.entries.insert(0, [digest, filename])
+        for (old_digest, old_filename) in self.entries[self.max_entries:]:
+            try:
+                os.unlink(os.path.join(self.dirname, old_digest))
+            except OSError:
+                pass
+        del self.entries[self.max_entries:]
+        self._save()
+
+    def etags(self):
+        if self.entries is None:
+            self._load()
+        return ['"%s"' % digest for (digest, filename) in self.entries]
+
+    def lookup(self, digest):
+        """Get the filename of the program with the given digest."""
+        if self.entries is None:
+            self._load()
+        for (entry_digest, filename) in self.entries:
+            if entry_digest == digest and os.path.exists(os.path.join(self.dirname, digest)):
+                return filename
+        return None
+
+    def install(self, filename, digest):
+        """Make filename the program with the given digest, without writing it
+        if possible.
+
+        Returns False if the program is not cached.
+        """
+        if not self.lookup(digest):
+            return False
+        path = os.path.join(self.dirname, digest)
+        try:
+            if not os.path.exists(filename):
+                self._copy(path, filename)
+            elif os.path.samefile(path, filename):
+                # hardlinked by an older version, edits would have changed both
+                logger.info('not trusting cached program: %s', filename)
+                os.unlink(path)
+                return False
+            elif not filecmp.cmp(path, filename, shallow=False):
+                self._copy(path, filename)
+            else:
+                logger.debug('program unchanged: %s', filename)
+        except OSError:
+            logger.warning('failed to restore program: %s', filename)
+            return False
+        self._touch(digest, filename)
+        return True
+
+    def add(self, filename, digest):
+        try:
+            os.makedirs(self.dirname, exist_ok=True)
+            self._copy(filename, os.path.join(self.dirname, digest))
+        except OSError:
+            logger.warning('failed to cache program: %s', filename)
+            return
+        if self.entries is None:
+            self._load()
+        self._touch(digest, filename)
+
+    def clear(self):
+        if self.entries is None:
+            self._load()
+        for (digest, filename) in self.entries:
+            try:
+                os.unlink(os.path.join(self.dirname, digest))
+            except OSError:
+                pass
+        self.entries = []
+        self._save()
+
+
+program_cache = ProgramCache(os.path.join(local_cache_path, 'programs'))
+
+
 class Service(dbus.service.Object):
     """OpenRobertab-Lab dbus service
 
@@ -75,7 +489,7 @@ class Service(dbus.service.Object):
 
     """
 
-    def __init__(self, path):
+    def __init__(self, path, zygote=None):
         logger.info('version: %s', version)
         logger.info('python path: %s', (':'.join(sys.path)))
         # passing None for path is only for testing
@@ -84,30 +498,40 @@ class Service(dbus.service.Object):
             bus_name = dbus.service.BusName('org.openroberta.lab', bus=dbus.SystemBus())
             dbus.service.Object.__init__(self, bus_name, path)
             logger.debug('object registered')
+            timeline.mark('dbus object registered')
             self.status('disconnected')
-        self.hal = Hal(None)
-        self.hal.clearDisplay()
+        # the Hal is created on first use
+        self._hal = None
+        self.hal_lock = threading.Lock()
         self.thread = None
+        self.zygote = zygote
         self.params = {
             'macaddr': '00:00:00:00:00:00',
             'firmwarename': 'ev3dev',
             'menuversion': version.split('-')[0],
         }
-        self.updateConfiguration()
+        with timeline.phase('init configuration'):
+            self.updateConfiguration()
+
+    @property
+    def hal(self):
+        with self.hal_lock:
+            if not self._hal:
+                (ev3dev, Hal) = getHardwareModules()
+                with timeline.phase('init hal'):
+                    self._hal = Hal(None)
+                    self._hal.clearDisplay()
+        return self._hal
+
+    def isHalLoaded(self):
+        return self._hal is not None
 
     def updateConfiguration(self):
         # or /etc/os-release
         with open('/proc/version', 'r') as ver:
             self.params['firmwareversion'] = ver.read()
 
-        for iface in ['wlan', 'usb', 'eth']:
-            for ix in range(10):
-                try:
-                    ifname = bytes(iface + str(ix), 'ascii')
-                    self.params['macaddr'] = getHwAddr(ifname)
-                    break
-                except IOError:
-                    pass
+        self.params['macaddr'] = findHwAddr() or self.params['macaddr']
         # reusing token is nice for developers, but the server started to reject
         # them
         if not TOKEN_PER_SESSION:
@@ -172,15 +596,71 @@ class GfxMode(object):
 class AbortHandler(threading.Thread):
     """ Key press handler to abort running programms.
         Tests for a center+down press to soft-kill the programm or a 1 sec back
-        key press and terminate the whole process"""
+        key press and terminate the whole process. If the programm runs in a
+        child process (pid is set), only the child gets terminated.
+
+        The handler waits for the events of the button input device and only
+        falls back to polling the keys, if the device is not available."""
 
-    def __init__(self, service, runner):
+    def __init__(self, service, runner, device=KeyState.BUTTONS_DEVICE):
         threading.Thread.__init__(self)
         self.service = service
         self.running = True
         self.runner = runner
+        self.pid = None
+        # path or file descriptor of the input device
+        self.device = device
 
-    def run(self):
+    def _hardAbort(self):
+        logger.info('--- hard abort ---')
+        self.running = False
+        if self.pid:
+            try:
+                # the program's process group, including the sounds it started
+                os.killpg(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                os.kill(self.pid, signal.SIGKILL)
+            return
+        _thread.interrupt_main()  # throws KeyboardInterrupt
+        # something is eating the KeyboardInterrupt, this is a bit
+        # brute force, but works
+        _exit(1)
+
+    def _softAbort(self):
+        logger.debug('--- soft-abort ---')
+        self.running = False
+        if self.pid:
+            os.kill(self.pid, signal.SIGTERM)
+        else:
+            self.ctype_async_raise(SystemExit)
+
+    def _waitForKeys(self, key_state):
+        back_pressed = time.monotonic() if key_state.isPressed('backspace') else None
+        abort = None
+        with key_state.cond:
+            while self.running and key_state.running and not abort:
+                # we own this KeyState, hence we can consume all of its events
+                while key_state.events:
+                    (name, pressed) = key_state.events.popleft()
+                    if name == 'backspace':
+                        back_pressed = time.monotonic() if pressed else None
+                if back_pressed is not None:
+                    # if pressed for one sec, hard exit
+                    timeout = back_pressed + 1.0 - time.monotonic()
+                    if timeout <= 0:
+                        abort = self._hardAbort
+                        continue
+                elif key_state.isPressed('enter') and key_state.isPressed('down'):
+                    abort = self._softAbort
+                    continue
+                else:
+                    # wake up once in a while to check if we're still running
+                    timeout = 0.5
+                key_state.cond.wait(timeout)
+        if abort and self.running:
+            abort()
+
+    def _pollKeys(self):
         long_press = 0
         hal = self.service.hal
         while self.running:
@@ -188,22 +668,26 @@ class AbortHandler(threading.Thread):
                 logger.debug('back: %d', long_press)
                 # if pressed for one sec, hard exit
                 if long_press > 10:
-                    logger.info('--- hard abort ---')
-                    _thread.interrupt_main()  # throws KeyboardInterrupt
-                    self.running = False
-                    # something is eating the KeyboardInterrupt, this is a bit
-                    # brute force, but works
-                    os._exit(1)
+                    self._hardAbort()
                 else:
                     long_press += 1
             elif hal.isKeyPressed('enter') and hal.isKeyPressed('down'):
-                logger.debug('--- soft-abort ---')
-                self.running = False
-                self.ctype_async_raise(SystemExit)
+                self._softAbort()
             else:
                 long_press = 0
             time.sleep(0.1)
 
+    def run(self):
+        key_state = KeyState(self.device)
+        if not key_state.start():
+            logger.debug('no input device %s, polling keys', self.device)
+            self._pollKeys()
+            return
+        try:
+            self._waitForKeys(key_state)
+        finally:
+            key_state.stop()
+
     def __enter__(self):
         self.start()
 
@@ -241,6 +725,177 @@ class AbortHandler(threading.Thread):
         logger.debug("Successfully set asynchronized exception for %d", target_tid)
 
 
+def runProgram(compiled_code):
+    scope = {
+        '__name__': '__main__',
+        'result': 0,
+    }
+    exec(compiled_code, scope)
+    return scope['result']
+
+
+def _exit(status):
+    """os._exit(), but without losing the buffered output of the program."""
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (AttributeError, OSError, ValueError):
+            pass
+    os._exit(status)
+
+
+def _send(sock, obj):
+    data = marshal.dumps(obj)
+    sock.sendall(struct.pack('<I', len(data)) + data)
+
+
+def _recv(f):
+    header = f.read(4)
+    if len(header) < 4:
+        raise EOFError()
+    (size,) = struct.unpack('<I', header)
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError()
+    return marshal.loads(data)
+
+
+class Zygote(object):
+    """Fork server to run programms in a separate process
+
+    The zygote has to be started before any threads are created. It imports
+    the modules used by the programms once and then forks a warm child process
+    for each programm. This keeps the startup fast, while an abort only
+    terminates the child.
+    """
+
+    PRELOAD = [
+        'ev3dev.auto',
+        'PIL.Image',
+        'PIL.ImageFont',
+        'roberta.ev3',
+        'roberta.BlocklyMethods',
+    ]
+
+    def __init__(self):
+        self.pid = None
+        self.sock = None
+        self.rfile = None
+
+    def start(self):
+        (sock, child_sock) = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            sock.close()
+            try:
+                self._serve(child_sock)
+            except:  # noqa: E722
+                logger.exception("Ooops:")
+            _exit(0)
+        child_sock.close()
+        self.pid = pid
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+        logger.info('zygote started: %d', pid)
+
+    def stop(self):
+        if self.pid:
+            self.rfile.close()
+            self.sock.close()
+            os.waitpid(self.pid, 0)
+            self.pid = None
+
+    def is_alive(self):
+        if not self.pid:
+            return False
+        try:
+            (pid, status) = os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            pid = self.pid
+        if pid:
+            logger.warning('zygote died')
+            self.pid = None
+        return bool(self.pid)
+
+    def _serve(self, sock):
+        for module in Zygote.PRELOAD:
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                logger.debug('failed to preload %s', module)
+        # the forked programs inherit the font, screen and buttons
+        try:
+            (ev3dev, Hal) = getHardwareModules()
+            pool = Hal.enablePool()
+            if pool:
+                pool.warm()
+        except (AttributeError, OSError):
+            logger.exception('failed to warm up the hal pool')
+        rfile = sock.makefile('rb')
+        while True:
+            try:
+                compiled_code = _recv(rfile)
+            except EOFError:
+                break
+            (r, w) = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                # a hard abort kills the whole group, see AbortHandler._hardAbort()
+                os.setpgid(0, 0)
+                os.close(r)
+                rfile.close()
+                sock.close()
+                result = self._run(compiled_code)
+                try:
+                    os.write(w, marshal.dumps(result))
+                except ValueError:
+                    os.write(w, marshal.dumps(1))
+                _exit(0)
+            os.close(w)
+            try:
+                # set it on both sides, the group has to exist before the daemon gets the pid
+                os.setpgid(pid, pid)
+            except OSError:
+                pass
+            _send(sock, pid)
+            (pid, status) = os.waitpid(pid, 0)
+            with os.fdopen(r, 'rb') as f:
+                data = f.read()
+            if data:
+                result = marshal.loads(data)
+            elif os.WIFSIGNALED(status):
+                result = 128 + os.WTERMSIG(status)
+            else:
+                result = 1
+            _send(sock, result)
+
+    def _run(self, compiled_code):
+        def terminate(signum, frame):
+            raise SystemExit()
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            return runProgram(compiled_code)
+        except SystemExit:
+            logger.info("soft kill")
+            return 143
+        except:  # noqa: E722
+            logger.exception("Ooops:")
+            return 1
+        finally:
+            # the daemon's resetState() can't reach the commands of this process
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            (ev3dev, Hal) = getHardwareModules()
+            Hal.terminateCommands()
+
+    def run(self, compiled_code, abort_handler):
+        """Run the code in a child process and return the result."""
+        _send(self.sock, compiled_code)
+        abort_handler.pid = _recv(self.rfile)
+        logger.debug('running programm in process: %d', abort_handler.pid)
+        with abort_handler:
+            return _recv(self.rfile)
+
+
 class Connector(threading.Thread):
     """OpenRobertab-Lab network IO thread"""
 
@@ -256,44 +911,126 @@ class Connector(threading.Thread):
         if TOKEN_PER_SESSION:
             self.params['token'] = generateToken()
 
+        # import this here, it is slow to load and not needed before connecting
+        from .connection import HttpConnectionPool
+        self.http = HttpConnectionPool()
+        self.negotiation = negotiation_cache
+        self.code_cache = code_cache
+        self.programs = program_cache
+        self.backoff = Backoff()
+        self.payload = Payload(self.params)
+        self.brickname = CachedValue(socket.gethostname, 60.0)
+        self.battery = CachedValue(getBatteryVoltage, 10.0)
         self.registered = False
         self.running = True   # Used to cancel this through self.thread.running
         logger.debug('thread created')
 
-    def _store_code(self, filename, code):
+    def _store_code(self, filename, stream, chunk_size=4096):
+        """Read the program from stream, apply the hotfixes on the way and
+        store it as filename.
+
+        The program is streamed into a temporary file, which is dropped if
+        the program cache has the same download already, so that an unchanged
+        program is not rewritten.
+
+        Returns a tuple of the patched source (bytes) and the hexdigest of the
+        downloaded content.
+        """
         # TODO: what can we do if the file can't be overwritten
         # https://github.com/OpenRoberta/robertalab-ev3dev/issues/26
         # - there is no point in catching if we only log it
         # - once we can report error details to the server, we can reconsider
         #   https://github.com/OpenRoberta/robertalab-ev3dev/issues/20
-        with open(filename, 'w') as prog:
-            # Apply hotfixes needed until server update
-            # - the server generated code is python2 still
-            code = code.replace('from __future__ import absolute_import\n', '')
-            code = code.replace('in xrange(', 'in range(')
-            code = code.replace('#!/usr/bin/python\n', '#!/usr/bin/python3\n')
-            prog.write(code)
-        os.chmod(filename, stat.S_IXUSR | stat.S_IRUSR | stat.S_IWUSR)
-        return code
-
-    def _exec_code(self, filename, code, abort_handler):
+        digest = hashlib.sha256()
+        chunks = []
+        tail = b''
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as prog:
+            while True:
+                data = stream.read(chunk_size)
+                if data:
+                    digest.update(data)
+                    data = tail + data
+                    # only patch complete lines, none of the hotfixes spans lines
+                    end = data.rfind(b'\n') + 1
+                    (data, tail) = (data[:end], data[end:])
+                else:
+                    (data, tail) = (tail, b'')
+                if data:
+                    for (old, new) in HOTFIXES:
+                        data = data.replace(old, new)
+                    prog.write(data)
+                    chunks.append(data)
+                elif not tail:
+                    break
+        digest = digest.hexdigest()
+        if self.programs.install(filename, digest):
+            os.unlink(tmp_filename)
+        else:
+            os.chmod(tmp_filename, stat.S_IXUSR | stat.S_IRUSR | stat.S_IWUSR)
+            os.replace(tmp_filename, filename)
+            self.programs.add(filename, digest)
+        return (b''.join(chunks), digest)
+
+    def _download(self, headers, timeout):
+        """Download the program unless the server tells us that we have a copy
+        already.
+
+        Returns a tuple of the filename and the patched source.
+        """
+        etags = self.programs.etags()
+        request_headers = headers
+        if etags:
+            request_headers = dict(headers)
+            request_headers['If-None-Match'] = ', '.join(etags)
+        response = self._request('download', request_headers, timeout)
+        if response.status == 304:
+            response.read()
+            digest = response.getheader('ETag', '')
+            if digest.startswith('W/'):
+                digest = digest[2:]
+            digest = digest.strip('"')
+            filename = self.programs.lookup(digest)
+            if filename and self.programs.install(filename, digest):
+                logger.info('code not modified: %s (sha256: %s)', filename, digest)
+                with open(filename, 'rb') as prog:
+                    return (filename, prog.read())
+            logger.warning('code not modified, but not cached: %s', digest)
+            self.programs.clear()
+            return self._download(headers, timeout)
+        hdr = response.getheader('Content-Disposition')
+        # save to $HOME/
+        filename = os.path.join(self.home, hdr.split('=')[1] if hdr else 'unknown')
+        (code, digest) = self._store_code(filename, response)
+        logger.info('code downloaded to: %s (%d bytes, sha256: %s)', filename, len(code), digest)
+        return (filename, code)
+
+    def _exec_code(self, filename, code, abort_handler, started=None):
         result = 0
         # using a new process would be using this, but is slower (4s vs <1s):
         # result = subprocess.call(["python", filename], env={"PYTHONPATH":"$PYTONPATH:."})
         # logger.info('execution result: %d' % result)
+        # hence if we have a zygote, we let it fork a warm process for us.
         #
         # NOTE: we don't have to keep pinging the server while running
         #   the code - robot is busy until we send push request again
         #   it would be nice though if we could cancel the running program
         try:
-            compiled_code = compile(code, filename, 'exec')
-            with abort_handler:
-                scope = {
-                    '__name__': '__main__',
-                    'result': 0,
-                }
-                exec(compiled_code, scope)
-                result = scope['result']
+            compiled_code = self.code_cache.compile(code, filename)
+            if started:
+                logger.info('time to exec: %.3f s, max rss: %d kB',
+                            time.monotonic() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+            zygote = self.service.zygote if self.service else None
+            if zygote and zygote.is_alive():
+                result = zygote.run(compiled_code, abort_handler)
+            else:
+                # programs running in this process reuse the warm resources
+                (ev3dev, Hal) = getHardwareModules()
+                pool = Hal.enablePool()
+                with abort_handler:
+                    result = runProgram(compiled_code)
+                if pool:
+                    logger.debug('hal pool: %d hits, %d misses', pool.hits, pool.misses)
             logger.info('execution finished: result = %d', result)
         except KeyboardInterrupt:
             logger.info("reraise hard kill")
@@ -309,43 +1046,52 @@ class Connector(threading.Thread):
         return result
 
     def _request(self, cmd, headers, timeout, send_params=True):
-        protocol = 'https'
-        url = '%s://%s/%s' % (protocol, self.address, cmd)
+        negotiated = self.negotiation.get(self.address)
+        if negotiated:
+            (protocol, prefix) = negotiated
+        else:
+            (protocol, prefix) = ('https', '')
         while True:
+            url = '%s://%s/%s%s' % (protocol, self.address, prefix, cmd)
             try:
                 logger.debug('sending request to: %s', url)
-                req = urllib.request.Request(url, headers=headers)
                 data = None
                 if send_params:
-                    data = json.dumps(self.params).encode('utf8')
+                    data = self.payload.encode()
                     logger.debug('  with params: %s', data)
-                return urllib.request.urlopen(req, data, timeout=timeout)
+                response = self.http.request(url, data, headers, timeout)
+                self.negotiation.set(self.address, protocol, prefix)
+                return response
             except urllib.error.HTTPError as e:
-                if e.code == 404 and '/rest/' not in url:
+                self.negotiation.invalidate(self.address)
+                if negotiated and e.code in [404, 405]:
+                    logger.warning("HTTPError(%s): %s, negotiating again", e.code, e.reason)
+                    # the server setup has changed since we've been here
+                    negotiated = None
+                    (protocol, prefix) = ('https', '')
+                elif e.code == 404 and not prefix:
                     logger.warning("HTTPError(%s): %s, retrying with '/rest'", e.code, e.reason)
                     # upstream changed the server path
-                    url = '%s://%s/rest/%s' % (protocol, self.address, cmd)
+                    prefix = 'rest/'
                 elif e.code == 405 and protocol == 'https':
                     # TODO(ensonic): this only works for http->https
                     logger.warning("HTTPError(%s): %s, retrying with 'http://'", e.code, e.reason)
                     protocol = 'http'
-                    url = "http" + url[5:]
                 else:
                     logger.warning("HTTPError(%s): %s, unhandled!'", e.code, e.reason)
                     raise e
             except urllib.error.URLError as e:
+                if protocol != 'https':
+                    raise e
                 # [SSL: UNKNOWN_PROTOCOL] unknown protocol
                 logger.warning("URLError(%s): %s, retrying with 'http://'", e.errno, e.reason)
                 protocol = 'http'
-                url = "http" + url[5:]
         return None
 
     def run(self):
         logger.debug('network thread started')
         # network related locals
-        # TODO: change the user agent:
-        # https://docs.python.org/2/library/urllib2.html#urllib2.Request
-        # default is "Python-urllib/<version>"
+        # TODO: set a user agent, http.client does not send one by default
         headers = {
             'Content-Type': 'application/json'
         }
@@ -359,18 +1105,16 @@ class Connector(threading.Thread):
             else:
                 self.params['cmd'] = 'register'
                 timeout = 330
-            self.params['brickname'] = socket.gethostname()
-            self.params['battery'] = getBatteryVoltage()
+            self.params['brickname'] = self.brickname.get()
+            self.params['battery'] = self.battery.get()
 
             try:
-                # TODO: according to https://tools.ietf.org/html/rfc6202
-                # we should use keep alive
-                # http://stackoverflow.com/questions/1037406/python-urllib2-with-keep-alive
-                # http://stackoverflow.com/questions/13881196/remove-http-connection-header-python-urllib2
-                # https://github.com/jcgregorio/httplib2
+                # the connection is kept alive between requests, see
+                # https://tools.ietf.org/html/rfc6202
                 response = self._request("pushcmd", headers, timeout)
                 reply = json.loads(response.read().decode('utf8'))
                 logger.debug('response: %s', json.dumps(reply))
+                self.backoff.reset()
                 cmd = reply['cmd']
                 if cmd == 'repeat':
                     if not self.registered:
@@ -392,12 +1136,8 @@ class Connector(threading.Thread):
                     # TODO: we should receive a digest for the download (md5sum) so that
                     #   we can verify the download
                     logger.debug('download code: %s/download', self.address)
-                    response = self._request('download', headers, timeout)
-                    hdr = response.getheader('Content-Disposition')
-                    # save to $HOME/
-                    filename = os.path.join(self.home, hdr.split('=')[1] if hdr else 'unknown')
-                    code = self._store_code(filename, response.read().decode('utf-8'))
-                    logger.info('code downloaded to: %s', filename)
+                    started = time.monotonic()
+                    (filename, code) = self._download(headers, timeout)
                     # use a long-press of backspace to terminate
                     abort_handler = AbortHandler(self.service, self)
                     abort_handler.daemon = True
@@ -405,7 +1145,7 @@ class Connector(threading.Thread):
                     self.service.status('executing')
                     with GfxMode():
                         self.service.hal.clearDisplay()
-                        self.params['nepoexitvalue'] = self._exec_code(filename, code, abort_handler)
+                        self.params['nepoexitvalue'] = self._exec_code(filename, code, abort_handler, started)
                         # if the user did wait for a key press, wait for the key for be released
                         # before handing control back (to e.g. brickman)
                         while self.service.hal.isKeyPressed('any'):
@@ -415,7 +1155,6 @@ class Connector(threading.Thread):
                 elif cmd == 'update':
                     # import them here, since we don't use them otherwise
                     from io import BytesIO
-                    import shutil
                     import zipfile
 
                     logger.info('download update: %s/update/ev3dev/runtime', self.address)
@@ -430,6 +1169,9 @@ class Connector(threading.Thread):
                     logger.info('firmware updated')
                     # then restart:
                     # TODO: maybe we can reuse the token (pass as arg)?
+                    # the new image starts its own zygote, don't leave a zombie
+                    if self.service and self.service.zygote:
+                        self.service.zygote.stop()
                     os.execl(sys.executable, sys.executable, *sys.argv)
                 else:
                     logger.warning('unhandled command: %s', cmd)
@@ -445,7 +1187,8 @@ class Connector(threading.Thread):
                     logger.error("HTTPError(%s): %s", e.code, e.reason)
                     break
                 else:
-                    logger.error("HTTPError(%s): %s (retrying)", e.code, e.reason)
+                    delay = self.backoff.failure(Backoff.classify(e))
+                    logger.error("HTTPError(%s): %s (retrying in %.1f s)", e.code, e.reason, delay)
             except urllib.error.URLError as e:
                 # e.g. [Errno 111] Connection refused
                 #                  The handshake operation timed out
@@ -477,11 +1220,16 @@ class Connector(threading.Thread):
                         logger.debug("Nested Exception: %s", repr(nested_e))
                     break
                 else:
-                    logger.info("URLError: %s: %s (retrying)", self.address, e.reason)
-            except (socket.timeout, socket.gaierror, socket.herror, socket.error):
-                pass
+                    delay = self.backoff.failure(Backoff.classify(e))
+                    logger.info("URLError: %s: %s (retrying in %.1f s)", self.address, e.reason, delay)
+            except (socket.timeout, socket.gaierror, socket.herror, socket.error) as e:
+                delay = self.backoff.failure(Backoff.classify(e))
+                logger.debug("%s: %s (retrying in %.1f s)", self.address, repr(e), delay)
             except:  # noqa: E722
                 logger.exception("Ooops:")
+                self.backoff.failure('network')
+            self.backoff.wait(lambda: self.running)
+        self.http.close()
         logger.info('network thread stopped')
         if self.service:
             self.service.status('disconnected')
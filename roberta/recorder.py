@@ -0,0 +1,153 @@
+import array
+import struct
+import sys
+import threading
+import time
+
+# file format (little endian):
+#   header: magic, version, number of channels
+#   per channel: name length, name (utf-8), rate (Hz), typecode, sample count
+#   per channel: timestamps (float64, seconds since the start), values
+MAGIC = b'RLOG'
+VERSION = 1
+HEADER = struct.Struct('<4sHH')
+CHANNEL = struct.Struct('<dcI')
+
+
+def runPeriodically(periods, func, stop_event, clock=time.monotonic):
+    """Call func(key) every periods[key] seconds, until stop_event is set."""
+    now = clock()
+    due = {key: now for key in periods}
+    while due and not stop_event.is_set():
+        key = min(due, key=due.get)
+        now = clock()
+        if due[key] > now:
+            stop_event.wait(due[key] - now)
+            continue
+        func(key)
+        # don't try to catch up if we're late by more than a period
+        due[key] = max(due[key] + periods[key], now)
+
+
+class RingBuffer(object):
+    """Fixed size buffer that keeps the last size samples
+
+    The storage is allocated upfront, appending does not allocate.
+    """
+
+    def __init__(self, size, typecode='f'):
+        self.size = size
+        self.data = array.array(typecode, bytes(array.array(typecode).itemsize * size))
+        self.pos = 0
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.pos] = value
+        self.pos = (self.pos + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def toArray(self):
+        """Get the samples, oldest first."""
+        if self.count < self.size:
+            return self.data[:self.count]
+        return self.data[self.pos:] + self.data[:self.pos]
+
+
+class Channel(object):
+    def __init__(self, name, func, rate, size, typecode='f'):
+        self.name = name
+        self.func = func
+        self.rate = rate
+        self.timestamps = RingBuffer(size, 'd')
+        self.values = RingBuffer(size, typecode)
+        self.errors = 0
+
+
+class Recorder(object):
+    """Records samples of several channels from a background thread
+
+    Each channel is a function that returns a number and has its own sample
+    rate. Only the last size samples per channel are kept.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.channels = []
+        self.start_time = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def addChannel(self, name, func, rate, size=4096, typecode='f'):
+        self.channels.append(Channel(name, func, rate, size, typecode))
+
+    def start(self):
+        self.start_time = self.clock()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _sample(self, channel):
+        try:
+            value = channel.func()
+        except (IOError, OSError, ValueError, struct.error):
+            channel.errors += 1
+            return
+        channel.timestamps.append(self.clock() - self.start_time)
+        channel.values.append(value)
+
+    def _run(self):
+        periods = {channel: 1.0 / channel.rate for channel in self.channels}
+        runPeriodically(periods, self._sample, self.stop_event, self.clock)
+
+    def write(self, f):
+        """Write the recorded samples to the binary file object f."""
+        f.write(HEADER.pack(MAGIC, VERSION, len(self.channels)))
+        for channel in self.channels:
+            name = channel.name.encode('utf-8')
+            f.write(struct.pack('<B', len(name)) + name)
+            f.write(CHANNEL.pack(channel.rate, channel.values.data.typecode.encode(), channel.values.count))
+        for channel in self.channels:
+            for data in (channel.timestamps.toArray(), channel.values.toArray()):
+                if sys.byteorder != 'little':
+                    data.byteswap()
+                f.write(data.tobytes())
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            self.write(f)
+
+
+def readLog(filename):
+    """Load a file written by Recorder.
+
+    Returns a list of (name, rate, timestamps, values) tuples, the samples are
+    arrays.
+    """
+    with open(filename, 'rb') as f:
+        (magic, version, num_channels) = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a recording' % filename)
+        headers = []
+        for i in range(num_channels):
+            name = f.read(f.read(1)[0]).decode('utf-8')
+            (rate, typecode, count) = CHANNEL.unpack(f.read(CHANNEL.size))
+            headers.append((name, rate, typecode.decode(), count))
+        channels = []
+        for (name, rate, typecode, count) in headers:
+            samples = []
+            for tc in ('d', typecode):
+                data = array.array(tc)
+                data.frombytes(f.read(data.itemsize * count))
+                if sys.byteorder != 'little':
+                    data.byteswap()
+                samples.append(data)
+            channels.append((name, rate, samples[0], samples[1]))
+        return channels
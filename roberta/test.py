@@ -1,13 +1,31 @@
 # Hal and Ev3dev class to satisfy testing
 
+import collections
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import struct
+import threading
 from PIL import Image, ImageDraw
 
 
 class Hal(object):
+    cmds = []
 
     def __init__(self, brickConfiguration, usedSensors=None):
         self.cfg = brickConfiguration
 
+    @staticmethod
+    def enablePool():
+        return None
+
+    @staticmethod
+    def terminateCommands():
+        for cmd in Hal.cmds:
+            cmd.terminate()
+            cmd.wait()
+        Hal.cmds = []
+
     def clearDisplay(self):
         pass
 
@@ -46,8 +64,15 @@ class Ev3dev(object):
         draw = None
 
         def __init__(self):
-            im = Image.new('1', (178, 128), (0))
-            self.draw = ImageDraw.Draw(im)
+            self.image = Image.new('1', (178, 128), (0))
+            self.draw = ImageDraw.Draw(self.image)
+            self.updates = 0
+
+        def clear(self):
+            self.draw.rectangle(((0, 0), self.image.size), fill='white')
+
+        def update(self):
+            self.updates += 1
 
     class LargeMotor(object):
 
@@ -75,3 +100,139 @@ class Ev3dev(object):
 
         def stop(self):
             pass
+
+
+class SysfsSensor(object):
+    """Sensor that keeps its attributes in files like in its sysfs directory
+    and counts the reads per attribute.
+
+    modes maps the mode names to a list of values, decimals are kept per mode
+    in decimals. 'bin_data' holds the values as little endian s16.
+    """
+
+    def __init__(self, path, modes, decimals=None):
+        self._path = path
+        self.modes = modes
+        self.mode_decimals = decimals or {}
+        self.bin_data_format = 's16'
+        self.reads = collections.Counter()
+        os.makedirs(path)
+        self.mode = sorted(modes)[0]
+
+    def _read(self, name):
+        self.reads[name] += 1
+        with open(os.path.join(self._path, name), 'r') as f:
+            return f.read().strip()
+
+    def _write(self, name, value):
+        # update in place, readers keep the files open and must not see them
+        # empty
+        fd = os.open(os.path.join(self._path, name), os.O_WRONLY | os.O_CREAT)
+        try:
+            data = value if isinstance(value, bytes) else ('%s\n' % value).encode()
+            os.pwrite(fd, data, 0)
+            os.ftruncate(fd, len(data))
+        finally:
+            os.close(fd)
+
+    def setValues(self, values):
+        for (i, value) in enumerate(values):
+            self._write('value%d' % i, value)
+        self._write('bin_data', struct.pack('<%dh' % len(values), *values))
+
+    @property
+    def mode(self):
+        return self._read('mode')
+
+    @mode.setter
+    def mode(self, mode):
+        self._write('mode', mode)
+        self._write('decimals', self.mode_decimals.get(mode, 0))
+        self._write('num_values', len(self.modes[mode]))
+        self._write('bin_data_format', self.bin_data_format)
+        self.setValues(self.modes[mode])
+
+    @property
+    def decimals(self):
+        return int(self._read('decimals'))
+
+    @property
+    def num_values(self):
+        return int(self._read('num_values'))
+
+    def value(self, n=0):
+        return int(self._read('value%d' % n))
+
+
+class LocalServer(HTTPServer):
+    """Local stand-in for the openroberta server, serves program for
+    '/download' (honoring If-None-Match), redirects the paths in redirects
+    (path -> (status, location)), replies REPEAT to all other requests and
+    counts connections."""
+
+    REPEAT = b'{"cmd": "repeat"}'
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            self.server.connections += 1
+
+        def do_GET(self):
+            self.do_POST()
+
+        def do_POST(self):
+            if 'Content-Length' in self.headers:
+                self.rfile.read(int(self.headers['Content-Length']))
+            self.server.methods.append(self.command)
+            if self.path in self.server.redirects:
+                (status, location) = self.server.redirects[self.path]
+                self.send_response(status)
+                self.send_header('Location', location)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.path == '/download':
+                etag = '"%s"' % hashlib.sha256(self.server.program).hexdigest()
+                if etag in self.headers.get('If-None-Match', ''):
+                    self.server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                body = self.server.program
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Disposition', 'attachment; filename=NEPOprog.py')
+                self.send_header('ETag', etag)
+            else:
+                body = LocalServer.REPEAT
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    def __init__(self, program=b''):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), LocalServer.Handler)
+        self.connections = 0
+        self.not_modified = 0
+        self.program = program
+        self.redirects = {}
+        # of all requests
+        self.methods = []
+        self.url = 'http://127.0.0.1:%d' % self.server_port
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+        self.server_close()
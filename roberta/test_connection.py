@@ -0,0 +1,75 @@
+import logging
+import socket
+import unittest
+import urllib.error
+
+from roberta.connection import HttpConnectionPool
+
+from .test import LocalServer
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestHttpConnectionPool(unittest.TestCase):
+    def test_reuses_connection(self):
+        pool = HttpConnectionPool()
+        with LocalServer() as server:
+            for i in range(5):
+                response = pool.request(server.url + '/pushcmd', b'{}', {'Content-Type': 'application/json'}, 5)
+                self.assertEqual(LocalServer.REPEAT, response.read())
+            pool.close()
+        self.assertEqual(1, server.connections)
+        self.assertEqual(1, pool.stats['connects'])
+
+    def test_reconnects_when_dropped(self):
+        pool = HttpConnectionPool()
+        with LocalServer() as server:
+            pool.request(server.url + '/pushcmd', b'{}', {}, 5).read()
+            # simulate the server closing the idle connection
+            list(pool.connections.values())[0].sock.shutdown(socket.SHUT_RDWR)
+            response = pool.request(server.url + '/pushcmd', b'{}', {}, 5)
+            self.assertEqual(LocalServer.REPEAT, response.read())
+            pool.close()
+        self.assertEqual(1, pool.stats['reconnects'])
+
+    def test_follows_redirects(self):
+        pool = HttpConnectionPool()
+        with LocalServer() as server:
+            server.redirects['/old'] = (307, '/pushcmd')
+            server.redirects['/moved'] = (302, server.url + '/pushcmd')
+            response = pool.request(server.url + '/old', b'{}', {'Content-Type': 'application/json'}, 5)
+            self.assertEqual(LocalServer.REPEAT, response.read())
+            response = pool.request(server.url + '/moved', b'{}', {'Content-Type': 'application/json'}, 5)
+            self.assertEqual(LocalServer.REPEAT, response.read())
+            pool.close()
+        self.assertEqual(['POST', 'POST', 'POST', 'GET'], server.methods)
+
+    def test_too_many_redirects(self):
+        pool = HttpConnectionPool()
+        with LocalServer() as server:
+            server.redirects['/loop'] = (307, '/loop')
+            with self.assertRaises(urllib.error.HTTPError):
+                pool.request(server.url + '/loop', b'{}', None, 5)
+            pool.close()
+
+    def test_other_status(self):
+        pool = HttpConnectionPool()
+        with LocalServer() as server:
+            server.redirects['/choices'] = (300, '/pushcmd')
+            server.redirects['/nowhere'] = (301, '')
+            for path in ['/choices', '/nowhere']:
+                with self.assertRaises(urllib.error.HTTPError) as cm:
+                    pool.request(server.url + path, b'{}', None, 5)
+                self.assertIn(cm.exception.code, (300, 301))
+            pool.close()
+
+    def test_connection_refused(self):
+        pool = HttpConnectionPool()
+        with LocalServer() as server:
+            url = server.url
+        with self.assertRaises(urllib.error.URLError):
+            pool.request(url + '/pushcmd', b'{}', {}, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
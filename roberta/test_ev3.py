@@ -1,7 +1,19 @@
+import math
+import mmap
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 
-from .ev3 import Hal
-from .test import Ev3dev as ev3dev
+from .ev3 import ConfigurationBuilder, Display, Framebuffer, FramebufferDisplay, Hal, HalPool, KeyState, MotorHandle, \
+    MotorWaiter, ProcessWaiter, SensorReader, SensorSampler, WriteCache, isIdleOrStalled, loadFont, pollUntil, \
+    textSize
+from .recorder import readLog
+from PIL import Image, ImageDraw
+from .test import Ev3dev as ev3dev, SysfsSensor
 
 
 class TestHal(unittest.TestCase):
@@ -10,6 +22,12 @@ class TestHal(unittest.TestCase):
         self.assertNotEqual(0, hal.font_w)
         self.assertNotEqual(0, hal.font_h)
 
+    def test_atlas_is_built_on_first_draw_text(self):
+        hal = Hal(None)
+        self.assertIsNone(hal.atlas)
+        hal.drawText('Hallo', 0, 0)
+        self.assertEqual((hal.font_w, hal.font_h), hal.atlas.cell)
+
     def test__init__simple_cfg(self):
         brickConfiguration = {
             'wheel-diameter': 5.6,
@@ -171,3 +189,1058 @@ class TestHal(unittest.TestCase):
         hal.driveInCurve('forward', 'B', 10, 'C', -10, 100)
         self.assertEqual(actors['B'].speed_sp, 10)
         self.assertEqual(actors['C'].speed_sp, -10)
+
+    def test_getMotorTachoValue(self):
+        hal = self._getStdHal()
+        hal.cfg['actors']['B'].position = 720
+        self.assertEqual(720.0, hal.getMotorTachoValue('B', 'degree'))
+        self.assertEqual(2.0, hal.getMotorTachoValue('B', 'rotation'))
+        self.assertEqual(round(2 * math.pi * 5.6), hal.getMotorTachoValue('B', 'distance'))
+
+    def test_driveDistance_OneRotation(self):
+        hal = self._getStdHal()
+        hal.driveDistance('B', 'C', False, 'forward', 50, 5.6 * math.pi)
+        actors = hal.cfg['actors']
+        self.assertEqual(360, actors['B'].position_sp)
+        self.assertEqual(50, actors['C'].speed_sp)
+
+
+class CountingMotor(ev3dev.LargeMotor):
+    """Counts reads of the constant attributes."""
+
+    def __init__(self, port):
+        self.__dict__['reads'] = 0
+        ev3dev.LargeMotor.__init__(self, port)
+
+    def __getattribute__(self, name):
+        if name in ['max_speed', 'count_per_rot']:
+            object.__getattribute__(self, '__dict__')['reads'] += 1
+        return object.__getattribute__(self, name)
+
+
+class TestMotorHandle(unittest.TestCase):
+    def test_constants_are_read_once(self):
+        motor = CountingMotor(ev3dev.OUTPUT_B)
+        m = MotorHandle(motor)
+        hal = Hal(None)
+        for i in range(10):
+            hal.scaleSpeed(m, 50)
+            self.assertEqual(360, m.count_per_rot)
+        self.assertEqual(2, motor.reads)
+        self.assertEqual(1.0, m.degrees_per_count)
+
+    def test_pass_through(self):
+        motor = ev3dev.LargeMotor(ev3dev.OUTPUT_B)
+        m = MotorHandle(motor)
+        m.speed_sp = 10
+        m.run_to_rel_pos(position_sp=20)
+        self.assertEqual(10, motor.speed_sp)
+        self.assertEqual(20, m.position_sp)
+
+    def test_dc_motor(self):
+        m = MotorHandle(object())
+        self.assertIsNone(m.max_speed)
+        self.assertIsNone(m.degrees_per_count)
+
+
+class CountingDevice(object):
+    """Counts attribute writes."""
+
+    def __init__(self):
+        self.__dict__['writes'] = 0
+
+    def __setattr__(self, name, value):
+        self.__dict__['writes'] += 1
+        self.__dict__[name] = value
+
+
+class FailingDevice(object):
+    def __setattr__(self, name, value):
+        raise OSError('no such device')
+
+
+class TestWriteCache(unittest.TestCase):
+    def test_write(self):
+        cache = WriteCache()
+        device = CountingDevice()
+        for i in range(3):
+            cache.write(device, 'brightness', 255)
+        cache.write(device, 'brightness', 0)
+        self.assertEqual(0, device.brightness)
+        self.assertEqual(2, device.writes)
+        self.assertEqual(2, cache.saved)
+
+    def test_invalidate(self):
+        cache = WriteCache()
+        device = CountingDevice()
+        cache.write(device, 'brightness', 255)
+        cache.invalidate()
+        cache.write(device, 'brightness', 255)
+        self.assertEqual(2, device.writes)
+
+    def test_error_invalidates(self):
+        cache = WriteCache()
+        device = CountingDevice()
+        cache.write(device, 'brightness', 255)
+        with self.assertRaises(OSError):
+            cache.write(FailingDevice(), 'brightness', 255)
+        cache.write(device, 'brightness', 255)
+        self.assertEqual(2, device.writes)
+
+
+class TestWriteElision(unittest.TestCase):
+    def _getHal(self):
+        return Hal({
+            'wheel-diameter': 5.6,
+            'track-width': 18.0,
+            'actors': {
+                'B': Hal.makeLargeMotor(ev3dev.OUTPUT_B, 'on', 'forward'),
+                'C': Hal.makeLargeMotor(ev3dev.OUTPUT_C, 'on', 'forward'),
+            },
+            'sensors': {
+            },
+        })
+
+    def test_driveDistance(self):
+        hal = self._getHal()
+        hal.driveDistance('B', 'C', False, 'forward', 50, 10)
+        self.assertEqual(0, hal.getSavedWrites())
+        hal.driveDistance('B', 'C', False, 'forward', 50, 10)
+        # stop_action, position_sp and speed_sp for both motors
+        self.assertEqual(6, hal.getSavedWrites())
+
+    def test_command_kwargs_are_cached(self):
+        hal = self._getHal()
+        hal.rotateRegulatedMotor('B', 50, 'degree', 90)
+        m = hal.cfg['actors']['B']
+        m.position_sp = 90
+        self.assertEqual(1, hal.getSavedWrites())
+        m.position_sp = 180
+        self.assertEqual(180, m.motor.position_sp)
+
+    def test_reset_invalidates(self):
+        hal = self._getHal()
+        hal.stopMotor('B')
+        hal.invalidateWriteCaches()
+        hal.stopMotor('B')
+        self.assertEqual(0, hal.getSavedWrites())
+        hal.stopMotor('B')
+        self.assertEqual(1, hal.getSavedWrites())
+
+    def test_leds(self):
+        leds = [CountingDevice() for i in range(4)]
+        (led_all, led_colors) = (Hal.LED_ALL, Hal.LED_COLORS)
+        Hal.LED_ALL = leds
+        Hal.LED_COLORS = {
+            'green': (0, 1, 0, 1),
+            'black': (0, 0, 0, 0),
+        }
+        try:
+            hal = Hal(None)
+            for i in range(3):
+                hal.ledOn('green', 'on')
+            hal.ledOff()
+            self.assertEqual([1, 2, 1, 2], [led.writes for led in leds])
+            self.assertEqual(10, hal.getSavedWrites())
+        finally:
+            (Hal.LED_ALL, Hal.LED_COLORS) = (led_all, led_colors)
+
+
+class SysfsMotor(object):
+    """Motor that has its 'state' attribute in a regular file."""
+
+    def __init__(self, path, state=''):
+        self._path = path
+        os.mkdir(path)
+        self.setState(state)
+
+    def setState(self, state):
+        with open(os.path.join(self._path, 'state'), 'w') as f:
+            f.write(state + '\n')
+
+
+class TestMotorWaiter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.waiter = MotorWaiter()
+
+    def tearDown(self):
+        self.waiter.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _makeMotor(self, name, state=''):
+        return SysfsMotor(os.path.join(self.tmpdir, name), state)
+
+    def _later(self, delay, func, *args):
+        timer = threading.Timer(delay, func, args)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_wait_idle(self):
+        m = self._makeMotor('motor0')
+        self.assertTrue(self.waiter.wait([m], timeout=0))
+
+    def test_wait_multiple_motors(self):
+        ml = self._makeMotor('motor0', 'running')
+        mr = self._makeMotor('motor1', 'running ramping')
+        self._later(0.05, ml.setState, '')
+        self._later(0.1, mr.setState, 'holding')
+        self.assertTrue(self.waiter.wait([ml, mr], done=lambda state: 'running' not in state, timeout=5.0))
+
+    def test_wait_stalled(self):
+        m = self._makeMotor('motor0', 'running')
+        self._later(0.05, m.setState, 'running stalled')
+        self.assertTrue(self.waiter.wait([m], done=isIdleOrStalled, timeout=5.0))
+
+    def test_wait_timeout(self):
+        m = self._makeMotor('motor0', 'running')
+        start = time.monotonic()
+        self.assertFalse(self.waiter.wait([m], timeout=0.1))
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+    def test_wait_cancel(self):
+        m = self._makeMotor('motor0', 'running')
+        self._later(0.05, self.waiter.cancel)
+        self.assertFalse(self.waiter.wait([m], timeout=5.0))
+
+    def test_wait_unplugged_motor(self):
+        m = self._makeMotor('motor0', 'running')
+        m.state = []
+        self.waiter._getStateFd(m)
+        # the attribute is gone and reading it fails
+        os.unlink(os.path.join(m._path, 'state'))
+        os.close(self.waiter.state_fds[m._path])
+        self.waiter.state_fds[m._path] = os.open(m._path, os.O_RDONLY)
+        self.assertTrue(self.waiter.wait([m], timeout=1.0))
+        self.assertNotIn(m._path, self.waiter.state_fds)
+
+    def test_wait_without_sysfs(self):
+        hal = Hal(None)
+        m = ev3dev.LargeMotor(ev3dev.OUTPUT_A)
+        m.state = ['running']
+        self._later(0.05, setattr, m, 'state', [])
+        self.assertTrue(hal.waitForMotors([m], timeout=5.0))
+        hal.motor_waiter.close()
+
+
+class PollingProcessWaiter(ProcessWaiter):
+    def _openPidfd(self, pid):
+        return None
+
+
+class TestProcessWaiter(unittest.TestCase):
+    def setUp(self):
+        self.waiter = ProcessWaiter()
+
+    def tearDown(self):
+        self.waiter.close()
+
+    def _spawn(self, seconds):
+        cmd = subprocess.Popen(['sleep', str(seconds)])
+        self.addCleanup(cmd.wait)
+        self.addCleanup(cmd.kill)
+        return cmd
+
+    def test_wait(self):
+        cmd = self._spawn(0.1)
+        self.assertTrue(self.waiter.wait(cmd, timeout=5.0))
+        self.assertEqual(0, cmd.returncode)
+
+    def test_wait_polling(self):
+        self.waiter.close()
+        self.waiter = PollingProcessWaiter()
+        cmd = self._spawn(0.1)
+        self.assertTrue(self.waiter.wait(cmd, timeout=5.0))
+        self.assertEqual(0, cmd.returncode)
+
+    def test_wait_timeout(self):
+        cmd = self._spawn(10)
+        self.assertFalse(self.waiter.wait(cmd, timeout=0.1))
+        self.assertIsNone(cmd.returncode)
+
+    def test_wait_cancel(self):
+        cmd = self._spawn(10)
+        timer = threading.Timer(0.05, self.waiter.cancel)
+        timer.start()
+        self.addCleanup(timer.join)
+        start = time.monotonic()
+        self.assertFalse(self.waiter.wait(cmd))
+        self.assertLess(time.monotonic() - start, 5.0)
+
+    def test_waitCmd_keeps_cmds(self):
+        hal = Hal(None)
+        cmd = self._spawn(0.05)
+        hal.waitCmd(cmd)
+        self.assertEqual(0, cmd.returncode)
+        self.assertNotIn(cmd, Hal.cmds)
+        hal.process_waiter.close()
+
+
+class TestSensorModes(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sensor = SysfsSensor(os.path.join(self.tmpdir, 'sensor0'), {
+            'COL-REFLECT': [42],
+            'RGB-RAW': [10, 20, 30],
+        })
+        self.hal = Hal({
+            'actors': {},
+            'sensors': {
+                '1': self.sensor,
+            },
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_mode_is_read_once(self):
+        for i in range(100):
+            self.assertEqual(42.0, self.hal.getColorSensorRed('1'))
+        self.assertEqual(1, self.sensor.reads['mode'])
+
+    def test_mode_switch(self):
+        for i in range(10):
+            self.assertEqual(42.0, self.hal.getColorSensorRed('1'))
+            self.assertEqual((10.0, 20.0, 30.0), self.hal.getColorSensorRgb('1'))
+        self.assertEqual(1, self.sensor.reads['mode'])
+        self.assertEqual('RGB-RAW', self.sensor.mode)
+
+    def test_revalidate_on_error(self):
+        self.hal.getColorSensorRed('1')
+        # make reading fail like for an unplugged sensor
+        reader = self.hal.sensor_readers[self.sensor]
+        os.close(reader.fds['bin_data'])
+        reader.fds['bin_data'] = os.open(self.sensor._path, os.O_RDONLY)
+        with self.assertRaises(OSError):
+            self.hal.getColorSensorRed('1')
+        self.assertNotIn(self.sensor, self.hal.sensor_readers)
+        self.sensor.setValues([43])
+        self.assertEqual(43.0, self.hal.getColorSensorRed('1'))
+        self.assertEqual(2, self.sensor.reads['mode'])
+
+    def test_read_in_unknown_mode(self):
+        self.sensor.mode = 'RGB-RAW'
+        self.assertEqual((10.0, 20.0, 30.0), self.hal.readSensor(self.sensor))
+        self.assertEqual(42.0, self.hal.getColorSensorRed('1'))
+        self.assertEqual((42.0,), self.hal.readSensor(self.sensor))
+
+    def test_mode_changed_elsewhere(self):
+        self.hal.getColorSensorRed('1')
+        self.sensor.mode = 'RGB-RAW'
+        self.hal.invalidateSensorModes(self.sensor)
+        self.assertEqual(42.0, self.hal.getColorSensorRed('1'))
+        self.assertEqual('COL-REFLECT', self.sensor.mode)
+
+
+class TestSensorReader(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sensor = SysfsSensor(os.path.join(self.tmpdir, 'sensor0'), {
+            'COL-REFLECT': [42],
+            'RGB-RAW': [10, 20, 300],
+            'GYRO-G&A': [-125, 3],
+        }, decimals={
+            'GYRO-G&A': 1,
+        })
+        self.reader = SensorReader(self.sensor._path)
+
+    def tearDown(self):
+        self.reader.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_read(self):
+        self.sensor.mode = 'RGB-RAW'
+        self.assertEqual((10.0, 20.0, 300.0), self.reader.read('RGB-RAW'))
+        reads = self.reader.reads
+        self.sensor.setValues([11, 21, 301])
+        self.assertEqual((11.0, 21.0, 301.0), self.reader.read('RGB-RAW'))
+        # all values with one read from bin_data
+        self.assertEqual(reads + 1, self.reader.reads)
+
+    def test_read_decimals(self):
+        self.sensor.mode = 'GYRO-G&A'
+        self.assertEqual((-12.5, 0.3), self.reader.read('GYRO-G&A'))
+
+    def test_read_modes(self):
+        self.sensor.mode = 'COL-REFLECT'
+        self.assertEqual((42.0,), self.reader.read('COL-REFLECT'))
+        self.sensor.mode = 'RGB-RAW'
+        self.assertEqual((10.0, 20.0, 300.0), self.reader.read('RGB-RAW'))
+        self.sensor.mode = 'COL-REFLECT'
+        reads = self.reader.reads
+        self.assertEqual((42.0,), self.reader.read('COL-REFLECT'))
+        self.assertEqual(reads + 1, self.reader.reads)
+
+    def test_read_without_usable_bin_data(self):
+        self.sensor.bin_data_format = 'u8'
+        self.sensor.mode = 'RGB-RAW'
+        self.assertEqual((10.0, 20.0, 300.0), self.reader.read('RGB-RAW'))
+        self.assertIsNone(self.reader.modes['RGB-RAW'].bin_data)
+        reads = self.reader.reads
+        self.assertEqual((10.0, 20.0, 300.0), self.reader.read('RGB-RAW'))
+        self.assertEqual(reads + 3, self.reader.reads)
+
+    def test_read_without_mode(self):
+        self.sensor.mode = 'RGB-RAW'
+        self.assertEqual((10.0, 20.0, 300.0), self.reader.read())
+        reads = self.reader.reads
+        self.sensor.setValues([11, 21, 301])
+        self.assertEqual((11.0, 21.0, 301.0), self.reader.read())
+        self.assertEqual(reads + 1, self.reader.reads)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSensorSampler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sensor = SysfsSensor(os.path.join(self.tmpdir, 'sensor0'), {
+            'COL-REFLECT': [42],
+            'RGB-RAW': [10, 20, 30],
+        })
+        self.hal = Hal({
+            'actors': {},
+            'sensors': {
+                '1': self.sensor,
+                '2': None,
+            },
+        })
+
+    def tearDown(self):
+        self.hal.stopSensorSampler()
+        self.hal.invalidateSensorModes()
+        shutil.rmtree(self.tmpdir)
+
+    def _waitForSamples(self, sampler, port, samples):
+        deadline = time.monotonic() + 5.0
+        while sampler.getStats()[port]['samples'] < samples and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_getter_uses_samples(self):
+        clock = FakeClock()
+        sampler = SensorSampler(self.hal, {'1': 10}, clock=clock)
+        self.hal.sensor_sampler = sampler
+        self.assertEqual(42.0, self.hal.getColorSensorRed('1'))
+        self.sensor.setValues([43])
+        sampler._sample('1')
+        self.sensor.setValues([44])
+        reads = self.hal.sensor_readers[self.sensor].reads
+        self.assertEqual(43.0, self.hal.getColorSensorRed('1'))
+        self.assertEqual(reads, self.hal.sensor_readers[self.sensor].reads)
+        clock.now += 0.3
+        self.assertEqual(44.0, self.hal.getColorSensorRed('1'))
+
+    def test_sampling(self):
+        self.assertEqual(42.0, self.hal.getColorSensorRed('1'))
+        sampler = self.hal.startSensorSampler(rate=200, max_staleness=1.0)
+        self.sensor.setValues([43])
+        self._waitForSamples(sampler, '1', 5)
+        self.assertEqual(43.0, self.hal.getColorSensorRed('1'))
+        self.assertGreater(sampler.getStats()['1']['rate'], 0.0)
+
+    def test_mode_switch_reads_synchronously(self):
+        self.assertEqual(42.0, self.hal.getColorSensorRed('1'))
+        sampler = self.hal.startSensorSampler(rate=200, max_staleness=1.0)
+        self._waitForSamples(sampler, '1', 1)
+        self.assertEqual((10.0, 20.0, 30.0), self.hal.getColorSensorRgb('1'))
+
+    def test_stale_values(self):
+        clock = FakeClock()
+        sampler = SensorSampler(self.hal, {'1': 10}, clock=clock)
+        self.hal.getColorSensorRed('1')
+        sampler._sample('1')
+        self.assertEqual((42.0,), sampler.getValues(self.sensor, 'COL-REFLECT'))
+        self.assertIsNone(sampler.getValues(self.sensor, 'RGB-RAW'))
+        clock.now += 0.3
+        self.assertIsNone(sampler.getValues(self.sensor, 'COL-REFLECT'))
+
+    def test_unknown_mode_is_not_sampled(self):
+        sampler = SensorSampler(self.hal, {'1': 10})
+        sampler._sample('1')
+        self.assertEqual(0, sampler.getStats()['1']['samples'])
+
+    def test_stats(self):
+        clock = FakeClock()
+        sampler = SensorSampler(self.hal, {'1': 10}, clock=clock)
+        self.hal.getColorSensorRed('1')
+        for dt in [0.1, 0.1, 0.1, 0.1]:
+            sampler._sample('1')
+            clock.now += dt
+        stats = sampler.getStats()['1']
+        self.assertEqual(4, stats['samples'])
+        self.assertAlmostEqual(10.0, stats['rate'])
+        self.assertAlmostEqual(0.0, stats['jitter'])
+
+    def test_errors(self):
+        sampler = SensorSampler(self.hal, {'1': 10})
+        self.hal.getColorSensorRed('1')
+        os.unlink(os.path.join(self.sensor._path, 'decimals'))
+        self.hal.invalidateSensorModes(self.sensor)
+        self.hal.sensor_modes[self.sensor] = 'COL-REFLECT'
+        sampler._sample('1')
+        self.assertEqual(1, sampler.getStats()['1']['errors'])
+
+    def test_stopSensorSampler(self):
+        self.hal.getColorSensorRed('1')
+        sampler = self.hal.startSensorSampler(rate=100)
+        self.assertNotIn('2', sampler.periods)
+        self.hal.stopSensorSampler()
+        self.assertIsNone(sampler.thread)
+        self.assertIsNone(self.hal.sensor_sampler)
+
+
+class TestRecording(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sensor = SysfsSensor(os.path.join(self.tmpdir, 'sensor0'), {
+            'COL-REFLECT': [42],
+        })
+        self.hal = Hal({
+            'actors': {
+                'B': ev3dev.LargeMotor(ev3dev.OUTPUT_B),
+            },
+            'sensors': {
+                '1': self.sensor,
+            },
+        })
+
+    def tearDown(self):
+        self.hal.stopRecording()
+        self.hal.invalidateSensorModes()
+        shutil.rmtree(self.tmpdir)
+
+    def test_recording(self):
+        self.hal.cfg['actors']['B'].position = 180
+        recorder = self.hal.startRecording(['1', 'B'], rate={'1': 200, 'B': 500}, size=64)
+        time.sleep(0.05)
+        filename = os.path.join(self.tmpdir, 'rec')
+        self.hal.saveRecording(filename)
+        self.assertIsNone(recorder.thread)
+        channels = {c[0]: c for c in readLog(filename)}
+        self.assertEqual(200, channels['1'][1])
+        self.assertEqual(42.0, channels['1'][3][0])
+        self.assertEqual(180, channels['B'][3][0])
+
+    def test_unknown_port(self):
+        with self.assertRaises(ValueError):
+            self.hal.startRecording(['1', '4'])
+        self.assertIsNone(self.hal.recorder)
+
+    def test_save_without_recording(self):
+        with self.assertRaises(ValueError):
+            self.hal.saveRecording(os.path.join(self.tmpdir, 'rec'))
+
+
+class SysfsTachoMotor(SysfsMotor):
+    max_speed = 1000
+    count_per_rot = 360
+
+    def __init__(self, path):
+        SysfsMotor.__init__(self, path)
+        with open(os.path.join(path, 'command'), 'w'):
+            pass
+
+    def getCommand(self):
+        with open(os.path.join(self._path, 'command'), 'r') as f:
+            return f.read()
+
+
+class TestStartMotors(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.hal = Hal({
+            'wheel-diameter': 5.6,
+            'track-width': 18.0,
+            'actors': {
+                'B': MotorHandle(SysfsTachoMotor(os.path.join(self.tmpdir, 'motor0'))),
+                'C': MotorHandle(SysfsTachoMotor(os.path.join(self.tmpdir, 'motor1'))),
+            },
+            'sensors': {
+            },
+        })
+
+    def tearDown(self):
+        for m in self.hal.cfg['actors'].values():
+            m.closeCommandFd()
+        if self.hal.motor_waiter:
+            self.hal.motor_waiter.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_startMotors(self):
+        actors = self.hal.cfg['actors']
+        skew = self.hal.startMotors([actors['B'], actors['C']], 'run-forever')
+        self.assertEqual('run-forever', actors['B'].getCommand())
+        self.assertEqual('run-forever', actors['C'].getCommand())
+        stats = self.hal.getMotorStartSkew()
+        self.assertEqual(1, stats['starts'])
+        self.assertEqual(skew, stats['last'])
+        self.assertGreaterEqual(stats['max'], skew)
+
+    def test_driveDistance(self):
+        self.hal.driveDistance('B', 'C', False, 'forward', 50, 5.6 * math.pi)
+        actors = self.hal.cfg['actors']
+        for port in ['B', 'C']:
+            self.assertEqual('run-to-rel-pos', actors[port].getCommand())
+            self.assertEqual(360, actors[port].motor.position_sp)
+            self.assertEqual(500, actors[port].motor.speed_sp)
+        self.assertEqual(1, self.hal.getMotorStartSkew()['starts'])
+
+    def test_write_error(self):
+        actors = self.hal.cfg['actors']
+        m = actors['C']
+        m.getCommandFd()
+        os.close(m.command_fd)
+        m.__dict__['command_fd'] = os.open(os.path.join(self.tmpdir, 'motor1', 'command'), os.O_RDONLY)
+        with self.assertRaises(OSError):
+            self.hal.startMotors([actors['B'], m], 'run-forever')
+        self.assertNotIn('command_fd', m.__dict__)
+        self.hal.startMotors([actors['B'], m], 'run-forever')
+        self.assertEqual('run-forever', m.getCommand())
+
+    def test_startMotors_without_sysfs(self):
+        hal = Hal(None)
+        ml = Hal.makeLargeMotor(ev3dev.OUTPUT_B, 'on', 'forward')
+        mr = Hal.makeLargeMotor(ev3dev.OUTPUT_C, 'on', 'forward')
+        ml.speed_sp = 10
+        mr.speed_sp = 20
+        hal.startMotors([ml, mr], 'run-forever')
+        self.assertEqual(1, hal.getMotorStartSkew()['starts'])
+
+    def test_skew_includes_last_motor(self):
+        class SlowMotor(object):
+            def run_forever(self):
+                time.sleep(0.01)
+        skew = Hal(None).startMotors([SlowMotor(), SlowMotor()], 'run-forever')
+        self.assertGreaterEqual(skew, 0.02)
+
+    def test_closeAllCommandFds(self):
+        actors = self.hal.cfg['actors']
+        self.hal.startMotors([actors['B'], actors['C']], 'run-forever')
+        self.assertIn(actors['B'], MotorHandle.open_handles)
+        # what the daemon's Hal.resetState() does after the program
+        MotorHandle.closeAllCommandFds()
+        self.assertNotIn('command_fd', actors['B'].__dict__)
+        self.assertNotIn('command_fd', actors['C'].__dict__)
+        self.assertEqual(set(), MotorHandle.open_handles)
+
+
+class TestPollUntil(unittest.TestCase):
+    def test_ready(self):
+        results = iter([None, None, 'ready'])
+        self.assertEqual('ready', pollUntil(lambda: next(results), 5.0, 0.001))
+
+    def test_timeout(self):
+        start = time.monotonic()
+        self.assertIsNone(pollUntil(lambda: None, 0.05, 0.001))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+
+class TestConfigurationBuilder(unittest.TestCase):
+    @staticmethod
+    def slowFactory(port):
+        time.sleep(0.2)
+        return port
+
+    def test_build(self):
+        builder = ConfigurationBuilder({'wheel-diameter': 5.6, 'track-width': 18.0})
+        builder.addActor('B', Hal.makeLargeMotor, ev3dev.OUTPUT_B, 'on', 'forward')
+        builder.addSensor('1', TestConfigurationBuilder.slowFactory, ev3dev.INPUT_1)
+        cfg = builder.build()
+        self.assertEqual(5.6, cfg['wheel-diameter'])
+        self.assertIsInstance(cfg['actors']['B'], MotorHandle)
+        self.assertEqual(ev3dev.INPUT_1, cfg['sensors']['1'])
+        self.assertEqual(set(['B', '1', 'total']), set(builder.timings))
+        hal = Hal(cfg)
+        self.assertIsNotNone(hal.wheel_circumference)
+
+    def test_build_in_parallel(self):
+        builder = ConfigurationBuilder()
+        for port in ['1', '2', '3', '4']:
+            builder.addSensor(port, TestConfigurationBuilder.slowFactory, port)
+        cfg = builder.build()
+        self.assertEqual(['1', '2', '3', '4'], sorted(cfg['sensors']))
+        self.assertEqual({}, cfg['actors'])
+        self.assertGreaterEqual(builder.timings['1'], 0.2)
+        self.assertLess(builder.timings['total'], 0.6)
+
+    def test_missing_hardware(self):
+        builder = ConfigurationBuilder()
+        # the test stubs have no LegoPort
+        builder.addActor('A', Hal.makeOtherConsumer, ev3dev.OUTPUT_A, 'on', 'forward')
+        self.assertIsNone(builder.build()['actors']['A'])
+
+
+class PathDevice(object):
+    """Device with a sysfs directory."""
+
+    def __init__(self, path, **kwargs):
+        self._path = path
+        self.connected = True
+
+
+class TestHalPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = Hal.enablePool()
+
+    def tearDown(self):
+        Hal.pool = None
+
+    def _startProgram(self):
+        """What a generated program for a two motor, two sensor robot does
+        before the first block runs."""
+        return Hal({
+            'wheel-diameter': 5.6,
+            'track-width': 18.0,
+            'actors': {
+                'B': Hal.makeLargeMotor(ev3dev.OUTPUT_B, 'on', 'forward'),
+                'C': Hal.makeLargeMotor(ev3dev.OUTPUT_C, 'on', 'forward'),
+            },
+            'sensors': {
+                '1': Hal.openDevice(ev3dev.LargeMotor, ev3dev.INPUT_1),
+                '4': Hal.openDevice(ev3dev.LargeMotor, ev3dev.INPUT_4),
+            },
+        })
+
+    def test_reuse(self):
+        hal1 = self._startProgram()
+        hal2 = self._startProgram()
+        self.assertIs(hal1.font_s, hal2.font_s)
+        self.assertIs(hal1.lcd, hal2.lcd)
+        self.assertIs(hal1.cfg['actors']['B'].motor, hal2.cfg['actors']['B'].motor)
+        self.assertIs(hal1.cfg['sensors']['1'], hal2.cfg['sensors']['1'])
+        # the handles are new, so that nothing is cached from the last run
+        self.assertIsNot(hal1.cfg['actors']['B'], hal2.cfg['actors']['B'])
+        self.assertEqual(4, self.pool.misses)
+        self.assertEqual(4, self.pool.hits)
+
+    def test_driver_is_part_of_the_key(self):
+        s1 = Hal.openDevice(PathDevice, None, driver_name='ht-nxt-compass')
+        s2 = Hal.openDevice(PathDevice, None, driver_name='ht-nxt-color-v2')
+        self.assertIsNot(s1, s2)
+        self.assertIs(s1, Hal.openDevice(PathDevice, None, driver_name='ht-nxt-compass'))
+
+    def test_removed_device(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'sensor0')
+        os.mkdir(path)
+        s1 = Hal.openDevice(PathDevice, path)
+        self.assertIs(s1, Hal.openDevice(PathDevice, path))
+        os.rmdir(path)
+        self.assertIsNot(s1, Hal.openDevice(PathDevice, path))
+
+    def test_key_state_is_cleared(self):
+        key_state = KeyState(-1)
+        key_state.events.append(('enter', True))
+        self.pool.key_state = key_state
+        self.assertIs(key_state, Hal(None).getKeyState())
+        self.assertEqual(0, len(key_state.events))
+
+    def test_stopKeyStates(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fifo = os.path.join(tmpdir, 'event0')
+        os.mkfifo(fifo)
+        key_state = KeyState(fifo)
+        self.assertTrue(key_state.start())
+        Hal.key_states.add(key_state)
+        # what the daemon's Hal.resetState() does after a program without a pool
+        Hal.stopKeyStates()
+        self.assertFalse(key_state.running)
+        self.assertIsNone(key_state.thread)
+        self.assertIsNone(key_state.fd)
+        self.assertEqual(set(), Hal.key_states)
+
+    def test_start_latency(self):
+        Hal.pool = None
+        without_pool = min([self._timeStart() for i in range(5)])
+        Hal.pool = HalPool()
+        Hal.pool.warm()
+        with_pool = min([self._timeStart() for i in range(5)])
+        self.assertLess(with_pool, without_pool)
+
+    def _timeStart(self):
+        start = time.perf_counter()
+        self._startProgram()
+        return time.perf_counter() - start
+
+
+class FbScreen(object):
+    """ev3dev.Screen on a 1 bit framebuffer in memory (or mapped from a file)."""
+
+    class Info(object):
+        pass
+
+    def __init__(self, xres=178, yres=128, line_length=24, filename=None):
+        self.var_info = FbScreen.Info()
+        self.var_info.bits_per_pixel = 1
+        self.fix_info = FbScreen.Info()
+        self.fix_info.line_length = line_length
+        self.image = Image.new('1', (line_length * 8, yres), 'white')
+        self.draw = ImageDraw.Draw(self.image)
+        self.mmap = bytearray(self.image.tobytes('raw', '1;R'))
+        if filename:
+            with open(filename, 'w+b') as f:
+                f.write(self.mmap)
+                f.flush()
+                self.mmap = mmap.mmap(f.fileno(), len(self.mmap))
+        self.updates = 0
+
+    def clear(self):
+        self.draw.rectangle(((0, 0), self.image.size), fill='white')
+
+    def update(self):
+        self.updates += 1
+        b = self.image.tobytes('raw', '1;R')
+        self.mmap[:len(b)] = b
+
+
+class TestDisplay(unittest.TestCase):
+    def setUp(self):
+        self.screen = FbScreen()
+        self.hal = Hal(None)
+        self.hal.lcd = self.screen
+        self.hal.display = Display(self.screen)
+
+    def assertFlushed(self):
+        self.assertEqual(self.screen.image.tobytes('raw', '1;R'), bytes(self.screen.mmap))
+
+    def test_immediate(self):
+        self.hal.drawText('Hello', 0, 1)
+        self.assertFlushed()
+        stats = self.hal.getDisplayStats()
+        self.assertEqual(1, stats['frames'])
+        # only the rows of the second text line
+        self.assertEqual(self.hal.font_h * 24, stats['bytes'])
+        self.assertEqual(0, self.screen.updates)
+
+    def test_multi_line_text(self):
+        self.hal.drawText('Hello\nWorld', 0, 1)
+        self.assertFlushed()
+        self.assertEqual((30, 28), textSize('Hello\nWorld', self.hal.font_s))
+
+    def test_unchanged_rows_are_skipped(self):
+        self.hal.drawText('Hello', 0, 1)
+        self.hal.drawText('Hello', 0, 1)
+        self.assertEqual(2, self.hal.display.frames)
+        self.assertEqual(self.hal.font_h * 24, self.hal.display.bytes)
+
+    def test_clear(self):
+        self.hal.drawText('Hello', 0, 1)
+        self.hal.clearDisplay()
+        self.assertFlushed()
+        written = self.hal.display.bytes
+        self.hal.clearDisplay()
+        self.assertEqual(3, self.hal.display.frames)
+        # others might have drawn, hence clearing always writes all rows
+        self.assertEqual(written + 128 * 24, self.hal.display.bytes)
+
+    def test_shared_framebuffer(self):
+        # e.g. the daemon's Hal and the one of the program
+        other = FbScreen()
+        other.mmap = self.screen.mmap
+        daemon = Display(other)
+        daemon.clear()
+        self.hal.drawText('Hello', 0, 1)
+        daemon.clear()
+        self.assertEqual(other.image.tobytes('raw', '1;R'), bytes(self.screen.mmap))
+        self.hal.drawText('Hello', 0, 1)
+        self.hal.clearDisplay()
+        self.assertFlushed()
+
+    def test_picture(self):
+        self.hal.drawPicture(chr(0xff) * (23 * 128), 0, 0)
+        self.assertFlushed()
+
+    def test_max_fps(self):
+        clock = FakeClock()
+        self.hal.display = Display(self.screen, clock=clock)
+        self.hal.setDisplayMaxFps(10)
+        for y in range(5):
+            self.hal.drawText('line %d' % y, 0, y)
+        # the first draw is flushed right away, the others are pending
+        self.assertEqual(1, self.hal.display.frames)
+        self.hal.flushDisplay()
+        self.assertFlushed()
+        self.assertEqual(2, self.hal.display.frames)
+        self.assertIsNone(self.hal.display.timer)
+
+    def test_timer_flushes(self):
+        self.hal.setDisplayMaxFps(20)
+        self.hal.drawText('a', 0, 0)
+        self.hal.drawText('b', 0, 1)
+        self.assertTrue(pollUntil(lambda: self.hal.display.frames == 2, 1.0))
+        self.assertFlushed()
+
+    def test_fallback(self):
+        screen = ev3dev.Screen()
+        display = Display(screen)
+        display.text((0, 0), 'Hello', self.hal.font_s)
+        display.clear()
+        self.assertEqual(2, screen.updates)
+        self.assertEqual(2, display.frames)
+
+    def test_throughput(self):
+        """A loop printing five lines of values, full updates vs. rows."""
+        def run(display):
+            for i in range(20):
+                for y in range(5):
+                    display.text((0, y * self.hal.font_h), 'value %d: %d' % (y, i * y), self.hal.font_s)
+            display.flush()
+            return display.bytes
+        full = FbScreen()
+        full.var_info.bits_per_pixel = 32
+        full_bytes = run(Display(full))
+        rows_bytes = run(Display(FbScreen()))
+        self.assertEqual(100, full.updates)
+        self.assertLess(rows_bytes, full_bytes / 10)
+
+    def test_text_throughput(self):
+        """Characters per second, the glyph atlas vs. PIL text rendering on
+        a file backed screen."""
+        (fd, filename) = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, filename)
+        self.hal.lcd = FbScreen(filename=filename)
+        self.hal.display = Display(self.hal.lcd)
+        lines = ['value %d: %d' % (y, y * 7) for y in range(5)]
+
+        def run(draw):
+            rates = []
+            # the best of a few rounds, to not measure the noise
+            for r in range(5):
+                start = time.perf_counter()
+                for i in range(40):
+                    for (y, line) in enumerate(lines):
+                        draw(line, y)
+                rates.append(40 * sum(map(len, lines)) / (time.perf_counter() - start))
+            return max(rates)
+        font = self.hal.font_s
+        pil_rate = run(lambda line, y: self.hal.display.text((0, y * self.hal.font_h), line, font))
+        pil_screen = bytes(self.hal.lcd.mmap)
+        self.hal.clearDisplay()
+        self.hal.getAtlas()
+        atlas_rate = run(lambda line, y: self.hal.drawText(line, 0, y))
+        self.assertEqual(pil_screen, bytes(self.hal.lcd.mmap))
+        self.assertGreater(self.hal.atlas.hits, 0)
+        self.assertGreater(atlas_rate, pil_rate)
+
+
+class TestFramebuffer(unittest.TestCase):
+    """Draws the same things through the PIL image of FbScreen and directly
+    into a file standing in for the framebuffer."""
+
+    def setUp(self):
+        (fd, self.filename) = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.filename)
+        self.screen = FbScreen()
+        self.hal = Hal(None)
+        self.hal.display = Display(self.screen)
+        self.fb_hal = Hal(None)
+
+    def tearDown(self):
+        Hal.framebuffer = None
+
+    def _open(self, stride=24, lsb_first=True):
+        with open(self.filename, 'wb') as f:
+            f.write(bytes(stride * 128))
+        fb = Framebuffer.open(self.filename, (178, 128, stride), lsb_first)
+        self.addCleanup(fb.close)
+        self.fb_hal.display = FramebufferDisplay(fb)
+        return fb
+
+    def _draw(self, hal):
+        hal.clearDisplay()
+        hal.drawText('Hello', 0, 0)
+        hal.drawText('World', 3, 1)
+        hal.drawText('overlapping text', 25, 2)
+        hal.drawText('two\nlines', 1, 3)
+        hal.drawText('big', 2, 3, font=loadFont('ter-u18n_unicode.pil'))
+        picture = ''.join(chr(((i * 37) >> 3) & 0xff) for i in range(23 * 128))
+        hal.drawPicture(picture, 5, 80)
+
+    def test_same_as_screen(self):
+        fb = self._open()
+        self._draw(self.hal)
+        self._draw(self.fb_hal)
+        self.assertEqual(bytes(self.screen.mmap), bytes(fb.mmap))
+
+    def test_stride(self):
+        self.screen = FbScreen(line_length=32)
+        self.hal.display = Display(self.screen)
+        fb = self._open(stride=32)
+        self._draw(self.hal)
+        self._draw(self.fb_hal)
+        self.assertEqual(bytes(self.screen.mmap), bytes(fb.mmap))
+
+    def test_msb_first(self):
+        fb = self._open(lsb_first=False)
+        self._draw(self.hal)
+        self._draw(self.fb_hal)
+        self.assertEqual(bytes(self.screen.mmap).translate(Framebuffer.REVERSED_BITS), bytes(fb.mmap))
+
+    def test_unchanged_rows_are_skipped(self):
+        self._open()
+        self.fb_hal.clearDisplay()
+        self.fb_hal.drawText('Hello', 0, 1)
+        written = self.fb_hal.display.bytes
+        self.fb_hal.drawText('Hello', 0, 1)
+        stats = self.fb_hal.getDisplayStats()
+        self.assertEqual(3, stats['frames'])
+        self.assertEqual(written, stats['bytes'])
+
+    def test_display_interface(self):
+        fb = self._open()
+        display = self.fb_hal.display
+        self.fb_hal.setDisplayMaxFps(10)
+        self.fb_hal.clearDisplay()
+        self.fb_hal.drawText('Hello', 0, 0)
+        display.invalidate()
+        display.invalidateRows()
+        display.update()
+        self.fb_hal.flushDisplay()
+        self.hal.clearDisplay()
+        self.hal.drawText('Hello', 0, 0)
+        self.assertEqual(bytes(self.screen.mmap), bytes(fb.mmap))
+
+    def test_not_a_framebuffer(self):
+        self.assertIsNone(Hal.enableFramebuffer(self.filename))
+        self.assertIsNone(Hal.enableFramebuffer(os.path.join(self.filename, 'missing')))
+
+    def test_enable(self):
+        with open(self.filename, 'wb') as f:
+            f.write(bytes(24 * 128))
+        fb = Hal.enableFramebuffer(self.filename, (178, 128, 24))
+        self.addCleanup(fb.close)
+        self.assertIsInstance(Hal(None).display, FramebufferDisplay)
+
+    def test_update_latency(self):
+        """Latency of showing a line of text, via the PIL image (with only the
+        changed rows written) vs. directly on a file backed framebuffer."""
+        self.hal.lcd = FbScreen(filename=self.filename + '.pil')
+        self.addCleanup(os.unlink, self.filename + '.pil')
+        self.hal.display = Display(self.hal.lcd)
+        self._open()
+
+        def run(hal):
+            hal.getAtlas()
+            latencies = []
+            # the best of a few rounds, to not measure the noise
+            for r in range(5):
+                hal.clearDisplay()
+                start = time.perf_counter()
+                for i in range(200):
+                    hal.drawText('value: %4d' % (i % 50), 0, i % 5)
+                latencies.append((time.perf_counter() - start) / 200)
+            return min(latencies)
+        pil_latency = run(self.hal)
+        fb_latency = run(self.fb_hal)
+        self.assertEqual(bytes(self.hal.lcd.mmap), bytes(self.fb_hal.display.framebuffer.mmap))
+        self.assertLess(fb_latency, pil_latency)
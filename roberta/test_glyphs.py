@@ -0,0 +1,51 @@
+import os
+import unittest
+
+from PIL import Image, ImageDraw, ImageFont
+
+from .glyphs import GlyphAtlas, maskToRows
+
+
+def loadFont(name):
+    return ImageFont.load(os.path.join(os.path.dirname(__file__), name))
+
+
+class TestGlyphAtlas(unittest.TestCase):
+    def test_cells(self):
+        for (name, cell) in (('ter-u12n_unicode.pil', (6, 12)),
+                             ('ter-u14n_unicode.pil', (8, 14)),
+                             ('ter-u18n_unicode.pil', (10, 18))):
+            atlas = GlyphAtlas(loadFont(name))
+            self.assertEqual(cell, atlas.cell)
+            self.assertEqual((cell[0] * 3, cell[1]), atlas.render('abc').size)
+
+    def test_same_as_pil(self):
+        font = loadFont('ter-u12n_unicode.pil')
+        atlas = GlyphAtlas(font)
+        msg = 'Grüße: 42°'
+        expected = Image.new('1', (178, 128), 'white')
+        ImageDraw.Draw(expected).text((3, 5), msg, font=font)
+        image = Image.new('1', (178, 128), 'white')
+        mask = atlas.render(msg)
+        image.paste(0, (3, 5, 3 + mask.size[0], 5 + mask.size[1]), mask)
+        self.assertEqual(expected.tobytes(), image.tobytes())
+
+    def test_rows(self):
+        atlas = GlyphAtlas(loadFont('ter-u12n_unicode.pil'))
+        self.assertEqual(maskToRows(atlas.render('Hello!')), atlas.renderRows('Hello!'))
+
+    def test_can_render(self):
+        atlas = GlyphAtlas(loadFont('ter-u12n_unicode.pil'))
+        self.assertTrue(atlas.canRender('äöü'))
+        self.assertFalse(atlas.canRender('a\nb'))
+        self.assertFalse(atlas.canRender('☃'))
+
+    def test_cache(self):
+        atlas = GlyphAtlas(loadFont('ter-u12n_unicode.pil'), cache_size=2)
+        mask = atlas.render('a')
+        self.assertIs(mask, atlas.render('a'))
+        atlas.render('b')
+        atlas.render('c')
+        self.assertIsNot(mask, atlas.render('a'))
+        self.assertEqual(1, atlas.hits)
+        self.assertEqual(4, atlas.misses)
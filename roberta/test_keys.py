@@ -0,0 +1,81 @@
+import os
+import unittest
+
+from .keys import KeyState
+
+
+class TestKeyState(unittest.TestCase):
+    def setUp(self):
+        (self.r, self.w) = os.pipe()
+        self.key_state = KeyState(self.r)
+        self.assertTrue(self.key_state.start())
+
+    def tearDown(self):
+        self.key_state.stop()
+        os.close(self.r)
+        os.close(self.w)
+
+    def _sendKey(self, code, value):
+        os.write(self.w, KeyState.INPUT_EVENT.pack(0, 0, KeyState.EV_KEY, code, value))
+
+    def _press(self, code):
+        self._sendKey(code, 1)
+        self.assertTrue(self.key_state.waitForKeyPress(KeyState.KEYS[code], 1.0))
+
+    def _release(self, code):
+        with self.key_state.cond:
+            self._sendKey(code, 0)
+            self.key_state.cond.wait_for(lambda: not self.key_state.isPressed(KeyState.KEYS[code]), 1.0)
+
+    def test_isPressed(self):
+        self.assertFalse(self.key_state.isPressed('any'))
+        self._press(28)
+        self.assertTrue(self.key_state.isPressed('enter'))
+        self.assertTrue(self.key_state.isPressed('any'))
+        self.assertFalse(self.key_state.isPressed('up'))
+        self._release(28)
+        self.assertFalse(self.key_state.isPressed('enter'))
+
+    def test_wasPressedAndReleased(self):
+        self._press(103)
+        self.assertFalse(self.key_state.wasPressedAndReleased('up'))
+        self._release(103)
+        self.assertFalse(self.key_state.wasPressedAndReleased('down'))
+        self.assertTrue(self.key_state.wasPressedAndReleased('up'))
+        # consumed
+        self.assertFalse(self.key_state.wasPressedAndReleased('up'))
+
+    def test_wasPressedAndReleased_short_presses_are_kept(self):
+        for i in range(3):
+            self._press(14)
+            self._release(14)
+        for i in range(3):
+            self.assertTrue(self.key_state.wasPressedAndReleased('any'))
+        self.assertFalse(self.key_state.wasPressedAndReleased('any'))
+
+    def test_wasPressedAndReleased_interleaved(self):
+        self._press(103)
+        self._press(108)
+        self._release(108)
+        self._release(103)
+        self.assertTrue(self.key_state.wasPressedAndReleased('up'))
+        self.assertTrue(self.key_state.wasPressedAndReleased('down'))
+        self.assertFalse(self.key_state.wasPressedAndReleased('any'))
+
+    def test_wasPressedAndReleased_any_overlapping(self):
+        self._press(103)
+        self._press(108)
+        self._release(103)
+        self._release(108)
+        self.assertTrue(self.key_state.wasPressedAndReleased('any'))
+        self.assertTrue(self.key_state.wasPressedAndReleased('any'))
+        self.assertFalse(self.key_state.wasPressedAndReleased('any'))
+
+    def test_waitForKeyPress_timeout(self):
+        self.assertFalse(self.key_state.waitForKeyPress('enter', 0.05))
+
+    def test_events_are_bounded(self):
+        for i in range(100):
+            self._press(105)
+            self._release(105)
+        self.assertEqual(self.key_state.events.maxlen, len(self.key_state.events))
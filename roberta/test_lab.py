@@ -1,14 +1,25 @@
+import hashlib
+from io import BytesIO
+import json
 import logging
 import httpretty
+import os
 import _thread
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
 import threading
 import time
 import unittest
+import urllib.error
 
 from roberta import lab
 from roberta.lab import Connector, Service, TOKEN_PER_SESSION
+from roberta.keys import KeyState
 
-from .test import Hal
+from .test import Hal, LocalServer
 from .__version__ import version
 
 logging.basicConfig(level=logging.DEBUG)
@@ -16,6 +27,7 @@ logging.basicConfig(level=logging.DEBUG)
 URL = 'https://lab.open-roberta.org'
 JSON = 'application/json'
 CMD_REPEAT = '{"cmd": "repeat"}'
+CMD_ABORT = '{"cmd": "abort"}'
 
 
 class DummyAbortHandler(threading.Thread):
@@ -37,9 +49,57 @@ class DummyAbortHandler(threading.Thread):
             return False      # reraise the exception
 
 
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class KillingAbortHandler(DummyAbortHandler):
+    def __init__(self, signum, to_sleep=0.3):
+        DummyAbortHandler.__init__(self, to_sleep)
+        self.signum = signum
+        self.pid = None
+
+    def run(self):
+        time.sleep(self.to_sleep)
+        os.kill(self.pid, self.signum)
+
+
+class TimedAbortHandler(lab.AbortHandler):
+    """Aborts the program after to_sleep seconds, as if the keys were pressed."""
+
+    def __init__(self, abort, to_sleep=0.3):
+        lab.AbortHandler.__init__(self, DummyService(), None)
+        self.abort = abort
+        self.to_sleep = to_sleep
+
+    def run(self):
+        time.sleep(self.to_sleep)
+        if self.running:
+            getattr(self, self.abort)()
+
+
+def isRunning(pid):
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as f:
+            # zombies are dead, but might not be reaped by init yet
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
 class DummyService(object):
     def __init__(self):
         self.hal = Hal(None)
+        self.zygote = None
         self.params = {
             'macaddr': '00:00:00:00:00:00',
             'firmwarename': 'ev3dev',
@@ -56,6 +116,66 @@ class TestGetHwAddr(unittest.TestCase):
         self.assertRegex(lab.getHwAddr(b'eth0'), '^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$')
 
 
+class TestCachedValue(unittest.TestCase):
+    def test_get_is_cached(self):
+        clock = FakeClock()
+        calls = []
+        value = lab.CachedValue(lambda: calls.append(clock.now) or len(calls), 10.0, clock=clock.clock)
+        self.assertEqual(1, value.get())
+        clock.sleep(5.0)
+        self.assertEqual(1, value.get())
+        clock.sleep(5.0)
+        self.assertEqual(2, value.get())
+
+
+class TestPayload(unittest.TestCase):
+    def test_encode(self):
+        params = DummyService().params
+        params['token'] = 'ABCDEFGH'
+        params['battery'] = '7.500'
+        payload = lab.Payload(params)
+        self.assertEqual(params, json.loads(payload.encode().decode('utf8')))
+        params['battery'] = '7.400'
+        self.assertEqual(params, json.loads(payload.encode().decode('utf8')))
+
+    def test_encode_new_static_field(self):
+        params = {'cmd': 'push'}
+        payload = lab.Payload(params)
+        payload.encode()
+        params['firmwareversion'] = 'Linux'
+        self.assertEqual(params, json.loads(payload.encode().decode('utf8')))
+
+    def test_encode_changed_static_field(self):
+        params = {'cmd': 'push', 'firmwareversion': 'Linux'}
+        payload = lab.Payload(params)
+        payload.encode()
+        params['firmwareversion'] = 'Linux 4.14'
+        self.assertEqual(params, json.loads(payload.encode().decode('utf8')))
+
+
+class TestFindHwAddr(unittest.TestCase):
+    def setUp(self):
+        self.sys_class_net = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.sys_class_net)
+
+    def _addIface(self, ifname, addr):
+        os.mkdir(os.path.join(self.sys_class_net, ifname))
+        with open(os.path.join(self.sys_class_net, ifname, 'address'), 'w') as f:
+            f.write(addr + '\n')
+
+    def test_find_hw_addr(self):
+        self._addIface('lo', '00:00:00:00:00:00')
+        self._addIface('eth0', '02:00:00:00:00:03')
+        self._addIface('wlan0', '02:00:00:00:00:01')
+        self.assertEqual('02:00:00:00:00:01', lab.findHwAddr(self.sys_class_net))
+
+    def test_find_hw_addr_none(self):
+        self._addIface('lo', '00:00:00:00:00:00')
+        self.assertIsNone(lab.findHwAddr(self.sys_class_net))
+
+
 class TestGenerateToken(unittest.TestCase):
     def test_generate_token(self):
         self.assertRegex(lab.generateToken(), '^[0-9A-Z]{8}$')
@@ -66,11 +186,339 @@ class TestGetBatteryVoltage(unittest.TestCase):
         self.assertGreaterEqual(float(lab.getBatteryVoltage()), 0.0)
 
 
+class TestBackoff(unittest.TestCase):
+    def _getBackoff(self, clock, random=1.0):
+        return lab.Backoff(clock=clock.clock, sleep=clock.sleep, random=lambda: random)
+
+    def test_delay_grows_exponentially(self):
+        backoff = self._getBackoff(FakeClock())
+        self.assertEqual([1.0, 2.0, 4.0], [backoff.failure('refused') for i in range(3)])
+
+    def test_delay_is_capped(self):
+        backoff = self._getBackoff(FakeClock())
+        for i in range(20):
+            backoff.failure('timeout')
+        self.assertEqual(lab.Backoff.DELAYS['timeout'][1], backoff.delay)
+
+    def test_delay_has_jitter(self):
+        backoff = self._getBackoff(FakeClock(), random=0.0)
+        self.assertEqual(0.5, backoff.failure('refused'))
+
+    def test_error_classes_are_separate(self):
+        backoff = self._getBackoff(FakeClock())
+        backoff.failure('refused')
+        backoff.failure('refused')
+        self.assertEqual(lab.Backoff.DELAYS['dns'][0], backoff.failure('dns'))
+
+    def test_reset(self):
+        backoff = self._getBackoff(FakeClock())
+        backoff.failure('refused')
+        backoff.failure('refused')
+        backoff.reset()
+        self.assertEqual(0.0, backoff.delay)
+        self.assertEqual(1.0, backoff.failure('refused'))
+
+    def test_wait(self):
+        clock = FakeClock()
+        backoff = self._getBackoff(clock)
+        backoff.failure('refused')
+        backoff.failure('refused')
+        backoff.wait()
+        self.assertEqual(2.0, clock.now)
+
+    def test_wait_is_interruptible(self):
+        clock = FakeClock()
+        backoff = self._getBackoff(clock)
+        backoff.failure('refused')
+        backoff.wait(lambda: clock.now < 0.5)
+        self.assertEqual(0.5, clock.now)
+
+    def test_classify(self):
+        self.assertEqual('dns', lab.Backoff.classify(urllib.error.URLError(socket.gaierror(-2, 'unknown'))))
+        self.assertEqual('refused', lab.Backoff.classify(urllib.error.URLError(ConnectionRefusedError())))
+        self.assertEqual('timeout', lab.Backoff.classify(socket.timeout()))
+        self.assertEqual('server', lab.Backoff.classify(urllib.error.HTTPError(URL, 503, 'busy', {}, None)))
+        self.assertEqual('network', lab.Backoff.classify(urllib.error.URLError('no route')))
+
+
+class TestNegotiationCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'state', 'servers.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_unknown(self):
+        cache = lab.NegotiationCache(self.filename)
+        self.assertIsNone(cache.get('lab.open-roberta.org'))
+
+    def test_set_is_persisted(self):
+        lab.NegotiationCache(self.filename).set('lab.open-roberta.org', 'http', 'rest/')
+        cache = lab.NegotiationCache(self.filename)
+        self.assertEqual(('http', 'rest/'), cache.get('lab.open-roberta.org'))
+
+    def test_invalidate_is_persisted(self):
+        lab.NegotiationCache(self.filename).set('lab.open-roberta.org', 'http', 'rest/')
+        lab.NegotiationCache(self.filename).invalidate('lab.open-roberta.org')
+        cache = lab.NegotiationCache(self.filename)
+        self.assertIsNone(cache.get('lab.open-roberta.org'))
+
+
+class TestCodeCache(unittest.TestCase):
+    CODE = 'result = 6 * 7\n'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _exec(self, compiled_code):
+        scope = {}
+        exec(compiled_code, scope)
+        return scope['result']
+
+    def test_miss(self):
+        cache = lab.CodeCache(self.tmp_dir)
+        self.assertEqual(42, self._exec(cache.compile(self.CODE, 'test.py')))
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+
+    def test_hit(self):
+        lab.CodeCache(self.tmp_dir).compile(self.CODE, 'test.py')
+        cache = lab.CodeCache(self.tmp_dir)
+        self.assertEqual(42, self._exec(cache.compile(self.CODE.encode('utf-8'), 'test.py')))
+        self.assertEqual((1, 0), (cache.hits, cache.misses))
+
+    def test_filename_is_part_of_key(self):
+        cache = lab.CodeCache(self.tmp_dir)
+        cache.compile(self.CODE, 'test.py')
+        self.assertEqual('other.py', cache.compile(self.CODE, 'other.py').co_filename)
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+
+    def test_size_is_bounded(self):
+        cache = lab.CodeCache(self.tmp_dir, max_entries=2)
+        for i in range(4):
+            cache.compile('result = %d\n' % i, 'test.py')
+        self.assertEqual(2, len(os.listdir(self.tmp_dir)))
+
+    def test_broken_entry(self):
+        cache = lab.CodeCache(self.tmp_dir)
+        cache.compile(self.CODE, 'test.py')
+        for entry in os.listdir(self.tmp_dir):
+            with open(os.path.join(self.tmp_dir, entry), 'wb') as f:
+                f.write(b'broken')
+        self.assertEqual(42, self._exec(cache.compile(self.CODE, 'test.py')))
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+
+
+class TestProgramCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, content):
+        filename = os.path.join(self.tmp_dir, name)
+        with open(filename, 'wb') as f:
+            f.write(content)
+        return filename
+
+    def test_add(self):
+        cache = lab.ProgramCache(self.cache_dir)
+        filename = self._write('prog.py', b'pass\n')
+        cache.add(filename, 'abc')
+        self.assertEqual(filename, lab.ProgramCache(self.cache_dir).lookup('abc'))
+        self.assertEqual(['"abc"'], cache.etags())
+
+    def test_install_unchanged(self):
+        cache = lab.ProgramCache(self.cache_dir)
+        filename = self._write('prog.py', b'pass\n')
+        cache.add(filename, 'abc')
+        mtime = os.stat(filename).st_mtime_ns
+        self.assertTrue(cache.install(filename, 'abc'))
+        self.assertEqual(mtime, os.stat(filename).st_mtime_ns)
+
+    def test_install_restores(self):
+        cache = lab.ProgramCache(self.cache_dir)
+        filename = self._write('prog.py', b'pass\n')
+        cache.add(filename, 'abc')
+        # atomically replaced by another program
+        os.replace(self._write('other.py', b'x = 1\n'), filename)
+        self.assertTrue(cache.install(filename, 'abc'))
+        with open(filename, 'rb') as f:
+            self.assertEqual(b'pass\n', f.read())
+
+    def test_install_edited_in_place(self):
+        cache = lab.ProgramCache(self.cache_dir)
+        filename = self._write('prog.py', b'pass\n')
+        cache.add(filename, 'abc')
+        with open(filename, 'ab') as f:
+            f.write(b'x = 1\n')
+        self.assertTrue(cache.install(filename, 'abc'))
+        with open(filename, 'rb') as f:
+            self.assertEqual(b'pass\n', f.read())
+
+    def test_install_hardlinked(self):
+        cache = lab.ProgramCache(self.cache_dir)
+        filename = self._write('prog.py', b'pass\n')
+        cache.add(filename, 'abc')
+        # as stored by older versions
+        os.unlink(filename)
+        os.link(os.path.join(self.cache_dir, 'abc'), filename)
+        self.assertFalse(cache.install(filename, 'abc'))
+        self.assertIsNone(cache.lookup('abc'))
+
+    def test_install_unknown(self):
+        cache = lab.ProgramCache(self.cache_dir)
+        self.assertFalse(cache.install(os.path.join(self.tmp_dir, 'prog.py'), 'abc'))
+
+    def test_size_is_bounded(self):
+        cache = lab.ProgramCache(self.cache_dir, max_entries=2)
+        for digest in ['a', 'b', 'c']:
+            cache.add(self._write(digest + '.py', digest.encode('utf8')), digest)
+        self.assertEqual(['"c"', '"b"'], cache.etags())
+        self.assertIsNone(cache.lookup('a'))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'a')))
+
+
+class TestAbortHandler(unittest.TestCase):
+    # from linux/input-event-codes.h
+    KEY_BACKSPACE = 14
+    KEY_ENTER = 28
+    KEY_DOWN = 108
+
+    def setUp(self):
+        (self.r, self.w) = os.pipe()
+        self.child = subprocess.Popen(['sleep', '10'])
+        self.abort_handler = lab.AbortHandler(DummyService(), None, device=self.r)
+        self.abort_handler.pid = self.child.pid
+        self.abort_handler.daemon = True
+
+    def tearDown(self):
+        self.abort_handler.running = False
+        self.abort_handler.join()
+        if self.child.poll() is None:
+            self.child.kill()
+            self.child.wait()
+        os.close(self.r)
+        os.close(self.w)
+
+    def _key(self, code, value):
+        os.write(self.w, KeyState.INPUT_EVENT.pack(0, 0, KeyState.EV_KEY, code, value))
+
+    def test_soft_abort(self):
+        self.abort_handler.start()
+        self._key(TestAbortHandler.KEY_ENTER, 1)
+        self._key(TestAbortHandler.KEY_DOWN, 1)
+        self.assertEqual(-signal.SIGTERM, self.child.wait(timeout=1.0))
+
+    def test_hard_abort(self):
+        self.abort_handler.start()
+        started = time.monotonic()
+        self._key(TestAbortHandler.KEY_BACKSPACE, 1)
+        self.assertEqual(-signal.SIGKILL, self.child.wait(timeout=2.0))
+        self.assertGreaterEqual(time.monotonic() - started, 1.0)
+
+    def test_short_back_press(self):
+        self.abort_handler.start()
+        self._key(TestAbortHandler.KEY_BACKSPACE, 1)
+        self._key(TestAbortHandler.KEY_BACKSPACE, 0)
+        time.sleep(1.2)
+        self.assertIsNone(self.child.poll())
+
+    def test_single_key(self):
+        self.abort_handler.start()
+        self._key(TestAbortHandler.KEY_ENTER, 1)
+        self._key(TestAbortHandler.KEY_ENTER, 0)
+        self._key(TestAbortHandler.KEY_DOWN, 1)
+        time.sleep(0.2)
+        self.assertIsNone(self.child.poll())
+
+
+class TestZygote(unittest.TestCase):
+    def setUp(self):
+        self.zygote = lab.Zygote()
+        self.zygote.start()
+
+    def tearDown(self):
+        self.zygote.stop()
+
+    def _run(self, code, abort_handler=None):
+        return self.zygote.run(compile(code, 'test.py', 'exec'), abort_handler or DummyAbortHandler())
+
+    def test_is_alive(self):
+        self.assertTrue(self.zygote.is_alive())
+
+    def test_run_with_result(self):
+        self.assertEqual(42, self._run(TestConnector.GOOD_CODE_WITH_RESULT))
+
+    def test_run_in_child_process(self):
+        self.assertNotEqual(os.getpid(), self._run('import os\nresult = os.getpid()\n'))
+
+    def test_run_with_error(self):
+        self.assertEqual(1, self._run('raise ValueError()\n'))
+
+    def test_output_is_flushed(self):
+        (fd, filename) = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, filename)
+        # like a pipe to the journal, the output is block buffered
+        self._run('import sys\nsys.stdout = open(%r, "w")\nprint("hello")\n' % filename)
+        with open(filename, 'r') as f:
+            self.assertEqual('hello\n', f.read())
+
+    def test_soft_abort(self):
+        self.assertEqual(143, self._run(TestConnector.INFINITE_LOOP, KillingAbortHandler(signal.SIGTERM)))
+
+    def test_hard_abort(self):
+        self.assertEqual(137, self._run(TestConnector.INFINITE_LOOP, KillingAbortHandler(signal.SIGKILL)))
+        # the zygote survives
+        self.assertEqual(42, self._run(TestConnector.GOOD_CODE_WITH_RESULT))
+
+    def _runWithCommand(self, abort):
+        (fd, filename) = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, filename)
+        code = (
+            'import subprocess, time\n'
+            'from roberta.test import Hal\n'
+            'cmd = subprocess.Popen(["sleep", "10"])\n'
+            'Hal.cmds.append(cmd)\n'
+            'with open(%r, "w") as f:\n'
+            '  f.write(str(cmd.pid))\n'
+            'while True:\n'
+            '  time.sleep(0.1)\n'
+        ) % filename
+        result = self._run(code, TimedAbortHandler(abort))
+        with open(filename, 'r') as f:
+            pid = int(f.read())
+        deadline = time.monotonic() + 2.0
+        while isRunning(pid) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(isRunning(pid))
+        return result
+
+    def test_soft_abort_terminates_commands(self):
+        self.assertEqual(143, self._runWithCommand('_softAbort'))
+
+    def test_hard_abort_kills_commands(self):
+        self.assertEqual(137, self._runWithCommand('_hardAbort'))
+
+
 class TestService(unittest.TestCase):
     def test___init__(self):
         service = Service(None)
         self.assertNotEqual('00:00:00:00:00:00', service.params['macaddr'])
 
+    def test_hal_is_loaded_on_first_use(self):
+        service = Service(None)
+        self.assertFalse(service.isHalLoaded())
+        self.assertIsNotNone(service.hal)
+        self.assertTrue(service.isHalLoaded())
+
     def test_updateConfiguration(self):
         if TOKEN_PER_SESSION:
             return
@@ -128,6 +576,21 @@ class TestConnector(unittest.TestCase):
         '  result += 1\n'
     )
 
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.negotiation_cache = lab.negotiation_cache
+        lab.negotiation_cache = lab.NegotiationCache(os.path.join(self.tmp_dir, 'servers.json'))
+        self.code_cache = lab.code_cache
+        lab.code_cache = lab.CodeCache(os.path.join(self.tmp_dir, 'code'))
+        self.program_cache = lab.program_cache
+        lab.program_cache = lab.ProgramCache(os.path.join(self.tmp_dir, 'programs'))
+
+    def tearDown(self):
+        lab.negotiation_cache = self.negotiation_cache
+        lab.code_cache = self.code_cache
+        lab.program_cache = self.program_cache
+        shutil.rmtree(self.tmp_dir)
+
     def test___init__(self):
         connector = Connector(URL, None)
         self.assertTrue(connector.running)
@@ -166,6 +629,35 @@ class TestConnector(unittest.TestCase):
         req = httpretty.last_request()
         self.assertEqual(req.path, '/rest/pushcmd')
 
+    @httpretty.activate
+    def test_remembers_rest_prefix(self):
+        responses = [
+            httpretty.Response(body=CMD_REPEAT, status=200, content_type=JSON),
+            httpretty.Response(body=CMD_ABORT, status=200, content_type=JSON),
+        ]
+        httpretty.register_uri(httpretty.POST, "%s/pushcmd" % URL,
+                               body=CMD_REPEAT, status=404, content_type=JSON)
+        httpretty.register_uri(httpretty.POST, "%s/rest/pushcmd" % URL, responses=responses)
+
+        connector = Connector(URL, DummyService())
+        connector.run()
+        paths = [req.path for req in httpretty.latest_requests()]
+        # no more probing once the prefix is known
+        self.assertNotIn('/pushcmd', paths[paths.index('/rest/pushcmd'):])
+        self.assertEqual(('https', 'rest/'), lab.negotiation_cache.get('lab.open-roberta.org'))
+
+    @httpretty.activate
+    def test_uses_negotiated_prefix(self):
+        lab.negotiation_cache.set('lab.open-roberta.org', 'https', 'rest/')
+        httpretty.register_uri(httpretty.POST, "%s/rest/pushcmd" % URL,
+                               body=CMD_REPEAT, status=403, content_type=JSON)
+
+        connector = Connector(URL, None)
+        connector.run()  # catch error and return
+        self.assertNotIn('/pushcmd', [req.path for req in httpretty.latest_requests()])
+        # the error response invalidated the entry
+        self.assertIsNone(lab.negotiation_cache.get('lab.open-roberta.org'))
+
     @httpretty.activate
     def test_sends_json_with_register(self):
         httpretty.register_uri(httpretty.POST, "%s/pushcmd" % URL,
@@ -195,6 +687,75 @@ class TestConnector(unittest.TestCase):
         self.assertIn('token', body)
         self.assertIn('brickname', body)
 
+    def test_store_code(self):
+        code = (
+            '#!/usr/bin/python\n'
+            'from __future__ import absolute_import\n'
+            'for i in xrange(10):\n'
+            '    pass\n'
+        ).encode('utf-8')
+        filename = os.path.join(self.tmp_dir, 'test.py')
+        connector = Connector(URL, None)
+        # use a tiny chunk size to split lines across chunks
+        (source, digest) = connector._store_code(filename, BytesIO(code), chunk_size=5)
+        expected = (
+            '#!/usr/bin/python3\n'
+            'for i in range(10):\n'
+            '    pass\n'
+        ).encode('utf-8')
+        self.assertEqual(expected, source)
+        self.assertEqual(hashlib.sha256(code).hexdigest(), digest)
+        with open(filename, 'rb') as f:
+            self.assertEqual(expected, f.read())
+
+    def test_store_code_without_final_newline(self):
+        filename = os.path.join(self.tmp_dir, 'test.py')
+        connector = Connector(URL, None)
+        (source, digest) = connector._store_code(filename, BytesIO(b'a = 1\nb = 2'), chunk_size=3)
+        self.assertEqual(b'a = 1\nb = 2', source)
+
+    def test_store_code_unchanged(self):
+        filename = os.path.join(self.tmp_dir, 'test.py')
+        connector = Connector(URL, None)
+        connector._store_code(filename, BytesIO(b'a = 1\n'))
+        inode = os.stat(filename).st_ino
+        connector._store_code(filename, BytesIO(b'a = 1\n'))
+        self.assertEqual(inode, os.stat(filename).st_ino)
+        self.assertFalse(os.path.exists(filename + '.tmp'))
+        connector._store_code(filename, BytesIO(b'a = 2\n'))
+        self.assertNotEqual(inode, os.stat(filename).st_ino)
+
+    def test_download_not_modified(self):
+        with LocalServer(TestConnector.GOOD_CODE.encode('utf8')) as server:
+            lab.negotiation_cache.set(server.url[7:], 'http', '')
+            connector = Connector(server.url, None)
+            connector.home = self.tmp_dir
+            (filename, code) = connector._download({}, 5)
+            self.assertEqual(os.path.join(self.tmp_dir, 'NEPOprog.py'), filename)
+            inode = os.stat(filename).st_ino
+            (filename, code) = connector._download({}, 5)
+            self.assertEqual(1, server.not_modified)
+            self.assertEqual(TestConnector.GOOD_CODE.encode('utf8'), code)
+            self.assertEqual(inode, os.stat(filename).st_ino)
+            # a new program is downloaded again
+            server.program = TestConnector.GOOD_CODE_WITH_RESULT.encode('utf8')
+            (filename, code) = connector._download({}, 5)
+            self.assertEqual(TestConnector.GOOD_CODE_WITH_RESULT.encode('utf8'), code)
+            connector.http.close()
+
+    def test_download_not_modified_after_edit(self):
+        with LocalServer(TestConnector.GOOD_CODE.encode('utf8')) as server:
+            lab.negotiation_cache.set(server.url[7:], 'http', '')
+            connector = Connector(server.url, None)
+            connector.home = self.tmp_dir
+            (filename, code) = connector._download({}, 5)
+            with open(filename, 'ab') as f:
+                f.write(b'raise Exception()\n')
+            (filename, code) = connector._download({}, 5)
+            self.assertEqual(1, server.not_modified)
+            self.assertEqual(TestConnector.GOOD_CODE.encode('utf8'), code)
+            connector.http.close()
+
     def test_exec_good_code(self):
         connector = Connector(URL, None)
         res = connector._exec_code("test.py", TestConnector.GOOD_CODE, DummyAbortHandler())
@@ -210,6 +771,15 @@ class TestConnector(unittest.TestCase):
         res = connector._exec_code("test.py", TestConnector.GOOD_CODE_WITH_RESULT, DummyAbortHandler())
         self.assertEqual(res, 42)
 
+    def test_exec_code_in_zygote(self):
+        service = DummyService()
+        service.zygote = lab.Zygote()
+        service.zygote.start()
+        connector = Connector(URL, service)
+        res = connector._exec_code("test.py", TestConnector.GOOD_CODE_WITH_RESULT, DummyAbortHandler())
+        service.zygote.stop()
+        self.assertEqual(res, 42)
+
     def test_exec_code_with_infinite_loop(self):
         connector = Connector(URL, None)
         with self.assertRaises(KeyboardInterrupt):
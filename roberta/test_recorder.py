@@ -0,0 +1,108 @@
+import os
+import struct
+import tempfile
+import time
+import unittest
+
+from .recorder import RingBuffer, Recorder, readLog
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRingBuffer(unittest.TestCase):
+    def test_append(self):
+        buf = RingBuffer(4)
+        for i in range(3):
+            buf.append(i)
+        self.assertEqual([0.0, 1.0, 2.0], buf.toArray().tolist())
+
+    def test_append_wraps(self):
+        buf = RingBuffer(4, 'i')
+        for i in range(10):
+            buf.append(i)
+        self.assertEqual([6, 7, 8, 9], buf.toArray().tolist())
+        self.assertEqual(4, len(buf.data))
+
+
+class TestRecorder(unittest.TestCase):
+    def setUp(self):
+        (fd, self.filename) = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test_save_and_read(self):
+        clock = FakeClock()
+        recorder = Recorder(clock)
+        values = iter(range(100))
+        recorder.addChannel('A', lambda: next(values), 500, size=8, typecode='i')
+        recorder.addChannel('1', lambda: 0.5, 10)
+        recorder.start_time = 0.0
+        for i in range(10):
+            recorder._sample(recorder.channels[0])
+            clock.now += 0.002
+        recorder._sample(recorder.channels[1])
+        recorder.save(self.filename)
+
+        channels = readLog(self.filename)
+        self.assertEqual(['A', '1'], [c[0] for c in channels])
+        (name, rate, timestamps, values) = channels[0]
+        self.assertEqual(500, rate)
+        self.assertEqual(list(range(2, 10)), values.tolist())
+        self.assertAlmostEqual(0.004, timestamps[0])
+        (name, rate, timestamps, values) = channels[1]
+        self.assertEqual([0.5], values.tolist())
+
+    def test_errors(self):
+        def fail():
+            raise OSError()
+        recorder = Recorder()
+        recorder.addChannel('1', fail, 10)
+        recorder.start_time = 0.0
+        recorder._sample(recorder.channels[0])
+        self.assertEqual(1, recorder.channels[0].errors)
+        self.assertEqual(0, recorder.channels[0].values.count)
+
+    def test_malformed_reads(self):
+        def fail():
+            raise struct.error('unpack requires a buffer of 2 bytes')
+        recorder = Recorder()
+        recorder.addChannel('1', fail, 10)
+        recorder.start_time = 0.0
+        recorder._sample(recorder.channels[0])
+        self.assertEqual(1, recorder.channels[0].errors)
+
+    def test_timestamp_resolution(self):
+        clock = FakeClock()
+        recorder = Recorder(clock)
+        recorder.addChannel('1', lambda: 1.0, 10)
+        recorder.start_time = 0.0
+        # after three hours, float32 would be off by about a millisecond
+        clock.now = 3 * 3600 + 0.0001
+        recorder._sample(recorder.channels[0])
+        recorder.save(self.filename)
+        timestamps = readLog(self.filename)[0][2]
+        self.assertAlmostEqual(clock.now, timestamps[0], places=6)
+
+    def test_read_invalid(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'\0' * 16)
+        with self.assertRaises(ValueError):
+            readLog(self.filename)
+
+    def test_record(self):
+        recorder = Recorder()
+        recorder.addChannel('A', time.monotonic, 500, size=16, typecode='d')
+        recorder.start()
+        time.sleep(0.1)
+        recorder.stop()
+        channel = recorder.channels[0]
+        self.assertEqual(16, channel.values.count)
+        self.assertEqual(16, len(channel.values.data))
@@ -0,0 +1,49 @@
+import logging
+import unittest
+
+from roberta.timeline import Timeline, getProcessAge
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def clock(self):
+        return self.now
+
+
+class TestGetProcessAge(unittest.TestCase):
+    def test_get_process_age(self):
+        self.assertGreaterEqual(getProcessAge(), 0.0)
+
+
+class TestTimeline(unittest.TestCase):
+    def test_mark(self):
+        clock = FakeClock()
+        timeline = Timeline(clock=clock.clock)
+        clock.now += 1.0
+        timeline.mark('done')
+        (name, timestamp, duration) = timeline.marks[-1]
+        self.assertEqual('done', name)
+        self.assertGreaterEqual(timestamp, 1.0)
+        self.assertIsNone(duration)
+
+    def test_phase(self):
+        clock = FakeClock()
+        timeline = Timeline(clock=clock.clock)
+        with timeline.phase('init'):
+            clock.now += 0.5
+        (name, timestamp, duration) = timeline.marks[-1]
+        self.assertEqual('init', name)
+        self.assertAlmostEqual(0.5, duration)
+
+    def test_log(self):
+        timeline = Timeline()
+        timeline.mark('ready')
+        timeline.log()
+
+
+if __name__ == '__main__':
+    unittest.main()
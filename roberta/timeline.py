@@ -0,0 +1,70 @@
+import logging
+import os
+import time
+
+logger = logging.getLogger('roberta.timeline')
+
+
+def getProcessAge():
+    """Get the seconds since the process was started (or None)."""
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            # the command name can contain spaces, hence skip past it
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        # field 22 is the start time in clock ticks after boot
+        return uptime - int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+class Timeline(object):
+    """Records timestamps of the startup phases
+
+    The times are relative to the start of the process (if known), so that
+    the interpreter startup is included.
+    """
+
+    class Phase(object):
+        def __init__(self, timeline, name):
+            self.timeline = timeline
+            self.name = name
+
+        def __enter__(self):
+            self.started = self.timeline.clock()
+
+        def __exit__(self, type, value, traceback):
+            self.timeline.mark(self.name, self.timeline.clock() - self.started)
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.start = clock()
+        self.marks = []
+        age = getProcessAge()
+        if age is not None:
+            self.start -= age
+            self.mark('interpreter')
+
+    def mark(self, name, duration=None):
+        """Record that phase name is done, optionally with its duration."""
+        timestamp = self.clock() - self.start
+        self.marks.append((name, timestamp, duration))
+        if duration is None:
+            logger.debug('%8.3f s: %s', timestamp, name)
+        else:
+            logger.debug('%8.3f s: %s (%.3f s)', timestamp, name, duration)
+
+    def phase(self, name):
+        """Context manager that records the duration of the phase name."""
+        return Timeline.Phase(self, name)
+
+    def log(self):
+        for (name, timestamp, duration) in self.marks:
+            if duration is None:
+                logger.info('%8.3f s: %s', timestamp, name)
+            else:
+                logger.info('%8.3f s: %s (%.3f s)', timestamp, name, duration)
+
+
+timeline = Timeline()